@@ -0,0 +1,140 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from models.align_image import AlignmentEngine
+
+# ---------------------------
+# Benchmark do alinhamento (matching + estimador) em folhas gravadas
+# ---------------------------
+# Cada variante = overrides à config_alignment.json, corrida sobre as mesmas
+# imagens com um AlignmentEngine próprio (só align(): sem cache de H nem
+# cantos; as variantes com "backend": "phase" correm só o phase_homography). As folhas gravadas não têm ground truth, por isso a precisão mede-se:
+#   - reproj_rms_px: RMS da reprojeção dos inliers do estimador (px a 1x);
+#   - residual_px:   resíduo do verify() da H final contra o template
+#                    (correlação de fase por quadrante a verify_scale 0.5);
+#   - vs_ref_px:     desvio máximo (grelha 3x3 do frame) entre a H da variante e
+#                    a da variante de referência (a primeira, o caminho atual).
+
+DEFAULT_VARIANTS = {
+    "bf_crosscheck": {},
+    "knn_ratio": {"matcher": "knn"},
+    "flann_lsh": {"matcher": "flann"},
+    "knn_tiles4": {"matcher": "knn", "feature_tiles": 4},
+    "phase_rigid": {"backend": "phase"},
+    "flann_bucket": {"matcher": "flann", "bucket_grid": [8, 6]},
+    "flann_bucket_magsac": {"matcher": "flann", "bucket_grid": [8, 6], "estimator": "usac_magsac"},
+    "flann_bucket_affine": {"matcher": "flann", "bucket_grid": [8, 6], "estimator": "usac_accurate",
+                            "model": "affine"},
+}
+
+
+def _grid_points(shape):
+    h, w = shape[:2]
+    return np.array([[x, y] for y in (0, h / 2, h - 1) for x in (0, w / 2, w - 1)],
+                    np.float64).reshape(-1, 1, 2)
+
+
+def benchmark_alignment(template_img, images, variants=None, base_config="config/config_alignment.json",
+                        repeat=1):
+    """
+    Corre cada variante ({nome: overrides da config}) sobre images (lista de BGR) e
+    devolve {nome: {"time_ms_p50", "time_ms_p95", "matches", "inliers",
+    "reproj_rms_px", "residual_px", "vs_ref_px", "failures"}} (médias por imagem).
+    """
+    variants = DEFAULT_VARIANTS if variants is None else variants
+    with open(base_config, "r") as f:
+        base = json.load(f)
+    report, ref_H = {}, None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for v, (name, overrides) in enumerate(variants.items()):
+            config_path = os.path.join(tmp, f"{name}.json")
+            with open(config_path, "w") as f:
+                json.dump({**base, "verify_scale": 0.5, **overrides}, f)
+            engine = AlignmentEngine(template_img, config_path=config_path)
+            phase = str(overrides.get("backend", "")).lower() == "phase"
+
+            times, rows, Hs = [], [], []
+            for img in images:
+                H = None
+                for _ in range(max(1, int(repeat))):
+                    t0 = time.perf_counter()
+                    try:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            if phase:
+                                H, _ = engine.phase_homography(img)
+                            else:
+                                _, H = engine.align(img)
+                    except (ValueError, cv2.error):
+                        H = None
+                    if H is None:
+                        break
+                    times.append((time.perf_counter() - t0) * 1000.0)
+                Hs.append(H)
+                if H is None:
+                    continue
+                m = {} if phase else engine.last_match_info
+                res = engine.verify(img, H)
+                row = [m.get("matches", np.nan), m.get("inliers", np.nan), m.get("reproj_rms_px") or np.nan,
+                       res["shift_px"], np.nan]
+                if ref_H is not None and ref_H[len(Hs) - 1] is not None:
+                    g = _grid_points(img.shape)
+                    d = cv2.perspectiveTransform(g, H) - cv2.perspectiveTransform(g, ref_H[len(Hs) - 1])
+                    row[4] = float(np.abs(d).max())
+                rows.append(row)
+            if v == 0:
+                ref_H = Hs
+
+            rows = np.array(rows, np.float64).reshape(-1, 5)
+            mean = [float(np.nanmean(c)) if np.isfinite(c).any() else None for c in rows.T]
+            report[name] = {
+                "time_ms_p50": float(np.percentile(times, 50)) if times else None,
+                "time_ms_p95": float(np.percentile(times, 95)) if times else None,
+                "matches": mean[0], "inliers": mean[1], "reproj_rms_px": mean[2],
+                "residual_px": mean[3], "vs_ref_px": mean[4],
+                "failures": sum(H is None for H in Hs),
+            }
+    return report
+
+
+def _fmt(value, width, digits):
+    return f"{value:{width}.{digits}f}" if value is not None else f"{'-':>{width}}"
+
+
+if __name__ == "__main__":
+    # python -m models.align_benchmark template.jpg folha1.jpg [folha2.jpg ...] [--repeat N]
+    import glob
+    import sys
+
+    args = sys.argv[1:]
+    repeat = 1
+    if "--repeat" in args:
+        i = args.index("--repeat")
+        repeat = int(args[i + 1])
+        del args[i:i + 2]
+    if len(args) < 2:
+        print("uso: python -m models.align_benchmark template.jpg folha1.jpg [folha2.jpg ...] [--repeat N]")
+        sys.exit(1)
+
+    template = cv2.imread(args[0])
+    if template is None:
+        raise ValueError(f"Não foi possível ler o template: {args[0]}")
+    paths = sorted(p for pattern in args[1:] for p in glob.glob(pattern))
+    images = [img for img in (cv2.imread(p) for p in paths) if img is not None]
+    if not images:
+        raise ValueError("Nenhuma folha gravada encontrada.")
+
+    print(f"alinhamento: {len(images)} folha(s) contra {args[0]} ({repeat} repetição(ões))")
+    print(f"  {'variante':<22}{'p50 ms':>9}{'p95 ms':>9}{'matches':>9}{'inliers':>9}"
+          f"{'reproj px':>11}{'resíduo px':>12}{'vs ref px':>11}{'falhas':>8}")
+    for name, r in benchmark_alignment(template, images, repeat=repeat).items():
+        print(f"  {name:<22}{_fmt(r['time_ms_p50'], 9, 1)}{_fmt(r['time_ms_p95'], 9, 1)}"
+              f"{_fmt(r['matches'], 9, 0)}{_fmt(r['inliers'], 9, 0)}{_fmt(r['reproj_rms_px'], 11, 2)}"
+              f"{_fmt(r['residual_px'], 12, 2)}{_fmt(r['vs_ref_px'], 11, 2)}{r['failures']:>8}")
@@ -1,16 +1,24 @@
+import hashlib
+import os
 import time
+from collections import deque
 
 import cv2
 import numpy as np
 import json
 
+from models.defect_detector import _run_strips, _split_strips, _tile_pool
+from models.detect_sheet_margins import sheet_corners
+from utils.profiler import PROFILER
+
 orb = cv2.ORB_create(nfeatures=1500)
 
-def align_with_template(current_img, template_img, config_path="config/config_alignment.json", resize_scale=0.5):
-    """
-    Alinha a imagem atual com o template usando ORB + Homografia, redimensionando temporariamente para acelerar o processo.
-    """
-    start_time = time.perf_counter()
+
+def _to_gray(img):
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+
+
+def _prepare_alignment():
     # Improve determinism: seed RNG and limit threading during alignment
     try:
         cv2.setRNGSeed(12345)
@@ -21,6 +29,305 @@ def align_with_template(current_img, template_img, config_path="config/config_al
     except Exception:
         pass
 
+
+def _small_gray(img, resize_scale):
+    """Imagem reduzida (INTER_AREA) em cinzento, onde corre o ORB."""
+    small = cv2.resize(img, (0, 0), fx=resize_scale, fy=resize_scale, interpolation=cv2.INTER_AREA)
+    return _to_gray(small)
+
+
+def _homography_from_matches(tpl_pts, kpts2, matches, good_match_percent, resize_scale, config=None,
+                             return_stats=False):
+    """
+    Homografia current -> template (coords originais) a partir dos matches template/current.
+    return_stats: devolve (H, {"matches", "inliers", "reproj_rms_px"}).
+    """
+    if not matches:
+        raise ValueError("Nenhum match encontrado.")
+
+    # ordenação estável por distância (= sorted(matches, key=distance)) e top good_match_percent
+    dist = np.array([m.distance for m in matches], np.float32)
+    order = np.argsort(dist, kind="stable")
+    num_good = max(4, int(len(matches) * good_match_percent))
+    good = order[:num_good]
+
+    if len(good) < 4:
+        raise ValueError("Matches insuficientes para homografia.")
+
+    # Pontos ajustados ao tamanho redimensionado
+    query_idx = np.array([m.queryIdx for m in matches], np.int64)[good]
+    train_idx = np.array([m.trainIdx for m in matches], np.int64)[good]
+    pts1 = tpl_pts[query_idx].reshape(-1, 1, 2)
+    pts2 = np.float32([kpts2[i].pt for i in train_idx]).reshape(-1, 1, 2)
+
+    # Compensar escala nos pontos
+    pts1 /= resize_scale
+    pts2 /= resize_scale
+
+    # Calcular homografia nos pontos originais
+    H, inliers = _estimate_transform(pts2, pts1, config or {})
+    if not return_stats:
+        return H
+    return H, {"matches": int(len(good)), "inliers": int(inliers.sum()),
+               "reproj_rms_px": _reproj_rms(H, pts2, pts1, inliers)}
+
+
+def _reproj_rms(H, src, dst, inliers):
+    """RMS (px) de |H·src - dst| nos inliers; None sem inliers."""
+    if not inliers.any():
+        return None
+    err = cv2.perspectiveTransform(src[inliers].astype(np.float64), H) - dst[inliers]
+    return float(np.sqrt(np.mean(np.sum(err * err, axis=-1))))
+
+
+# ---------------------------
+# Etapa de matching configurável (config_alignment.json)
+# ---------------------------
+# "matcher":      "bf"    -> BFMatcher crossCheck + top good_match_percent (omissão, como antes)
+#                 "knn"   -> BF k=2 do frame contra o template + ratio test
+#                 "flann" -> FLANN-LSH: índice do template construído 1x por template + ratio test
+# "ratio_test":   razão de Lowe para knn/flann (0.8)
+# "bucket_grid":  [colunas, linhas] -> seleção de keypoints por células: o ORB deteta
+#                 "bucket_candidates" pontos e cada célula fica com os
+#                 "bucket_max_per_cell" de maior resposta (template e frame); sem
+#                 a chave, os 1500 pontos do ORB como antes
+# "estimator":    "ransac" (omissão) | "lmeds" | "usac_default" | "usac_fast" |
+#                 "usac_accurate" | "usac_prosac" | "usac_magsac"
+# "model":        "homography" (omissão) | "affine" (estimateAffine2D, 6 graus de liberdade)
+# "ransac_reproj_threshold" (3.0), "ransac_max_iters" (2000), "ransac_confidence" (0.995):
+#                 os valores por omissão são os do findHomography, por isso a
+#                 config antiga dá exatamente a mesma H.
+# "feature_mask": keypoints só na máscara da folha (AlignmentEngine(mask=...)); no
+#                 frame a máscara é dilatada "feature_mask_margin" px (64, a 1x)
+# "feature_tiles": nº de faixas horizontais para o ORB (1 = imagem inteira); cada
+#                 faixa corre num ORB próprio, no pool de "feature_workers" threads
+#                 (o OpenCV fica a 1 thread por chamada, como antes: determinístico)
+# "stable_keypoints": usa o subconjunto estável do template escolhido offline
+#                 (python -m models.stable_keypoints) em vez de todas as features
+
+_ESTIMATORS = {
+    "ransac": cv2.RANSAC,
+    "lmeds": cv2.LMEDS,
+    "usac_default": cv2.USAC_DEFAULT,
+    "usac_fast": cv2.USAC_FAST,
+    "usac_accurate": cv2.USAC_ACCURATE,
+    "usac_prosac": cv2.USAC_PROSAC,
+    "usac_magsac": cv2.USAC_MAGSAC,
+}
+
+_FLANN_LSH = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)   # 6 = FLANN_INDEX_LSH
+
+
+def _estimate_transform(src, dst, config):
+    """
+    Transformação robusta src -> dst (pontos (N, 1, 2) float32) segundo a config:
+    devolve (H 3x3, máscara de inliers (N,) bool).
+    """
+    name = str(config.get("estimator", "ransac")).lower()
+    if name not in _ESTIMATORS:
+        raise ValueError(f"Estimador desconhecido: {name} (opções: {', '.join(_ESTIMATORS)})")
+    method = _ESTIMATORS[name]
+    threshold = float(config.get("ransac_reproj_threshold", 3.0))
+    max_iters = int(config.get("ransac_max_iters", 2000))
+    confidence = float(config.get("ransac_confidence", 0.995))
+    model = str(config.get("model", "homography")).lower()
+
+    sp = PROFILER.start("align.homography")
+    if model == "affine":
+        A, inliers = cv2.estimateAffine2D(src, dst, method=method, ransacReprojThreshold=threshold,
+                                          maxIters=max_iters, confidence=confidence)
+        H = None if A is None else np.vstack([A, [0.0, 0.0, 1.0]])
+    elif model == "homography":
+        H, inliers = cv2.findHomography(src, dst, method, threshold, maxIters=max_iters, confidence=confidence)
+    else:
+        raise ValueError(f"Modelo desconhecido: {model} (homography ou affine)")
+    sp.stop()
+    if H is None:
+        raise ValueError("Homografia falhou.")
+    return H, inliers.ravel().astype(bool)
+
+
+def _bucket_select(kpts, shape, grid, per_cell):
+    """Índices (ordenados) dos per_cell keypoints de maior resposta em cada célula de uma grelha (colunas, linhas)."""
+    if not kpts:
+        return np.zeros(0, np.int64)
+    h, w = shape[:2]
+    cols, rows = grid
+    pts = np.float32([kp.pt for kp in kpts])
+    response = np.float32([kp.response for kp in kpts])
+    cx = np.minimum((pts[:, 0] * cols / w).astype(np.int64), cols - 1)
+    cy = np.minimum((pts[:, 1] * rows / h).astype(np.int64), rows - 1)
+    cell = cy * cols + cx
+    order = np.lexsort((-response, cell))              # por célula, resposta decrescente
+    sorted_cell = cell[order]
+    first = np.searchsorted(sorted_cell, sorted_cell)  # início da célula de cada posição
+    rank = np.arange(len(order)) - first
+    return np.sort(order[rank < per_cell])
+
+
+def _orb_halo(detector):
+    """Margem (px da imagem do ORB) que cobre bordo + patch no nível mais grosseiro da pirâmide."""
+    reach = max(detector.getEdgeThreshold(), int(np.ceil(detector.getPatchSize() * 0.7072)))
+    return int(np.ceil(reach * detector.getScaleFactor() ** (detector.getNLevels() - 1))) + 2
+
+
+def _detect_tiled(detectors, gray, mask, pool):
+    """
+    detectAndCompute por faixas horizontais em paralelo (um ORB por faixa, com
+    nfeatures = total / faixas): cada faixa corre sobre o recorte com halo
+    (descritores completos) e só guarda os keypoints do seu núcleo (máscara).
+    """
+    strips = _split_strips(gray.shape[0], len(detectors), _orb_halo(detectors[0]))
+
+    def _strip(job):
+        detector, (y0, y1, hy0, hy1) = job
+        core = np.zeros((hy1 - hy0, gray.shape[1]), np.uint8)
+        core[y0 - hy0:y1 - hy0] = 255
+        if mask is not None:
+            cv2.bitwise_and(core, mask[hy0:hy1], dst=core)
+        kpts, desc = detector.detectAndCompute(gray[hy0:hy1], core)
+        for kp in kpts:
+            kp.pt = (kp.pt[0], kp.pt[1] + hy0)
+        return kpts, desc
+
+    results = _run_strips(_strip, list(zip(detectors, strips)), pool)
+    kpts = [kp for k, _ in results for kp in k]
+    descs = [d for _, d in results if d is not None and len(d)]
+    return kpts, (np.vstack(descs) if descs else None)
+
+
+def _ratio_matches(knn, ratio):
+    """(query_idx, train_idx, distance) dos matches knn (k=2) que passam o ratio test, por distância."""
+    q, t, d = [], [], []
+    for pair in knn:
+        if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance:
+            m = pair[0]
+            q.append(m.queryIdx)
+            t.append(m.trainIdx)
+            d.append(m.distance)
+    order = np.argsort(np.float32(d), kind="stable")
+    return np.int64(q)[order], np.int64(t)[order], np.float32(d)[order]
+
+
+# ---------------------------
+# Relatório de qualidade do alinhamento
+# ---------------------------
+# Cada alinhamento traz, além da H, um relatório (dict) que permite decidir se
+# a folha é inspecionável antes de gastar a deteção nela:
+#   - matches / inliers / inlier_ratio / reproj_rms_px do estimador (só ORB; a
+#     cache, os cantos e a fase não têm matches e são julgados pelo verify);
+#   - sanidade da H (homography_sanity): a câmara está fixa e a folha pára nas
+#     guias, por isso uma H que encolhe 10%, estica um eixo ou cisalha uns
+#     graus é um alinhamento errado, mesmo com muitos inliers;
+#   - shift_px / response do verify, quando corrido; time_ms.
+# "ok" = todos os critérios passam; "reasons" lista os que falharam. Limites
+# (config_alignment.json): quality_min_inliers (15), quality_min_inlier_ratio
+# (0.2), quality_max_reproj_px (2.5), quality_max_scale_dev (0.05),
+# quality_max_anisotropy (0.03), quality_max_skew_deg (2.0) e
+# quality_max_perspective (0.02: variação máxima do w da H nos cantos do frame).
+# Com "quality_verify_orb": true a H do ORB também tem de passar o verify.
+
+def homography_sanity(H, shape, config=None):
+    """
+    Escala, anisotropia e cisalhamento da parte linear de H e perspetiva nos cantos de
+    um frame com esta forma: {"ok", "scale", "anisotropy", "skew_deg", "perspective", "reasons"}.
+    """
+    cfg = config or {}
+    H = np.asarray(H, np.float64)
+    A = H[:2, :2] / H[2, 2]
+    s1, s2 = np.linalg.svd(A, compute_uv=False)
+    scale = float(np.sqrt(s1 * s2))
+    anisotropy = float(s1 / s2 - 1.0) if s2 > 0 else float("inf")
+    c0, c1 = A[:, 0], A[:, 1]
+    cos = float(c0 @ c1) / max(float(np.linalg.norm(c0) * np.linalg.norm(c1)), 1e-12)
+    skew = abs(90.0 - float(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))))
+    h, w = shape[:2]
+    corners = np.array([[0.0, 0.0], [w - 1.0, 0.0], [0.0, h - 1.0], [w - 1.0, h - 1.0]])
+    perspective = float(np.abs(corners @ H[2, :2] / H[2, 2]).max())
+
+    reasons = []
+    if np.linalg.det(A) <= 0:
+        reasons.append("H espelha a imagem")
+    max_dev = float(cfg.get("quality_max_scale_dev", 0.05))
+    if abs(scale - 1.0) > max_dev:
+        reasons.append(f"escala {scale:.3f} fora de 1±{max_dev:g}")
+    max_aniso = float(cfg.get("quality_max_anisotropy", 0.03))
+    if anisotropy > max_aniso:
+        reasons.append(f"anisotropia {anisotropy:.3f} > {max_aniso:g}")
+    max_skew = float(cfg.get("quality_max_skew_deg", 2.0))
+    if skew > max_skew:
+        reasons.append(f"cisalhamento {skew:.2f}° > {max_skew:g}°")
+    max_persp = float(cfg.get("quality_max_perspective", 0.02))
+    if perspective > max_persp:
+        reasons.append(f"perspetiva {perspective:.4f} > {max_persp:g}")
+    return {"ok": not reasons, "scale": scale, "anisotropy": anisotropy, "skew_deg": skew,
+            "perspective": perspective, "reasons": reasons}
+
+
+def alignment_report(H, shape, config=None, source="orb", matches=None, inliers=None,
+                     reproj_rms_px=None, shift_px=None, response=None, time_ms=None, error=None):
+    """
+    Relatório de qualidade de um alinhamento: {"ok", "source", "reasons", "matches", "inliers",
+    "inlier_ratio", "reproj_rms_px", "shift_px", "response", "scale", "anisotropy", "skew_deg",
+    "perspective", "time_ms"}. H None (ou error) = alinhamento falhado.
+    """
+    cfg = config or {}
+    report = {"ok": False, "source": source, "reasons": [], "matches": matches, "inliers": inliers,
+              "inlier_ratio": (inliers / matches) if matches and inliers is not None else None,
+              "reproj_rms_px": reproj_rms_px, "shift_px": shift_px, "response": response,
+              "scale": None, "anisotropy": None, "skew_deg": None, "perspective": None, "time_ms": time_ms}
+    if H is None or error is not None:
+        report["reasons"].append(error or "sem homografia")
+        return report
+
+    sanity = homography_sanity(H, shape, cfg)
+    report.update((k, sanity[k]) for k in ("scale", "anisotropy", "skew_deg", "perspective"))
+    reasons = report["reasons"]
+    if inliers is not None:
+        min_inliers = int(cfg.get("quality_min_inliers", 15))
+        if inliers < min_inliers:
+            reasons.append(f"{inliers} inliers < {min_inliers}")
+        min_ratio = float(cfg.get("quality_min_inlier_ratio", 0.2))
+        if report["inlier_ratio"] is not None and report["inlier_ratio"] < min_ratio:
+            reasons.append(f"inliers {100.0 * report['inlier_ratio']:.0f}% < {100.0 * min_ratio:.0f}%")
+    max_rms = float(cfg.get("quality_max_reproj_px", 2.5))
+    if reproj_rms_px is not None and reproj_rms_px > max_rms:
+        reasons.append(f"reprojeção {reproj_rms_px:.2f} px > {max_rms:g} px")
+    reasons.extend(sanity["reasons"])
+    report["ok"] = not reasons
+    return report
+
+
+def alignment_decision(info):
+    """
+    Política por folha a partir do info do align_verified: "reuse" (H da cache
+    verificada), "realign" (H nova fiável) ou "reject" (alinhamento não fiável).
+    """
+    quality = info.get("quality")
+    if quality is None or not quality["ok"]:
+        return "reject"
+    return "reuse" if info.get("source") == "cache" else "realign"
+
+
+def _warp_to_template(current_img, H, template_shape):
+    h, w = template_shape[:2]
+    sp = PROFILER.start("align.warp")
+    aligned = cv2.warpPerspective(current_img, H, (w, h))
+    sp.stop()
+    return aligned
+
+
+def align_with_template(current_img, template_img, config_path="config/config_alignment.json", resize_scale=0.5,
+                        return_report=False):
+    """
+    Alinha a imagem atual com o template usando ORB + Homografia, redimensionando temporariamente para acelerar o processo.
+    Chamada isolada: lê a config e calcula as features do template a cada chamada
+    (para alinhamentos repetidos contra o mesmo template usar AlignmentEngine).
+    return_report: devolve (aligned, H, alignment_report) em vez de (aligned, H).
+    """
+    start_time = time.perf_counter()
+    _prepare_alignment()
+
     # Carregar parâmetros
     with open(config_path, "r") as f:
         config = json.load(f)
@@ -28,55 +335,843 @@ def align_with_template(current_img, template_img, config_path="config/config_al
     max_features = config.get("max_features", 1000)
     good_match_percent = config.get("good_match_percent", 0.2)
 
-    # Função utilitária
-    def to_gray(img):
-        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
-
     # Redimensionar para acelerar alinhamento
-    template_small = cv2.resize(template_img, (0, 0), fx=resize_scale, fy=resize_scale, interpolation=cv2.INTER_AREA)
-    current_small = cv2.resize(current_img, (0, 0), fx=resize_scale, fy=resize_scale, interpolation=cv2.INTER_AREA)
-
-    template_gray = to_gray(template_small)
-    current_gray = to_gray(current_small)
+    sp = PROFILER.start("align.resize")
+    template_gray = _small_gray(template_img, resize_scale)
+    current_gray = _small_gray(current_img, resize_scale)
+    sp.stop()
 
     # ORB + Matching
     #orb = cv2.ORB_create(nfeatures=max_features)
+    sp = PROFILER.start("align.orb")
     kpts1, desc1 = orb.detectAndCompute(template_gray, None)
     kpts2, desc2 = orb.detectAndCompute(current_gray, None)
+    sp.stop()
 
     if desc1 is None or desc2 is None:
         raise ValueError("Não foi possível extrair descritores ORB.")
 
+    sp = PROFILER.start("align.match")
     matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
     matches = matcher.match(desc1, desc2)
-    if not matches:
-        raise ValueError("Nenhum match encontrado.")
+    sp.stop()
 
-    matches = sorted(matches, key=lambda x: x.distance)
-    num_good = max(4, int(len(matches) * good_match_percent))
-    good_matches = matches[:num_good]
+    tpl_pts = np.float32([kp.pt for kp in kpts1])
+    H, stats = _homography_from_matches(tpl_pts, kpts2, matches, good_match_percent, resize_scale, config,
+                                        return_stats=True)
+    aligned = _warp_to_template(current_img, H, template_img.shape)
 
-    if len(good_matches) < 4:
-        raise ValueError("Matches insuficientes para homografia.")
+    end_time = time.perf_counter()
+    print(f"Align Image (com resize) demorou {end_time - start_time:.4f} segundos")
 
-    # Pontos ajustados ao tamanho redimensionado
-    pts1 = np.float32([kpts1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-    pts2 = np.float32([kpts2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+    if return_report:
+        return aligned, H, alignment_report(H, current_img.shape, config, "orb",
+                                            time_ms=(end_time - start_time) * 1000.0, **stats)
+    return aligned, H
 
-    # Compensar escala nos pontos
-    pts1 /= resize_scale
-    pts2 /= resize_scale
 
-    # Calcular homografia nos pontos originais
-    H, _ = cv2.findHomography(pts2, pts1, cv2.RANSAC)
-    if H is None:
-        raise ValueError("Homografia falhou.")
+# ---------------------------
+# Warp só da ROI, com mapa de remap em cache
+# ---------------------------
+# A deteção só usa a bbox da máscara no espaço do template, por isso basta
+# warpar essa janela: H_roi = T(-x0, -y0)·H, saída (w0, h0). Quando a mesma H
+# volta (cache de homografias do AlignmentEngine), o mapeamento por pixel é
+# sempre o mesmo: à 2ª utilização gera-se o mapa em ponto fixo (CV_16SC2 +
+# tabela de interpolação a 1/32 px) e a partir daí é só um cv2.remap, sem
+# recalcular a projeção por pixel. O remap difere do warpPerspective em ±2
+# níveis nalguns pixels (arredondamento da interpolação), irrelevante para a
+# deteção. Uma H nova usa o warpPerspective direto da ROI (gerar o mapa
+# custaria mais que o próprio warp se a H não se repetir). Com lente calibrada
+# o mapa compõe distorção + H (AlignmentEngine._lens_maps) e gera-se logo à
+# 1ª utilização da H: a correção da lente não acrescenta nenhuma passagem.
 
-    # Aplicar na imagem em alta resolução
-    h, w = to_gray(template_img).shape
-    aligned = cv2.warpPerspective(current_img, H, (w, h))
+def _fixed_point_maps(H_roi, size, rows_per_chunk=256):
+    """Mapas de remap (CV_16SC2 + tabela CV_16UC1) equivalentes a warpPerspective(H_roi, size)."""
+    w, h = size
+    M = np.linalg.inv(np.asarray(H_roi, np.float64))     # dst -> src
+    map_xy = np.empty((h, w, 2), np.int16)
+    map_tab = np.empty((h, w), np.uint16)
+    xs = np.arange(w, dtype=np.float64)
+    # por blocos de linhas: os mapas float64/float32 intermédios ficam pequenos
+    for y0 in range(0, h, rows_per_chunk):
+        ys = np.arange(y0, min(h, y0 + rows_per_chunk), dtype=np.float64)[:, None]
+        W = M[2, 0] * xs + M[2, 1] * ys + M[2, 2]
+        W = np.where(W != 0, 1.0 / np.where(W != 0, W, 1.0), 0.0)
+        fx = ((M[0, 0] * xs + M[0, 1] * ys + M[0, 2]) * W).astype(np.float32)
+        fy = ((M[1, 0] * xs + M[1, 1] * ys + M[1, 2]) * W).astype(np.float32)
+        rows = slice(y0, y0 + fx.shape[0])
+        map_xy[rows], map_tab[rows] = cv2.convertMaps(fx, fy, cv2.CV_16SC2)
+    return map_xy, map_tab
 
-    end_time = time.perf_counter()
-    print(f"Align Image (com resize) demorou {end_time - start_time:.4f} segundos")
 
-    return aligned, H
+def _sample_grid(size, step):
+    """
+    Coordenadas (gx, gy) da saída a cada step px, com uma amostra extra a toda a
+    volta: a amostra j fica em (j - ½)·step - ½, o centro que o cv2.resize (xstep)
+    lhe atribui no _maps_from_samples (a extrapolação constante do resize cai fora).
+    """
+    w, h = size
+    gx = (np.arange(-(-w // step) + 2) - 0.5) * step - 0.5
+    gy = (np.arange(-(-h // step) + 2) - 0.5) * step - 0.5
+    return np.meshgrid(gx, gy)
+
+
+def _maps_from_samples(src_x, src_y, size, step):
+    """Mapas de remap (CV_16SC2 + tabela) para size, interpolando bilinearmente as amostras de _sample_grid."""
+    w, h = size
+    nh, nw = src_x.shape
+    full = (nw * step, nh * step)
+    fx = cv2.resize(src_x.astype(np.float32), full, interpolation=cv2.INTER_LINEAR)[step:step + h, step:step + w]
+    fy = cv2.resize(src_y.astype(np.float32), full, interpolation=cv2.INTER_LINEAR)[step:step + h, step:step + w]
+    return cv2.convertMaps(fx, fy, cv2.CV_16SC2)
+
+
+class RoiWarper:
+    """Warp current -> template limitado a uma ROI (x, y, w, h) do template, com remap em cache por H."""
+
+    def __init__(self, roi, lens_maps=None):
+        self.roi = tuple(int(v) for v in roi)
+        self.lens_maps = lens_maps   # H -> mapas (distorção + H compostas); None = só homografia
+        self._H = None          # última H warpada (cópia)
+        self._maps = None       # mapas em ponto fixo dessa H
+        self.remaps = 0         # nº de warps servidos pela cache (diagnóstico)
+
+    def H_roi(self, H):
+        x0, y0 = self.roi[:2]
+        T = np.array([[1.0, 0.0, -x0], [0.0, 1.0, -y0], [0.0, 0.0, 1.0]])
+        return T @ np.asarray(H, np.float64)
+
+    def warp(self, current_img, H):
+        w, h = self.roi[2:]
+        same = self._H is not None and np.array_equal(self._H, H)
+        if self.lens_maps is not None:
+            # com distorção não há warpPerspective equivalente: mapa composto logo à 1ª
+            if not same or self._maps is None:
+                sp = PROFILER.start("align.remap_build")
+                self._H = np.array(H, np.float64, copy=True)
+                self._maps = self.lens_maps(H)
+                sp.stop()
+            else:
+                self.remaps += 1
+            sp = PROFILER.start("align.warp")
+            out = cv2.remap(current_img, self._maps[0], self._maps[1], cv2.INTER_LINEAR)
+            sp.stop()
+            return out
+        if same and self._maps is None:
+            sp = PROFILER.start("align.remap_build")
+            self._maps = _fixed_point_maps(self.H_roi(H), (w, h))
+            sp.stop()
+        if same:
+            sp = PROFILER.start("align.warp")
+            out = cv2.remap(current_img, self._maps[0], self._maps[1], cv2.INTER_LINEAR)
+            sp.stop()
+            self.remaps += 1
+            return out
+        self._H = np.array(H, np.float64, copy=True)
+        self._maps = None
+        sp = PROFILER.start("align.warp")
+        out = cv2.warpPerspective(current_img, self.H_roi(H), (w, h))
+        sp.stop()
+        return out
+
+
+# ---------------------------
+# Alinhamento rígido / de semelhança por correlação de fase (backend "phase")
+# ---------------------------
+# A folha pára contra as guias: o movimento real é uma translação pequena e
+# uma rotação ligeira, não uma homografia de 8 graus de liberdade.
+# Fourier-Mellin a phase_scale (1/8): o módulo do espectro não depende da
+# translação e roda com a imagem (e escala ao contrário dela); em coordenadas
+# log-polares rotação e escala passam a translações, medidas com um
+# phaseCorrelate. O módulo é simétrico por 180°, por isso só se usa meio plano
+# (ângulos em ]-90°, 90°]). Roda-se o frame pelo ângulo encontrado e um segundo
+# phaseCorrelate dá a translação.
+# Refinamento no 2.º nível da pirâmide (phase_refine_scale, 1/4): o frame é
+# warpado com a estimativa e cada quadrante 2x2 comparado com o template, como
+# no verify; os 4 resíduos, nos centros dos quadrantes, dão a correção rígida
+# (ou de semelhança) por mínimos quadrados. confidence = resposta mínima dos
+# quadrantes: abaixo de phase_min_confidence (ou se o verify falhar) o
+# align_verified passa ao ORB. Só FFTs e warps, sem keypoints nem RANSAC: o
+# resultado é determinístico.
+# Com lente calibrada a estimativa grosseira é feita nos pixels com distorção
+# (a mesma lente afeta template e frame) e o refinamento já usa os mapas de
+# distorção + H, por isso a H final liga pixels sem distorção, como as outras.
+# Config: "phase_model" ("rigid" | "similarity"), "phase_scale" (0.125),
+# "phase_refine_scale" (0.25), "phase_radii"/"phase_angles" (256/360: amostras
+# log-polares em raio e por 180°), "phase_rotation_iters" (2),
+# "phase_refine_iters" (2), "phase_max_angle" (15°), "phase_min_confidence" (0.1).
+
+def _highpass(shape):
+    """Passa-alto (1 - X)(2 - X), X = cos(πξ)·cos(πη), para o espectro centrado (fftshift)."""
+    h, w = shape
+    fy = np.cos(np.pi * (np.arange(h) - h // 2) / h)
+    fx = np.cos(np.pi * (np.arange(w) - w // 2) / w)
+    X = fy[:, None] * fx[None, :]
+    return ((1.0 - X) * (2.0 - X)).astype(np.float32)
+
+
+def _logpolar_spectrum(gray, window, highpass, size):
+    """Meio plano (0-180°) do módulo do espectro filtrado, em log-polar: (ângulos, raios) = size[::-1]."""
+    spec = np.abs(np.fft.fftshift(np.fft.fft2(gray * window))).astype(np.float32) * highpass
+    h, w = gray.shape
+    lp = cv2.warpPolar(spec, size, (w // 2, h // 2), min(h, w) / 2.0,
+                       cv2.WARP_POLAR_LOG + cv2.INTER_LINEAR)
+    return lp[:size[1] // 2]
+
+
+def _fit_similarity(src, dst, with_scale=False):
+    """
+    Rotação (+ escala) e translação src -> dst (N, 2) por mínimos quadrados, em 3x3.
+    Em complexos: dst - μd ≈ c·(src - μs); c = Σ conj(a)·b / Σ|a|² (sem escala, só o argumento).
+    """
+    src, dst = np.asarray(src, np.float64), np.asarray(dst, np.float64)
+    mu_s, mu_d = src.mean(0), dst.mean(0)
+    a = (src[:, 0] - mu_s[0]) + 1j * (src[:, 1] - mu_s[1])
+    b = (dst[:, 0] - mu_d[0]) + 1j * (dst[:, 1] - mu_d[1])
+    z = np.sum(np.conj(a) * b)
+    c = z / np.sum(np.abs(a) ** 2) if with_scale else z / max(abs(z), 1e-12)
+    R = np.array([[c.real, -c.imag], [c.imag, c.real]])
+    H = np.eye(3)
+    H[:2, :2] = R
+    H[:2, 2] = mu_d - R @ mu_s
+    return H
+
+
+def _rescale(scale):
+    """Redução 1x -> scale com centros de pixel (x' = s·(x + ½) - ½), em 3x3."""
+    off = 0.5 * scale - 0.5
+    return np.array([[scale, 0.0, off], [0.0, scale, off], [0.0, 0.0, 1.0]])
+
+
+# ---------------------------
+# AlignmentEngine (template fixo: features, matcher e config em cache)
+# ---------------------------
+# As features ORB do template (pontos na escala reduzida + descritores) são
+# calculadas uma vez e guardadas ao lado do template em
+# <template>.orb_<hash>.npz; o hash cobre o conteúdo do template, a escala e os
+# parâmetros do ORB, por isso um template editado (ou outro ORB) gera um
+# ficheiro novo em vez de reutilizar features antigas. A config só é relida
+# quando o mtime do ficheiro muda. O resultado é igual ao de
+# align_with_template (mesmo ORB, mesmos pontos float32).
+#
+# align_verified(): antes do ORB tenta as homografias recentes (cache LRU).
+# Cada candidata é verificada a baixa resolução (verify_scale): o frame é
+# warpado com a H reescalada e cada quadrante 2x2 é comparado com o template
+# por correlação de fase. Um resíduo de translação num quadrante apanha
+# deslocamentos; quadrantes com resíduos diferentes apanham rotação/escala.
+# Aceita se max(resíduo) <= verify_max_shift_px (px da resolução total) e a
+# resposta mínima >= verify_min_response; senão alinhamento completo.
+#
+# backend "corners" (config "backend"): entre a cache e o ORB, H pelos 4
+# cantos da folha (models.detect_sheet_margins.sheet_corners: quad a 1/8 +
+# rectas subpíxel nos bordos), verificada como as da cache. Escala para ORB
+# se o quad não for fiável ou a verificação falhar (p.ex. impressão desviada
+# em relação ao bordo da folha).
+#
+# backend "phase": em vez dos cantos, H rígida (ou de semelhança com
+# phase_model "similarity") por correlação de fase log-polar + refinamento
+# por quadrantes (secção acima), verificada da mesma forma.
+
+
+def _quadrants(shape):
+    """Slices dos 4 quadrantes (2x2) de uma imagem com esta forma."""
+    h, w = shape[:2]
+    return [(slice(y0, y1), slice(x0, x1))
+            for y0, y1 in ((0, h // 2), (h // 2, 2 * (h // 2)))
+            for x0, x1 in ((0, w // 2), (w // 2, 2 * (w // 2)))]
+
+
+def _orb_signature(detector):
+    return (detector.getMaxFeatures(), detector.getScaleFactor(), detector.getNLevels(),
+            detector.getEdgeThreshold(), detector.getFirstLevel(), detector.getWTA_K(),
+            int(detector.getScoreType()), detector.getPatchSize(), detector.getFastThreshold())
+
+
+class AlignmentEngine:
+    """Alinhamento ORB + homografia contra um template fixo, com as features do template em cache."""
+
+    def __init__(self, template_img, config_path="config/config_alignment.json", resize_scale=0.5,
+                 template_path=None, detector=None, lens=None, mask=None):
+        self.template_img = template_img
+        self.template_shape = template_img.shape
+        self.config_path = config_path
+        self.resize_scale = float(resize_scale)
+        self.orb = detector if detector is not None else orb
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self._config = None
+        self._config_mtime = None
+        self.recent_H = deque(maxlen=max(1, int(self.config.get("homography_cache_size", 4))))
+        self._verify_ref = {}    # verify_scale -> (tamanho reduzido, quadrantes do template, janelas de Hanning)
+        self._phase_ref = {}     # (phase_scale, raios, ângulos) -> template reduzido, janela, passa-alto, log-polar
+        self.template_path = template_path
+        self._detectors = {}          # (nfeatures, slot) -> ORB com os restantes parâmetros de self.orb
+        self._knn_matchers = {}       # "knn"/"flann" -> matcher com os descritores do template
+        self.last_match_info = None   # {"matcher", "keypoints", "matches", "inliers", "reproj_rms_px"}
+        self.last_report = None       # alignment_report do último align()
+        self.roi_warper = None        # set_roi(): warp só da ROI (com remap em cache)
+        # lente calibrada (models.lens_calibration.LensModel): H entre pixels sem distorção
+        h, w = self.template_shape[:2]
+        self.lens = lens.for_size((w, h)) if lens is not None else None
+        self._lens_grids = {}         # (origem, tamanho, escala, passo) -> amostras do template sem distorção
+        self._tpl_pts_full = None
+        # máscara da folha no template (1x): restringe os keypoints ("feature_mask" na config)
+        self.feature_mask = None if mask is None else (np.asarray(mask) > 0).astype(np.uint8) * 255
+        self._small_masks = {}        # (margem, forma) -> máscara à escala do ORB
+        self.stable_info = None       # {"path", "kept", "total"} do conjunto estável em uso
+        self._refresh_template_features()
+
+    def _refresh_template_features(self):
+        """(Re)carrega as features do template se a extração ou o conjunto estável da config mudou."""
+        params = self._feature_params()
+        stable = bool(self.config.get("stable_keypoints", False))
+        if getattr(self, "_tpl_params", None) == params and getattr(self, "_tpl_stable", None) == stable:
+            return
+        self._tpl_params, self._tpl_stable = params, stable
+        self.template_hash = self._template_hash(self.template_img, params)
+        self.cache_path = None
+        if self.template_path:
+            stem = os.path.splitext(self.template_path)[0]
+            self.cache_path = f"{stem}.orb_{self.template_hash[:16]}.npz"
+        self.tpl_pts, self.tpl_desc = self._load_or_compute(self.template_img)
+        self.stable_info = None
+        if stable:
+            self._apply_stable_keypoints()
+        self._tpl_pts_full = None
+        self._knn_matchers.clear()
+
+    def stable_keypoints_path(self):
+        """<template>.stable_<hash>.npz: conjunto estável para estas features (None sem template_path)."""
+        if not self.template_path:
+            return None
+        return f"{os.path.splitext(self.template_path)[0]}.stable_{self.template_hash[:16]}.npz"
+
+    def _apply_stable_keypoints(self):
+        """Reduz as features do template ao conjunto estável gravado (models.stable_keypoints)."""
+        path = self.stable_keypoints_path()
+        if path is None or not os.path.exists(path):
+            print("⚠️ stable_keypoints ativo mas sem conjunto estável para este template/config; "
+                  "a usar todas as features (python -m models.stable_keypoints)")
+            return
+        try:
+            with np.load(path) as data:
+                if str(data["hash"]) != self.template_hash:
+                    raise ValueError("hash diferente do template")
+                idx = data["indices"].astype(np.int64)
+        except Exception as e:
+            print("⚠️ Conjunto estável inválido, a usar todas as features:", e)
+            return
+        if len(idx) < 4 or idx.max() >= len(self.tpl_pts):
+            print("⚠️ Conjunto estável incompatível com as features do template, ignorado.")
+            return
+        self.stable_info = {"path": path, "kept": int(len(idx)), "total": int(len(self.tpl_pts))}
+        self.tpl_pts, self.tpl_desc = self.tpl_pts[idx], self.tpl_desc[idx]
+
+    def _template_points(self):
+        """Pontos ORB do template na resolução original (sem distorção, com lente)."""
+        if self._tpl_pts_full is None:
+            pts = self.tpl_pts / self.resize_scale
+            if self.lens is not None:
+                pts = self.lens.undistort_points(pts).astype(np.float32)
+            self._tpl_pts_full = pts
+        return self._tpl_pts_full
+
+    def _template_hash(self, template_img, params=(None, 1, None)):
+        h = hashlib.blake2b(digest_size=20)
+        key = (template_img.shape, str(template_img.dtype), self.resize_scale, _orb_signature(self.orb))
+        bucket, tiles, margin = params
+        # com a extração por omissão o hash fica igual ao das caches já existentes
+        if bucket is not None:
+            key += (bucket,)
+        if tiles > 1 or margin is not None:
+            key += (("tiles", tiles), ("mask_margin", margin))
+        h.update(repr(key).encode())
+        h.update(np.ascontiguousarray(template_img).data)
+        if margin is not None:
+            h.update(np.ascontiguousarray(self.feature_mask).data)
+        return h.hexdigest()
+
+    def _feature_params(self):
+        """(bucketing ou None, nº de faixas, margem da máscara em px a 1x ou None): definem as features."""
+        cfg = self.config
+        tiles = max(1, int(cfg.get("feature_tiles", 1)))
+        margin = None
+        if self.feature_mask is not None and cfg.get("feature_mask", False):
+            margin = max(0, int(cfg.get("feature_mask_margin", 64)))
+        return self._bucket_params(), tiles, margin
+
+    def _bucket_params(self):
+        """(colunas, linhas, máx. por célula, candidatos) ou None sem "bucket_grid" na config."""
+        cfg = self.config
+        grid = cfg.get("bucket_grid")
+        if not grid:
+            return None
+        return (int(grid[0]), int(grid[1]), int(cfg.get("bucket_max_per_cell", 32)),
+                int(cfg.get("bucket_candidates", 4 * self.orb.getMaxFeatures())))
+
+    def _detector(self, nfeatures, slot=0):
+        """ORB com os parâmetros de self.orb (escalas, patch, limiar FAST) e outro nº de pontos (um por slot)."""
+        nfeatures = int(nfeatures)
+        if nfeatures == self.orb.getMaxFeatures() and slot == 0:
+            return self.orb
+        detector = self._detectors.get((nfeatures, slot))
+        if detector is None:
+            detector = cv2.ORB_create(nfeatures, *_orb_signature(self.orb)[1:])
+            self._detectors[(nfeatures, slot)] = detector
+        return detector
+
+    def _small_mask(self, margin, shape, frame):
+        """
+        Máscara da folha à escala do ORB: a do template; para o frame, dilatada por
+        margin px (a 1x) para cobrir o deslocamento da folha entre capturas.
+        """
+        key = (margin if frame else None, shape)
+        small = self._small_masks.get(key)
+        if small is None:
+            small = cv2.resize(self.feature_mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+            r = int(round(margin * self.resize_scale)) if frame else 0
+            if r > 0:
+                small = cv2.dilate(small, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * r + 1, 2 * r + 1)))
+            self._small_masks[key] = small
+        return small
+
+    def _features(self, gray, params, frame=True):
+        """
+        Keypoints e descritores ORB de uma imagem reduzida segundo _feature_params():
+        máscara da folha, faixas em paralelo ("feature_tiles", pool de "feature_workers")
+        e bucketing. frame=False: o template (máscara sem margem).
+        """
+        bucket, tiles, margin = params
+        mask = self._small_mask(margin, gray.shape, frame) if margin is not None else None
+        total = bucket[3] if bucket is not None else self.orb.getMaxFeatures()
+        if tiles > 1:
+            workers = int(self.config.get("feature_workers", tiles))
+            pool = _tile_pool(workers) if workers > 1 else None
+            detectors = [self._detector(-(-total // tiles), slot) for slot in range(tiles)]
+            kpts, desc = _detect_tiled(detectors, gray, mask, pool)
+            if bucket is not None and desc is not None:
+                keep = _bucket_select(kpts, gray.shape, bucket[:2], bucket[2])
+                kpts, desc = [kpts[i] for i in keep], desc[keep]
+            return kpts, desc
+        if bucket is None:
+            return self.orb.detectAndCompute(gray, mask)
+        kpts = self._detector(total).detect(gray, mask)
+        keep = _bucket_select(kpts, gray.shape, bucket[:2], bucket[2])
+        return self.orb.compute(gray, [kpts[i] for i in keep])
+
+    def _knn_matcher(self, kind):
+        """Matcher knn treinado com os descritores do template (índice LSH construído 1x)."""
+        matcher = self._knn_matchers.get(kind)
+        if matcher is None:
+            if kind == "flann":
+                matcher = cv2.FlannBasedMatcher(_FLANN_LSH, dict(checks=50))
+            else:
+                matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+            matcher.add([self.tpl_desc])
+            matcher.train()
+            self._knn_matchers[kind] = matcher
+        return matcher
+
+    def _load_or_compute(self, template_img):
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with np.load(self.cache_path) as data:
+                    if str(data["hash"]) == self.template_hash:
+                        return data["pts"], data["desc"]
+            except Exception as e:
+                print("⚠️ Cache de features do template inválida, a recalcular:", e)
+
+        _prepare_alignment()
+        kpts, desc = self._features(_small_gray(template_img, self.resize_scale), self._tpl_params, frame=False)
+        if desc is None:
+            raise ValueError("Não foi possível extrair descritores ORB do template.")
+        pts = np.float32([kp.pt for kp in kpts])
+        if self.cache_path:
+            try:
+                np.savez(self.cache_path, hash=self.template_hash, pts=pts, desc=desc)
+            except OSError as e:
+                print("⚠️ Não foi possível guardar as features do template:", e)
+        return pts, desc
+
+    def _verify_reference(self, scale):
+        """Template reduzido a verify_scale, cortado em quadrantes (calculado 1x por escala)."""
+        ref = self._verify_ref.get(scale)
+        if ref is None:
+            small = _small_gray(self.template_img, scale).astype(np.float32)
+            quads = [small[q] for q in _quadrants(small.shape)]
+            windows = [cv2.createHanningWindow((q.shape[1], q.shape[0]), cv2.CV_32F) for q in quads]
+            ref = self._verify_ref[scale] = (small.shape, quads, windows)
+        return ref
+
+    @property
+    def config(self):
+        """Config de alinhamento, relida só quando o mtime do ficheiro muda."""
+        mtime = os.stat(self.config_path).st_mtime_ns
+        if self._config is None or mtime != self._config_mtime:
+            with open(self.config_path, "r") as f:
+                self._config = json.load(f)
+            self._config_mtime = mtime
+        return self._config
+
+    def verify(self, current_img, H, current_small=None):
+        """
+        Resíduo de H sobre current_img: {"ok", "shift_px" (máx. dos quadrantes, px da
+        resolução total), "response" (mín. dos quadrantes)}. current_small: current_img
+        já reduzido a verify_scale (em cinzento), para várias candidatas.
+        """
+        cfg = self.config
+        scale = float(cfg.get("verify_scale", 0.25))
+        shifts, responses = self._quadrant_shifts(current_img, H, scale, current_small)
+        shift, response = float(np.hypot(*shifts.T).max() / scale), float(responses.min())
+        ok = (shift <= float(cfg.get("verify_max_shift_px", 2.0))
+              and response >= float(cfg.get("verify_min_response", 0.05)))
+        return {"ok": ok, "shift_px": shift, "response": response}
+
+    def _quadrant_shifts(self, current_img, H, scale, current_small=None):
+        """
+        Frame warpado com H à escala scale e comparado com o template por quadrante:
+        (deslocamentos (4, 2) em px da escala reduzida, respostas (4,)).
+        """
+        (h_t, w_t), quads_t, windows = self._verify_reference(scale)
+        if current_small is None:
+            current_small = _small_gray(current_img, scale)
+        # H na resolução reduzida: T·H·T⁻¹, T = redução com centros de pixel
+        T = _rescale(scale)
+        H_small = T @ np.asarray(H, np.float64) @ np.linalg.inv(T)
+        if self.lens is None:
+            warped = cv2.warpPerspective(current_small, H_small, (w_t, h_t))
+        else:
+            warped = cv2.remap(current_small, *self._lens_maps(H, (0, 0), (w_t, h_t), scale), cv2.INTER_LINEAR)
+        warped = warped.astype(np.float32)
+        shifts, responses = [], []
+        for q, tq, win in zip(_quadrants((h_t, w_t)), quads_t, windows):
+            shift, resp = cv2.phaseCorrelate(tq, warped[q], win)
+            shifts.append(shift)
+            responses.append(resp)
+        return np.array(shifts, np.float64), np.array(responses, np.float64)
+
+    def align_verified(self, current_img):
+        """
+        Tenta as homografias recentes (verify); depois, com backend "corners", a H dos
+        4 cantos da folha, ou com backend "phase", a H rígida por correlação de fase
+        (ambas também verificadas); só corre o ORB se nada passar.
+        Devolve (aligned, H, info) com info = {"source": "cache"|"corners"|"phase"|"orb",
+        "backend", "tried", "shift_px", "response", "corners" (info de sheet_corners
+        ou None), "phase" (info de phase_homography ou None), "quality"
+        (alignment_report), "time_ms"}; shift_px/response = resíduo da última H verificada.
+        Não lança exceção se o ORB falhar: aligned/H = None e quality["ok"] = False. Só
+        as H com quality["ok"] entram na cache.
+        """
+        start_time = time.perf_counter()
+        cfg = self.config
+        backend = str(cfg.get("backend", "orb")).lower()
+        info = {"source": "orb", "backend": backend, "tried": 0, "shift_px": None, "response": None,
+                "corners": None, "phase": None, "quality": None, "time_ms": 0.0}
+
+        def _done(aligned, H, source, report):
+            info["source"] = source
+            info["time_ms"] = report["time_ms"] = (time.perf_counter() - start_time) * 1000.0
+            info["quality"] = report
+            if report["ok"]:
+                self._remember(H)
+            return aligned, H, info
+
+        def _report(H, source, **stats):
+            return alignment_report(H, current_img.shape, cfg, source, shift_px=info["shift_px"],
+                                    response=info["response"], **stats)
+
+        current_small = None
+        if self.recent_H:
+            sp = PROFILER.start("align.verify")
+            current_small = _small_gray(current_img, float(cfg.get("verify_scale", 0.25)))
+            for i, H in enumerate(list(self.recent_H)):
+                res = self.verify(current_img, H, current_small)
+                info.update(tried=i + 1, shift_px=res["shift_px"], response=res["response"])
+                if res["ok"]:
+                    sp.stop()
+                    return _done(self._warp(current_img, H), H, "cache", _report(H, "cache"))
+            sp.stop()
+
+        if backend in ("corners", "phase"):
+            sp = PROFILER.start("align." + backend)
+            if backend == "corners":
+                H, backend_info = self.corners_homography(current_img)
+            else:
+                H, backend_info = self.phase_homography(current_img)
+            info[backend] = backend_info
+            report = None
+            if H is not None:
+                res = self.verify(current_img, H, current_small)
+                info.update(shift_px=res["shift_px"], response=res["response"])
+                backend_info["verified"] = res["ok"]
+                if res["ok"]:
+                    report = _report(H, backend)
+                    backend_info["quality_ok"] = report["ok"]
+            sp.stop()
+            if report is not None and report["ok"]:
+                return _done(self._warp(current_img, H), H, backend, report)
+
+        try:
+            aligned, H = self.align(current_img)
+        except (ValueError, cv2.error) as e:
+            return _done(None, None, "orb", alignment_report(None, current_img.shape, cfg, "orb", error=str(e)))
+        report = self.last_report
+        if bool(cfg.get("quality_verify_orb", False)):
+            # resíduo independente do estimador (correlação de fase) como critério extra
+            res = self.verify(current_img, H, current_small)
+            info.update(shift_px=res["shift_px"], response=res["response"])
+            report.update(shift_px=res["shift_px"], response=res["response"])
+            if not res["ok"]:
+                report["reasons"].append(f"verify: resíduo {res['shift_px']:.2f} px, resposta {res['response']:.3f}")
+                report["ok"] = False
+        return _done(aligned, H, "orb", report)
+
+    def template_corners(self):
+        """Cantos da folha no template (1x); None se o template não tiver um quad fiável."""
+        if not hasattr(self, "_template_corners"):
+            corners, corner_info = sheet_corners(self.template_img, **self._corner_params())
+            if corners is None:
+                print(f"⚠️ Cantos da folha não encontrados no template ({corner_info['reason']}): backend corners inativo")
+            self._template_corners = corners
+        return self._template_corners
+
+    def _corner_params(self):
+        cfg = self.config
+        return {"scale": float(cfg.get("corners_scale", 0.125)),
+                "max_angle_dev": float(cfg.get("corners_max_angle_dev", 20.0)),
+                "max_line_rms": float(cfg.get("corners_max_line_rms", 1.5))}
+
+    def corners_homography(self, current_img):
+        """H current -> template pelos 4 cantos da folha: (H ou None, info de sheet_corners)."""
+        tpl_corners = self.template_corners()
+        if tpl_corners is None:
+            return None, {"ok": False, "reason": "template sem cantos"}
+        corners, corner_info = sheet_corners(current_img, **self._corner_params())
+        if corners is None:
+            return None, corner_info
+        if self.lens is not None:
+            corners, tpl_corners = self.lens.undistort_points(corners), self.lens.undistort_points(tpl_corners)
+        H = cv2.getPerspectiveTransform(corners.astype(np.float32), tpl_corners.astype(np.float32))
+        return H, corner_info
+
+    def _phase_reference(self, scale, size):
+        """Template reduzido a phase_scale com janela, passa-alto e espectro log-polar (1x por escala)."""
+        key = (scale, size)
+        ref = self._phase_ref.get(key)
+        if ref is None:
+            small = _small_gray(self.template_img, scale).astype(np.float32)
+            window = cv2.createHanningWindow((small.shape[1], small.shape[0]), cv2.CV_32F)
+            highpass = _highpass(small.shape)
+            ref = self._phase_ref[key] = (small, window, highpass,
+                                          _logpolar_spectrum(small, window, highpass, size))
+        return ref
+
+    def phase_homography(self, current_img):
+        """
+        H current -> template rígida (phase_model "rigid") ou de semelhança ("similarity")
+        por correlação de fase: (H ou None, info) com info = {"ok", "confidence",
+        "angle_deg", "scale", "shift_px" (translação a 1x), "responses" {"rotation",
+        "translation", "refine"}, "reason"}.
+        """
+        cfg = self.config
+        scale = float(cfg.get("phase_scale", 0.125))
+        refine_scale = float(cfg.get("phase_refine_scale", 0.25))
+        with_scale = str(cfg.get("phase_model", "rigid")).lower() == "similarity"
+        size = (int(cfg.get("phase_radii", 256)), 2 * int(cfg.get("phase_angles", 360)))
+        info = {"ok": False, "confidence": 0.0, "angle_deg": None, "scale": None, "shift_px": None,
+                "responses": {}, "reason": ""}
+
+        tpl, window, highpass, lp_t = self._phase_reference(scale, size)
+        h, w = tpl.shape
+        cur = _small_gray(current_img, scale)
+        if cur.shape != tpl.shape:    # frame com outro tamanho: corta/completa ao do template
+            cur = cv2.warpAffine(cur, np.float64([[1, 0, 0], [0, 1, 0]]), (w, h))
+        cur = cur.astype(np.float32)
+
+        # rotação (+ escala) pelo módulo do espectro em log-polar; o pico sai puxado
+        # para 0 (bordos e janela não rodam), por isso mede-se outra vez o resíduo
+        # no frame já rodado
+        center = ((w - 1) / 2.0, (h - 1) / 2.0)
+        angle, s, rotated = 0.0, 1.0, cur
+        for _ in range(max(1, int(cfg.get("phase_rotation_iters", 2)))):
+            (d_rho, d_theta), resp_rot = cv2.phaseCorrelate(
+                lp_t, _logpolar_spectrum(rotated, window, highpass, size))
+            angle += d_theta * 360.0 / size[1]
+            if with_scale:
+                s *= float(np.exp(d_rho * np.log(min(h, w) / 2.0) / size[0]))
+            M = cv2.getRotationMatrix2D(center, angle, s)
+            rotated = cv2.warpAffine(cur, M, (w, h))
+        info["responses"]["rotation"] = float(resp_rot)
+        max_angle = float(cfg.get("phase_max_angle", 15.0))
+        if abs(angle) > max_angle:
+            info.update(angle_deg=float(angle), reason=f"rotação {angle:.1f}° > {max_angle:.1f}°")
+            return None, info
+
+        # translação do frame já rodado
+        (dx, dy), resp_shift = cv2.phaseCorrelate(tpl, rotated, window)
+        info["responses"]["translation"] = float(resp_shift)
+        A = np.vstack([M, [0.0, 0.0, 1.0]])
+        A[:2, 2] -= (dx, dy)
+        T = _rescale(scale)
+        H0 = np.linalg.inv(T) @ A @ T
+
+        # 2.º nível: resíduo por quadrante -> correção rígida / de semelhança
+        h_r, w_r = self._verify_reference(refine_scale)[0]
+        centers = np.array([((q[1].start + q[1].stop - 1) / 2.0, (q[0].start + q[0].stop - 1) / 2.0)
+                            for q in _quadrants((h_r, w_r))])
+        centers = (centers + 0.5) / refine_scale - 0.5
+        refine_small = _small_gray(current_img, refine_scale)
+        H = H0
+        for _ in range(max(1, int(cfg.get("phase_refine_iters", 2)))):
+            shifts, responses = self._quadrant_shifts(current_img, H, refine_scale, refine_small)
+            H = _fit_similarity(centers + shifts / refine_scale, centers, with_scale) @ H
+
+        confidence = float(responses.min())
+        info["responses"]["refine"] = confidence
+        info.update(confidence=confidence,
+                    angle_deg=float(np.degrees(np.arctan2(H[1, 0], H[0, 0]))),
+                    scale=float(np.hypot(H[0, 0], H[1, 0])),
+                    shift_px=(float(H[0, 2]), float(H[1, 2])))
+        min_confidence = float(cfg.get("phase_min_confidence", 0.1))
+        if confidence < min_confidence:
+            info["reason"] = f"confiança {confidence:.3f} < {min_confidence:.3f}"
+            return None, info
+        info["ok"] = True
+        return H, info
+
+    def set_roi(self, roi):
+        """
+        Limita o warp a roi = (x, y, w, h) no espaço do template: align/align_verified devolvem
+        então só essa janela (w x h). None volta ao frame inteiro.
+        """
+        if roi is None:
+            self.roi_warper = None
+            return
+        lens_maps = None
+        if self.lens is not None:
+            origin, size = tuple(int(v) for v in roi[:2]), tuple(int(v) for v in roi[2:])
+            lens_maps = lambda H: self._lens_maps(H, origin, size)   # noqa: E731
+        self.roi_warper = RoiWarper(roi, lens_maps)
+
+    def _warp(self, current_img, H):
+        if self.roi_warper is None:
+            return self.warp_full(current_img, H)
+        return self.roi_warper.warp(current_img, H)
+
+    def warp_full(self, current_img, H):
+        """Frame inteiro no espaço do template (sem cache; para visualização)."""
+        if self.lens is None:
+            return _warp_to_template(current_img, H, self.template_shape)
+        h, w = self.template_shape[:2]
+        maps = self._lens_maps(H, (0, 0), (w, h))
+        sp = PROFILER.start("align.warp")
+        aligned = cv2.remap(current_img, maps[0], maps[1], cv2.INTER_LINEAR)
+        sp.stop()
+        return aligned
+
+    # ---- lente: distorção + H num só mapa ----
+    # Um pixel t do template (com distorção) vem do pixel do frame
+    #   c = distort(H⁻¹ · undistort(t))
+    # (a H liga pixels sem distorção). A composição é suave, por isso calcula-se
+    # exatamente numa grelha de lens_map_step px (8 por omissão; erro < 0.01 px)
+    # e interpola-se bilinearmente para o mapa inteiro; undistort(t) da grelha
+    # só depende do template e fica em cache. Por folha: H⁻¹ + distorção sobre
+    # ~1/64 dos pixels, resize dos mapas e um único remap.
+
+    def _lens_maps(self, H, origin, size, scale=1.0):
+        """Mapas de remap frame -> template (janela origin/size, à escala scale) com distorção e H."""
+        step = max(1, int(self.config.get("lens_map_step", 8)))
+        key = (origin, size, scale, step)
+        grid = self._lens_grids.get(key)
+        if grid is None:
+            gx, gy = _sample_grid(size, step)
+            # amostras da saída -> pixels do template a 1x (centros de pixel) -> sem distorção
+            tx = (gx + 0.5) / scale - 0.5 + origin[0]
+            ty = (gy + 0.5) / scale - 0.5 + origin[1]
+            grid = self._lens_grids[key] = (gx.shape, self.lens.undistort_points(np.stack([tx, ty], -1)))
+        shape, tpl_undist = grid
+        src = cv2.perspectiveTransform(tpl_undist.reshape(-1, 1, 2), np.linalg.inv(np.asarray(H, np.float64)))
+        src = self.lens.distort_points(src)
+        src = scale * (src + 0.5) - 0.5
+        return _maps_from_samples(src[:, 0].reshape(shape), src[:, 1].reshape(shape), size, step)
+
+    def template_to_current(self, H):
+        """
+        Mapeamento template -> frame para reprojetar desenhos: a matriz H⁻¹ sem lente,
+        ou uma função (N, 2) -> (N, 2) com a distorção (aceite pelo DefectTable).
+        """
+        H_inv = np.linalg.inv(np.asarray(H, np.float64))
+        if self.lens is None:
+            return H_inv
+        lens = self.lens
+
+        def _map(pts):
+            pts = lens.undistort_points(pts)
+            return lens.distort_points(cv2.perspectiveTransform(pts.reshape(-1, 1, 2), H_inv))
+        return _map
+
+    def _remember(self, H):
+        """Coloca H à frente da cache (sem duplicados)."""
+        for i, old in enumerate(self.recent_H):
+            if old is H or np.array_equal(old, H):
+                del self.recent_H[i]
+                break
+        self.recent_H.appendleft(H)
+
+    def align(self, current_img):
+        """Como align_with_template(current_img, template): devolve (aligned, H)."""
+        start_time = time.perf_counter()
+        _prepare_alignment()
+        cfg = self.config
+        self._refresh_template_features()
+        matcher = str(cfg.get("matcher", "bf")).lower()
+
+        sp = PROFILER.start("align.resize")
+        current_gray = _small_gray(current_img, self.resize_scale)
+        sp.stop()
+
+        sp = PROFILER.start("align.orb")
+        kpts2, desc2 = self._features(current_gray, self._tpl_params)
+        sp.stop()
+        if desc2 is None:
+            raise ValueError("Não foi possível extrair descritores ORB.")
+
+        sp = PROFILER.start("align.match")
+        if matcher == "bf":
+            matches = self.matcher.match(self.tpl_desc, desc2)
+            if not matches:
+                sp.stop()
+                raise ValueError("Nenhum match encontrado.")
+            dist = np.array([m.distance for m in matches], np.float32)
+            good = np.argsort(dist, kind="stable")[:max(4, int(len(matches) * cfg.get("good_match_percent", 0.2)))]
+            tpl_idx = np.array([m.queryIdx for m in matches], np.int64)[good]
+            cur_idx = np.array([m.trainIdx for m in matches], np.int64)[good]
+        elif matcher in ("knn", "flann"):
+            knn = self._knn_matcher(matcher).knnMatch(desc2, k=2)
+            cur_idx, tpl_idx, _ = _ratio_matches(knn, float(cfg.get("ratio_test", 0.8)))
+        else:
+            sp.stop()
+            raise ValueError(f"Matcher desconhecido: {matcher} (bf, knn ou flann)")
+        sp.stop()
+        if len(tpl_idx) < 4:
+            raise ValueError("Matches insuficientes para homografia.")
+
+        # pontos na resolução original (ordem por distância: o PROSAC usa-a)
+        pts_tpl = self._template_points()[tpl_idx].reshape(-1, 1, 2)
+        pts_cur = np.float32([kpts2[i].pt for i in cur_idx]) / self.resize_scale
+        if self.lens is not None:
+            pts_cur = self.lens.undistort_points(pts_cur).astype(np.float32)
+        pts_cur = pts_cur.reshape(-1, 1, 2)
+        H, inliers = _estimate_transform(pts_cur, pts_tpl, cfg)
+        self.last_match_info = {
+            "matcher": matcher, "keypoints": len(kpts2), "matches": int(len(tpl_idx)),
+            "inliers": int(inliers.sum()), "reproj_rms_px": _reproj_rms(H, pts_cur, pts_tpl, inliers),
+        }
+        aligned = self._warp(current_img, H)
+
+        elapsed = time.perf_counter() - start_time
+        m = self.last_match_info
+        self.last_report = alignment_report(H, current_img.shape, cfg, "orb", matches=m["matches"],
+                                            inliers=m["inliers"], reproj_rms_px=m["reproj_rms_px"],
+                                            time_ms=elapsed * 1000.0)
+        print(f"Align Image (engine) demorou {elapsed:.4f} segundos")
+        return aligned, H
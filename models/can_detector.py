@@ -0,0 +1,495 @@
+import inspect
+import time
+
+import cv2
+import numpy as np
+
+from models import defect_detector as dd
+from models.defect_detector import (
+    LEGACY_OUTPUTS, TemplateModel, detect_defects_with_model,
+    _apply_morphological_ops, _classic_combined, _color_delta_raw, _color_masks, _dark_mask,
+    _filter_contours, _hat_diff, _morph_ops_reach, _ms_ssim_map, _norm01_range,
+    _full_stage_graph, _odd_at_least_1, _overexposed_mask, _resolve_stages, _run_strips, _thin_edges_inv, _threshold_bin, _tile_pool,
+)
+from models.percentile_hist import RoiPercentileEngine
+
+# ---------------------------
+# Deteção por lata (recortes por bbox de lata em vez da folha inteira)
+# ---------------------------
+# Cada lata tem um TemplateModel próprio do recorte da sua bbox (+ margem),
+# com a máscara = polígono da lata ∩ máscara da folha. As fases seguem o
+# modo Full do detect_defects_with_model, mas sobre os recortes:
+#   1) por lata: mapas clássicos (darker/cores + morfologia) -> veredito barato
+#   2) por lata: mapas caros (top/black-hat, Δa/Δb, MS-SSIM) só nas latas por decidir
+#   3) global: min/max e percentis da FOLHA (sheet_thresholds), ou agregados
+#      sobre todas as latas quando não são dados
+#   4) por lata: binarização, fusão, máscara final e contornos
+# verdict_only=True: uma lata já rejeitada em 1) não corre 4) (nem 2), com os
+# limiares da folha dados). Os limiares nunca dependem de que latas saíram
+# cedo: o veredicto de uma lata é o mesmo com ou sem verdict_only e em
+# qualquer ordem.
+#
+# sheet_thresholds: população dos percentis = amostra fixa de tiles da ROI da
+# folha (1 em cada sample_stride da grelha, sempre os mesmos) a resolução
+# total, com os mesmos mapas do modo Full. Aproxima os limiares do modo Full
+# (percentil sobre a ROI inteira) sem calcular os mapas caros na folha toda,
+# e é o que os modos per_can e coarse usam. Sem píxeis de ROI na amostra (p.ex.
+# roi_erode_px grande) usa todos os tiles; sem nenhum, ValueError.
+# Com max_reuse > 0 os limiares ficam em cache no TemplateModel (chave =
+# parâmetros do detetor + amostra) e servem as folhas seguintes enquanto a
+# exposição (média BGR da folha na máscara) não se afastar mais de max_drift
+# níveis da folha em que foram calculados: a amostra a resolução total corre
+# 1x em cada max_reuse folhas, não em todas.
+#
+# Diferenças face ao modo folha:
+#   - os pixels entre latas (fora dos polígonos) não são processados;
+#   - Canny e escalas grosseiras do MS-SSIM são calculados no recorte (a margem
+#     cobre o alcance dos filtros, mas a histerese do Canny é só local);
+#   - min/max e percentis vêm da amostra da folha, não da ROI inteira.
+# O modo Simple não tem fase barata: corre detect_defects_with_model por lata.
+
+
+class CanRegion:
+    """Uma lata: número, bbox (núcleo) e janela com margem em coords da ROI, e o TemplateModel do recorte."""
+
+    def __init__(self, numero_lata, core, window, model):
+        self.numero_lata = numero_lata
+        self.core = core        # (x0, y0, x1, y1)
+        self.window = window    # (x0, y0, x1, y1), núcleo + margem
+        self.model = model
+
+    def core_slices(self):
+        """(linhas, colunas) do núcleo dentro do recorte da janela."""
+        x0, y0, x1, y1 = self.core
+        wx0, wy0 = self.window[:2]
+        return slice(y0 - wy0, y1 - wy0), slice(x0 - wx0, x1 - wx0)
+
+    def population_roi(self, roi_erode_px):
+        """ROI seguro limitado ao núcleo: população dos percentis (as margens sobrepõem-se entre regiões)."""
+        def _roi():
+            safe_roi = self.model.safe_roi(roi_erode_px)
+            roi = np.zeros_like(safe_roi)
+            rows, cols = self.core_slices()
+            roi[rows, cols] = safe_roi[rows, cols]
+            return roi
+        return self.model._cached(("population_roi", int(roi_erode_px)), _roi)
+
+    def percentile_engine(self, roi_erode_px, bins=4096):
+        return self.model._cached(("population_engine", int(roi_erode_px), int(bins)), lambda: RoiPercentileEngine(
+            self.population_roi(roi_erode_px), bins=bins))
+
+
+def tile_regions(model, tile_size, pad):
+    """CanRegion por tile de uma grelha fixa (cache no TemplateModel); tiles fora da máscara ficam de fora."""
+    def _build():
+        H, W = model.shape
+        layout = []
+        for ty, y0 in enumerate(range(0, H, tile_size)):
+            for tx, x0 in enumerate(range(0, W, tile_size)):
+                x1, y1 = min(W, x0 + tile_size) - 1, min(H, y0 + tile_size) - 1
+                layout.append({"numero_lata": (ty, tx), "points": [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]})
+        return build_can_regions(model, layout, pad=pad, polygon_mask=False)
+    return model._cached(("tile_regions", int(tile_size), int(pad)), _build)
+
+
+def build_can_regions(model, layout, origin=(0, 0), pad=20, polygon_mask=True):
+    """
+    Cria as CanRegion a partir do TemplateModel da folha (ROI) e do layout
+    (models.can_layout.load_can_layout, coords do template). origin: canto
+    (x, y) da ROI no template. Latas fora da ROI/máscara são ignoradas.
+    polygon_mask=False mantém a máscara da folha em toda a janela (regiões
+    artificiais, p.ex. tiles, sem erosão/anel de borda na fronteira do núcleo).
+    """
+    H, W = model.shape
+    ox, oy = origin
+    pad = max(0, int(pad))
+    regions = []
+    for can in layout:
+        pts = np.round(np.asarray(can["points"], np.float64) - (ox, oy)).astype(np.int32)
+        x, y, w, h = cv2.boundingRect(pts)
+        cx0, cy0 = max(0, x), max(0, y)
+        cx1, cy1 = min(W, x + w), min(H, y + h)
+        if cx1 <= cx0 or cy1 <= cy0:
+            continue
+        wx0, wy0 = max(0, cx0 - pad), max(0, cy0 - pad)
+        wx1, wy1 = min(W, cx1 + pad), min(H, cy1 + pad)
+
+        can_mask = model.mask_bin[wy0:wy1, wx0:wx1]
+        if polygon_mask:
+            poly = np.zeros_like(can_mask)
+            cv2.fillPoly(poly, [pts - (wx0, wy0)], 255)
+            can_mask = cv2.bitwise_and(poly, can_mask)
+        if cv2.countNonZero(can_mask[cy0 - wy0:cy1 - wy0, cx0 - wx0:cx1 - wx0]) == 0:
+            continue
+        can_model = TemplateModel(model.tpl[wy0:wy1, wx0:wx1], can_mask)
+        regions.append(CanRegion(can["numero_lata"], (cx0, cy0, cx1, cy1), (wx0, wy0, wx1, wy1), can_model))
+    return regions
+
+
+def can_regions_pad(msssim_kernel_sizes=(7, 5, 3), se_top=9, se_black=9,
+                    dark_morph_kernel_size=3, dark_morph_iterations=1,
+                    bright_morph_kernel_size=3, bright_morph_iterations=1,
+                    msssim_morph_kernel_size=3, msssim_morph_iterations=1):
+    """Margem (px) que cobre o alcance dos filtros locais do modo Full (Gaussianas 5x5 incluídas)."""
+    return 4 + max(
+        8,                                                                     # Canny/black-hat 7x7
+        6 + _morph_ops_reach(dark_morph_kernel_size, dark_morph_iterations),
+        1 + _morph_ops_reach(bright_morph_kernel_size, bright_morph_iterations),
+        2 * (_odd_at_least_1(se_top) // 2),
+        2 * (_odd_at_least_1(se_black) // 2),
+        4 * max(int(k) // 2 for k in msssim_kernel_sizes) + _morph_ops_reach(
+            msssim_morph_kernel_size, msssim_morph_iterations),
+    )
+
+
+def _bind_detector_params(args, kwargs):
+    """Argumentos posicionais/nomeados de detect_defects_with_model (sem model/aligned), com defaults."""
+    bound = inspect.signature(detect_defects_with_model).bind(None, None, *args, **kwargs)
+    bound.apply_defaults()
+    params = dict(bound.arguments)
+    params.pop("model")
+    params.pop("aligned")
+    return params
+
+
+# parâmetros de execução/retorno: não mudam os limiares (fora da chave da cache)
+_NON_THRESHOLD_PARAMS = ("tiles", "workers", "verbose", "workspace", "outputs", "return_msssim", "return_fusion")
+
+
+def _can_final_mask(mask, safe_roi, border_ring, over_mask):
+    fin = cv2.bitwise_and(mask, mask, mask=safe_roi)
+    if border_ring is not None:
+        fin = cv2.bitwise_and(fin, cv2.bitwise_not(border_ring))
+    if over_mask is not None:
+        fin = cv2.bitwise_and(fin, cv2.bitwise_not(over_mask))
+    return fin
+
+
+def _to_roi_contours(contours, window):
+    """Contornos do recorte -> coords da ROI da folha."""
+    off = np.array([[[window[0], window[1]]]], np.int32)
+    return [c + off for c in contours]
+
+
+# ---------------------------
+# Refinamento local por lata (translação por correlação de fase)
+# ---------------------------
+# A H global deixa resíduos de alguns px nalgumas latas (folha empenada,
+# H média da folha). estimate_can_offsets() mede, em paralelo, a translação
+# subpíxel do recorte alinhado de cada lata face ao template (phaseCorrelate
+# com janela de Hanning sobre o cinzento desfocado) e
+# detect_defects_per_can(..., offsets=) compara cada lata com a janela do
+# frame deslocada desse valor (getRectSubPix: bilinear, bordo replicado).
+# Desvios acima de max_shift ou com resposta < min_response são descartados
+# (0, 0): uma lata sem textura ou com um defeito grande não arrasta a janela.
+
+
+def _phase_reference(region):
+    """Cinzento desfocado float32 do template da janela + janela de Hanning (1x por lata)."""
+    def _ref():
+        tpl = region.model.blur.astype(np.float32)
+        return tpl, cv2.createHanningWindow((tpl.shape[1], tpl.shape[0]), cv2.CV_32F)
+    return region.model._cached(("phase_reference",), _ref)
+
+
+def estimate_can_offsets(regions, aligned, max_shift=4.0, min_response=0.1, workers=4):
+    """
+    Translação local (dx, dy) de cada lata: aligned[janela + (dx, dy)] ≈ template da janela.
+    Devolve {numero_lata: (dx, dy, resposta)}; (0, 0) se o desvio for > max_shift px
+    ou a resposta < min_response.
+    """
+    pool = _tile_pool(workers) if int(workers or 1) > 1 else None
+
+    def _offset(region):
+        tpl, win = _phase_reference(region)
+        wx0, wy0, wx1, wy1 = region.window
+        crop = aligned[wy0:wy1, wx0:wx1]
+        gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+        cur = cv2.GaussianBlur(gray, (5, 5), 0).astype(np.float32)
+        (dx, dy), response = cv2.phaseCorrelate(tpl, cur, win)
+        if response < min_response or np.hypot(dx, dy) > max_shift:
+            return 0.0, 0.0, float(response)
+        return float(dx), float(dy), float(response)
+
+    results = _run_strips(_offset, regions, pool)
+    return {rg.numero_lata: res for rg, res in zip(regions, results)}
+
+
+def _shifted_crop(aligned, window, offset):
+    """Recorte da janela deslocada por offset (dx, dy); inteiro -> slice, senão bilinear."""
+    wx0, wy0, wx1, wy1 = window
+    dx, dy = (0.0, 0.0) if offset is None else offset[:2]
+    if dx == 0 and dy == 0:
+        return aligned[wy0:wy1, wx0:wx1]
+    w, h = wx1 - wx0, wy1 - wy0
+    return cv2.getRectSubPix(aligned, (w, h), (wx0 + (w - 1) * 0.5 + dx, wy0 + (h - 1) * 0.5 + dy))
+
+
+def detect_defects_per_can(regions, aligned, *args, verdict_only=False, workers=4, offsets=None, thresholds=None,
+                           _population=False, **kwargs):
+    """
+    Deteção por lata. regions: build_can_regions(...); aligned: ROI alinhada
+    (a mesma imagem que iria para detect_defects_with_model). *args/**kwargs:
+    parâmetros de detect_defects_with_model (tiles/workers/returns são ignorados).
+    offsets: {numero_lata: (dx, dy, ...)} de estimate_can_offsets (janela do frame
+    deslocada; contornos e máscaras continuam nas coords do template).
+    thresholds: sheet_thresholds(...) da folha; sem eles, min/max e percentis são
+    agregados sobre todas as regiões (as que saem cedo também calculam os mapas).
+
+    Devolve {numero_lata: {"rejected", "contours" (coords da ROI), "bbox" (x, y, w, h),
+    "stages" (fases corridas), "masks" (final, darker, brighter, blue, red) no recorte da janela}}.
+    Numa lata que saiu cedo, "final" só tem a parte clássica.
+    """
+    start_time = time.perf_counter()
+    p = _bind_detector_params(args, kwargs)
+    pool = _tile_pool(workers) if int(workers or 1) > 1 else None
+    min_area = p["min_defect_area"]
+    try:
+        border_w = max(0, int(p["suppress_border_width_px"]))
+    except Exception:
+        border_w = 0
+
+    def _result(region, rejected, contours, stages, masks=None):
+        x0, y0, x1, y1 = region.core
+        return {"rejected": bool(rejected), "contours": _to_roi_contours(contours, region.window),
+                "bbox": (x0, y0, x1 - x0, y1 - y0), "stages": stages, "masks": masks}
+
+    def _crop(region):
+        return _shifted_crop(aligned, region.window, offsets.get(region.numero_lata) if offsets else None)
+
+    # --- Simple: sem fase barata -> detetor completo por lata ---
+    if str(dd.mode).lower() == "simple":
+        call = dict(p, tiles=None, workers=None, return_msssim=False, return_fusion=False, verbose=False)
+
+        def _simple(region):
+            res = detect_defects_with_model(region.model, _crop(region), **call)
+            return _result(region, len(res[1]) > 0, res[1], ["simple"], res[:1] + res[2:6])
+
+        results = _run_strips(_simple, regions, pool)
+        out = {rg.numero_lata: res for rg, res in zip(regions, results)}
+        if p["verbose"]:
+            print(f"[Simple] detect_defects_per_can took {time.perf_counter() - start_time:.4f} seconds"
+                  f" ({len(regions)} latas)")
+        return out
+
+    msssim_scales = (1.0, 0.5, 0.25)
+    msssim_weights = (0.5, 0.3, 0.2)
+    # mesmo grafo de estágios do detetor de folha: só corre o que as máscaras finais usam
+    run = set(_resolve_stages(_full_stage_graph(
+        p["bright_threshold"], p["blue_threshold"], p["red_threshold"], p["use_ms_ssim"], p["msssim_weight"],
+        p["use_morph_maps"], p["use_color_delta"], p["fusion_mode"],
+        p["w_struct"], p["w_top"], p["w_black"], p["w_color"], p["ignore_overexposed"]), LEGACY_OUTPUTS))
+    use_ms_ssim = p["use_ms_ssim"] and "msssim" in run
+    use_msssim_mask = use_ms_ssim and p["msssim_weight"] > 0
+    fusion_weighted = str(p["fusion_mode"]).lower() == "weighted"
+    hist_pct = str(p["percentile_method"]).lower() == "histogram"
+    se_top_eff = _odd_at_least_1(p["se_top"])
+    se_black_eff = _odd_at_least_1(p["se_black"])
+    k_top = cv2.getStructuringElement(cv2.MORPH_RECT, (se_top_eff, se_top_eff))
+    k_blk = cv2.getStructuringElement(cv2.MORPH_RECT, (se_black_eff, se_black_eff))
+
+    # --- 1) mapas clássicos + veredito barato ---
+    def _classic(region):
+        m = region.model
+        aln = _crop(region)
+        st = {"region": region, "stages": ["classic"]}
+        st["safe_roi"] = safe_roi = m.safe_roi(p["roi_erode_px"])
+        st["a_blur"] = a_blur = cv2.GaussianBlur(cv2.cvtColor(aln, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        st["a_lab"] = cv2.cvtColor(aln, cv2.COLOR_BGR2LAB) if "lab" in run else None
+        if _population:             # só a população dos limiares: sem máscaras clássicas
+            return st
+        st["over"] = _overexposed_mask(aln, safe_roi) if "overexposed" in run else None
+        st["ring"] = m.border_ring(border_w) if border_w > 0 else None
+
+        darker = _dark_mask(m.blur, a_blur, m.mask_bin, m.micro_blackhat,
+                            p["dark_threshold"], p["dark_gradient_threshold"])
+        if "color" in run:
+            edge_inv = _thin_edges_inv(cv2.bitwise_or(m.edges, cv2.Canny(a_blur, 60, 180)))
+            brighter, blue, red = _color_masks(m.lab, st["a_lab"], edge_inv,
+                                               p["bright_threshold"], p["blue_threshold"], p["red_threshold"])
+            st["combined"] = _classic_combined(darker, brighter, blue, red,
+                                               p["dark_morph_kernel_size"], p["dark_morph_iterations"],
+                                               p["bright_morph_kernel_size"], p["bright_morph_iterations"])
+        else:
+            brighter = blue = red = np.zeros_like(darker)
+            st["combined"] = _apply_morphological_ops(darker, p["dark_morph_kernel_size"], p["dark_morph_iterations"])
+        st["maps"] = (darker, brighter, blue, red)
+
+        if verdict_only:
+            fin = _can_final_mask(st["combined"], safe_roi, st["ring"], st["over"])
+            contours, _ = cv2.findContours(fin, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours = _filter_contours(contours, min_area)
+            if contours:
+                st["done"] = _result(region, True, contours, st["stages"], (fin,) + st["maps"])
+        return st
+
+    states = _run_strips(_classic, regions, pool)
+    pending = [st for st in states if "done" not in st]
+    # população dos limiares: todas as regiões (nunca só as que ficaram por decidir)
+    population = states if thresholds is None else []
+
+    # --- 2) mapas caros (scores brutos): nas latas por decidir, ou em todas sem limiares dados ---
+    def _raw_maps(st):
+        m = st["region"].model
+        a_blur = st["a_blur"]
+        st["stages"].append("maps")
+        if "tophat" in run:
+            st["top"] = _hat_diff(a_blur, m.tophat(se_top_eff), k_top, cv2.MORPH_TOPHAT)
+        if "blackhat" in run:
+            st["black"] = _hat_diff(a_blur, m.blackhat(se_black_eff), k_blk, cv2.MORPH_BLACKHAT)
+        if "color_delta" in run:
+            st["color"] = _color_delta_raw(m.lab, st["a_lab"], p["color_metric"])
+        if use_ms_ssim:
+            st["dssim"] = _ms_ssim_map(
+                m.blur, a_blur, scales=msssim_scales, ksizes=p["msssim_kernel_sizes"],
+                sigmas=p["msssim_sigmas"], weights=msssim_weights,
+                x_pyramid=m.ms_ssim_pyramid(msssim_scales, p["msssim_kernel_sizes"], p["msssim_sigmas"],
+                                            p["ssim_backend"]),
+                backend=p["ssim_backend"])
+        return st
+
+    evaluated = states if thresholds is None else pending
+    _run_strips(_raw_maps, evaluated, pool)
+
+    # --- 3) reduções: limiares da folha dados, ou agregados sobre TODAS as regiões ---
+    def _range(key, states_):
+        return (min(np.float32(st[key].min()) for st in states_),
+                max(np.float32(st[key].max()) for st in states_))
+
+    def _pct(key, pct):
+        if hist_pct:
+            engines = [st["region"].percentile_engine(p["roi_erode_px"], p["percentile_bins"])
+                       for st in population]
+            hist = np.sum([eng.histogram(st[key]) for eng, st in zip(engines, population)], axis=0)
+            return engines[0].thresholds(hist, [pct])[0]
+        vals = np.concatenate([st[key][st["region"].population_roi(p["roi_erode_px"]) > 0]
+                               for st in population])
+        return np.percentile(vals, float(pct)) if vals.size else None
+
+    map_keys = [key for key, stage in (("top", "tophat"), ("black", "blackhat"), ("color", "color_delta"))
+                if stage in run]
+    if thresholds is not None:
+        missing = [key for key in map_keys + ["fused"] * fusion_weighted if key not in thresholds["ranges"]]
+        if missing:
+            raise ValueError(f"thresholds sem min/max para {missing} (parâmetros diferentes dos do detetor?)")
+        ranges, thr = dict(thresholds["ranges"]), dict(thresholds["thr"])
+    elif population:
+        ranges, thr = {key: _range(key, population) for key in map_keys}, {}
+    else:
+        ranges, thr = {}, {}
+
+    def _normalize(st):
+        for key in map_keys:
+            st[key] = _norm01_range(st[key], *ranges[key])
+        if fusion_weighted:
+            zeros = np.zeros(st["a_blur"].shape, np.float32)
+            fr = (p["w_struct"] * st.get("dssim", zeros) +
+                  p["w_top"]    * st.get("top", zeros) +
+                  p["w_black"]  * st.get("black", zeros) +
+                  p["w_color"]  * st.get("color", zeros))
+            st["fused"] = fr.astype(np.float32)
+
+    _run_strips(_normalize, evaluated, pool)
+    if fusion_weighted and evaluated:
+        if "fused" not in ranges:
+            ranges["fused"] = _range("fused", population)
+        for st in evaluated:
+            st["fused"] = _norm01_range(st["fused"], *ranges["fused"])
+
+    if thresholds is None and population:
+        if use_ms_ssim:
+            thr["dssim"] = _pct("dssim", p["msssim_percentile"])
+            if thr["dssim"] is None:
+                thr["dssim"] = 1.0
+        if fusion_weighted:
+            thr["fused"] = _pct("fused", p["fused_percentile"])
+        else:
+            for key, pct in (("top", p["th_top_percentile"]), ("black", p["th_black_percentile"]),
+                             ("color", p["color_percentile"])):
+                if key in ranges:
+                    thr[key] = _pct(key, pct)
+    if _population:
+        return {"ranges": ranges, "thr": thr}
+
+    # --- 4) binarização + fusão + máscara final por lata ---
+    def _finalize(st):
+        safe_roi = st["safe_roi"]
+        st["stages"].append("fusion")
+        comb = st["combined"]
+        ms_m = None
+        if use_ms_ssim:
+            ms_m = _threshold_bin(st["dssim"], safe_roi, thr.get("dssim", 1.0))
+            ms_m = _apply_morphological_ops(ms_m, p["msssim_morph_kernel_size"], p["msssim_morph_iterations"])
+        if use_msssim_mask:
+            comb = cv2.bitwise_or(comb, ms_m)
+
+        if fusion_weighted:
+            fm = _threshold_bin(st["fused"], safe_roi, thr.get("fused"))
+        else:
+            fm = np.zeros_like(safe_roi, dtype=np.uint8)
+            for key in map_keys:
+                if thr.get(key) is not None:
+                    fm = cv2.bitwise_or(fm, _threshold_bin(st[key], safe_roi, thr[key]))
+            if use_msssim_mask:
+                fm = cv2.bitwise_or(fm, ms_m)
+
+        fin = _can_final_mask(cv2.bitwise_or(comb, fm), safe_roi, st["ring"], st["over"])
+        contours, _ = cv2.findContours(fin, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours = _filter_contours(contours, min_area)
+        return _result(st["region"], len(contours) > 0, contours, st["stages"], (fin,) + st["maps"])
+
+    finals = _run_strips(_finalize, pending, pool)
+    for st, res in zip(pending, finals):
+        st["done"] = res
+
+    n_early = len(states) - len(pending)
+    if p["verbose"]:
+        print(f"[Full] detect_defects_per_can took {time.perf_counter() - start_time:.4f} seconds"
+              f" ({len(regions)} latas, {n_early} rejeitadas na fase barata)")
+    return {st["region"].numero_lata: st["done"] for st in states}
+
+
+def sheet_thresholds(model, aligned, *args, tile_size=256, sample_stride=4, workers=4,
+                     max_reuse=0, max_drift=2.0, **kwargs):
+    """
+    min/max e limiares de percentil da folha para detect_defects_per_can(thresholds=):
+    mapas do modo Full numa amostra fixa de tiles da ROI (model = TemplateModel da
+    folha; 1 tile em cada sample_stride, em xadrez). max_reuse > 0: reutiliza os
+    limiares em cache em até max_reuse folhas seguintes se a média BGR na máscara
+    não variou mais de max_drift níveis. Devolve {"ranges", "thr", "cached"}.
+    """
+    p = _bind_detector_params(args, kwargs)
+    pad = can_regions_pad(p["msssim_kernel_sizes"], p["se_top"], p["se_black"],
+                          p["dark_morph_kernel_size"], p["dark_morph_iterations"],
+                          p["bright_morph_kernel_size"], p["bright_morph_iterations"],
+                          p["msssim_morph_kernel_size"], p["msssim_morph_iterations"])
+    stride = max(1, int(sample_stride))
+    call = {k: v for k, v in p.items() if k not in _NON_THRESHOLD_PARAMS}
+
+    entry = exposure = None
+    if int(max_reuse) > 0:
+        entry = model._cached(("sheet_thresholds", int(tile_size), int(pad), stride, repr(sorted(call.items()))),
+                              dict)
+        exposure = np.array(cv2.mean(aligned, mask=model.mask_bin)[:3])
+        if (entry and entry["uses"] < int(max_reuse)
+                and float(np.abs(exposure - entry["exposure"]).max()) <= float(max_drift)):
+            entry["uses"] += 1
+            return dict(entry["thresholds"], cached=True)
+
+    def _roi_px(regions):
+        return sum(cv2.countNonZero(rg.population_roi(p["roi_erode_px"])) for rg in regions)
+
+    regions = tile_regions(model, tile_size, pad)
+    sample = model._cached(
+        ("threshold_sample", int(tile_size), int(pad), stride),
+        lambda: [rg for rg in regions if (rg.numero_lata[0] * 3 + rg.numero_lata[1]) % stride == 0])
+    if _roi_px(sample) == 0:
+        # amostra sem ROI depois da erosão: população = todos os tiles
+        sample = regions
+        if _roi_px(sample) == 0:
+            raise ValueError(f"sheet_thresholds: ROI vazio com roi_erode_px={p['roi_erode_px']}"
+                             " (sem população para os percentis)")
+    thresholds = detect_defects_per_can(sample, aligned, workers=workers, _population=True, verbose=False, **call)
+    if entry is not None:
+        entry.update(thresholds=thresholds, exposure=exposure, uses=0)
+    return dict(thresholds, cached=False)
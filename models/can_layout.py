@@ -0,0 +1,64 @@
+import json
+
+import cv2
+import numpy as np
+
+# ---------------------------
+# Layout das latas na folha (espaço do TEMPLATE)
+# ---------------------------
+# forma_base.json: contorno de uma lata centrado em (0, 0)
+# instancias_poligonos.txt: uma linha por lata "idx:cx,cy,s"
+# can_label_map: raster uint8 com o nº da lata por pixel (1x ao carregar o
+# layout), para atribuir a lata a todos os defeitos num só lookup vetorizado
+
+
+def load_can_layout(forma_path="data/mask/forma_base.json",
+                    instances_path="data/mask/instancias_poligonos.txt"):
+    """
+    Lê a forma base e as instâncias; devolve [{numero_lata, points, center, scale}]
+    com points = vértices da lata em coords do template (lista de (x, y)).
+    """
+    with open(forma_path, "r") as f:
+        forma_base = json.load(f)
+    layout = []
+    with open(instances_path) as f:
+        for line in f:
+            parts = line.strip().split(":")
+            if len(parts) != 2:
+                continue
+            idx_str, rest = parts
+            cx_str, cy_str, s_str = rest.split(",")
+            idx = int(idx_str)
+            cx, cy, s = float(cx_str), float(cy_str), float(s_str)
+            layout.append({
+                "numero_lata": idx,
+                "points": [(cx + x * s, cy + y * s) for x, y in forma_base],
+                "center": (cx, cy),
+                "scale": s
+            })
+    return layout
+
+
+def can_label_map(layout, shape, origin=(0, 0), fill=True):
+    """
+    Mapa uint8 (H, W) com o nº da lata por pixel (0 = sem lata), nas coords do
+    template com origin = canto (x, y) da ROI. fill=True atribui os pixels fora
+    dos contornos à lata mais próxima (Voronoi pelo distanceTransform): um
+    defeito entre latas ou na borda do contorno fica na lata vizinha.
+    """
+    label_map = np.zeros(shape, np.uint8)
+    ox, oy = origin
+    for can in layout:
+        n = int(can["numero_lata"])
+        if not 0 < n < 256:
+            raise ValueError(f"Nº de lata fora de 1..255 para o mapa uint8: {n}")
+        pts = np.round(np.asarray(can["points"], np.float64) - (ox, oy)).astype(np.int32)
+        cv2.fillPoly(label_map, [pts], n)
+    inside = label_map > 0
+    if not fill or not inside.any() or inside.all():
+        return label_map
+    # DIST_LABEL_PIXEL numera os pixels zero (aqui: os das latas) por ordem de varrimento
+    _, nearest = cv2.distanceTransformWithLabels((~inside).view(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_5,
+                                                 labelType=cv2.DIST_LABEL_PIXEL)
+    lut = np.concatenate((np.zeros(1, np.uint8), label_map[inside]))
+    return lut[nearest]
@@ -0,0 +1,131 @@
+import time
+
+import cv2
+import numpy as np
+
+from models.can_detector import (
+    _bind_detector_params, can_regions_pad, detect_defects_per_can, sheet_thresholds, tile_regions,
+)
+from models.defect_detector import _filter_contours
+from utils.profiler import PROFILER
+
+# ---------------------------
+# Deteção coarse-to-fine (rastreio a 1/4 + refinamento só nos tiles suspeitos)
+# ---------------------------
+# 1) Rastreio: template (cache no TemplateModel) e imagem reduzidos por
+#    screen_scale; score = max(|Δgray|/dark_threshold, Δb/bright_threshold,
+#    -Δb/blue_threshold, Δa/red_threshold), i.e. 1.0 = limiar do modo Full.
+#    A redução INTER_AREA dilui defeitos pequenos (um ponto de 2 px a 1/4 fica
+#    com ~1/4 do contraste), por isso a margem por omissão é baixa (0.25).
+# 2) Refinamento: grelha fixa de tiles tile_size x tile_size; só os tiles com
+#    max(score) >= screen_margin correm o pipeline Full (detect_defects_per_can
+#    com um "polígono" por tile, janela com margem = alcance dos filtros).
+#    As máscaras dos tiles são costuradas e os contornos saem da máscara
+#    completa (um defeito na fronteira entre tiles não é partido).
+# Percentis/normalizações são os da folha (can_detector.sheet_thresholds:
+# amostra fixa de tiles a resolução total), antes do refinamento: um tile
+# suspeito não recebe o seu próprio percentil de topo (o que marcaria sempre
+# algo como defeito numa folha limpa com ruído no rastreio). A amostra custa
+# ~1/sample_stride do modo Full; com max_reuse > 0 os limiares ficam em cache
+# entre folhas (mesmo template/parâmetros, exposição estável) e uma folha com
+# um só tile marcado paga só esse tile. telemetry["thresholds_s"] mostra o custo.
+
+
+def _screen_score(model, aligned, scale, p):
+    """Score de rastreio float32 na resolução reduzida (0 fora da máscara)."""
+    t_gray, t_lab, mask_s = model.screen(scale)
+    small = cv2.resize(aligned, (t_gray.shape[1], t_gray.shape[0]), interpolation=cv2.INTER_AREA)
+    a_gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    a_lab = cv2.cvtColor(small, cv2.COLOR_BGR2LAB)
+
+    def _rel(diff, thr):
+        return diff.astype(np.float32) * np.float32(1.0 / max(1.0, float(thr)))
+
+    score = _rel(cv2.absdiff(t_gray, a_gray), p["dark_threshold"])
+    score = np.maximum(score, _rel(cv2.subtract(a_lab[:, :, 2], t_lab[:, :, 2]), p["bright_threshold"]))
+    score = np.maximum(score, _rel(cv2.subtract(t_lab[:, :, 2], a_lab[:, :, 2]), p["blue_threshold"]))
+    score = np.maximum(score, _rel(cv2.subtract(a_lab[:, :, 1], t_lab[:, :, 1]), p["red_threshold"]))
+    # max 3x3: um defeito junto à fronteira marca os dois tiles vizinhos
+    score = cv2.dilate(score, np.ones((3, 3), np.uint8))
+    # fora da máscara erodida: a redução mistura a borda da máscara com o fundo
+    score[cv2.erode(mask_s, np.ones((3, 3), np.uint8)) == 0] = 0
+    return score
+
+
+def detect_defects_coarse_to_fine(model, aligned, *args, screen_scale=0.25, screen_margin=0.25,
+                                  tile_size=256, workers=4, sample_stride=4, max_reuse=0, max_drift=2.0,
+                                  **kwargs):
+    """
+    Modo de dois níveis sobre o TemplateModel da folha. *args/**kwargs: parâmetros de
+    detect_defects_with_model (modo Full). sample_stride/max_reuse/max_drift: amostra e
+    reutilização dos limiares da folha (ver sheet_thresholds).
+
+    Devolve ((final_defect_mask, filtered_contours, darker, brighter, blue, red), telemetry)
+    com telemetry = {"tiles_total", "tiles_refined", "refined_area_frac" (fração da máscara
+    refinada a resolução total), "max_screen_score", "screen_s", "thresholds_s",
+    "thresholds_cached" (None sem tiles refinados), "refine_s" (sem os limiares)}.
+    """
+    start_time = time.perf_counter()
+    p = _bind_detector_params(args, kwargs)
+    tile_size = max(32, int(tile_size))
+    H, W = model.shape
+
+    # --- 1) rastreio grosseiro ---
+    score = _screen_score(model, aligned, screen_scale, p)
+    t_screen = time.perf_counter() - start_time
+
+    pad = can_regions_pad(p["msssim_kernel_sizes"], p["se_top"], p["se_black"],
+                          p["dark_morph_kernel_size"], p["dark_morph_iterations"],
+                          p["bright_morph_kernel_size"], p["bright_morph_iterations"],
+                          p["msssim_morph_kernel_size"], p["msssim_morph_iterations"])
+    regions = tile_regions(model, tile_size, pad)
+    sh, sw = score.shape
+    flagged = []
+    for rg in regions:
+        x0, y0, x1, y1 = rg.core
+        sx0, sy0 = int(x0 * sw / W), int(y0 * sh / H)
+        sx1, sy1 = max(sx0 + 1, int(np.ceil(x1 * sw / W))), max(sy0 + 1, int(np.ceil(y1 * sh / H)))
+        if float(score[sy0:sy1, sx0:sx1].max()) >= screen_margin:
+            flagged.append(rg)
+
+    # --- 2) pipeline Full só nos tiles suspeitos + costura ---
+    t_ref = time.perf_counter()
+    final_defect_mask = np.zeros((H, W), np.uint8)
+    darker_mask, brighter_mask, blue_mask, red_mask = (np.zeros((H, W), np.uint8) for _ in range(4))
+    refined_px = 0
+    t_thr, cached = 0.0, None
+    if flagged:
+        call = {k: v for k, v in p.items() if k not in ("tiles", "workers")}
+        call["verbose"] = False
+        with PROFILER.span("detect.sheet_thresholds"):
+            thresholds = sheet_thresholds(model, aligned, tile_size=tile_size, sample_stride=sample_stride,
+                                          max_reuse=max_reuse, max_drift=max_drift, workers=workers, **call)
+        t_thr, cached = time.perf_counter() - t_ref, thresholds["cached"]
+        res = detect_defects_per_can(flagged, aligned, workers=workers, thresholds=thresholds, **call)
+        for rg in flagged:
+            x0, y0, x1, y1 = rg.core
+            rows, cols = rg.core_slices()
+            for dst, src in zip((final_defect_mask, darker_mask, brighter_mask, blue_mask, red_mask),
+                                res[rg.numero_lata]["masks"]):
+                dst[y0:y1, x0:x1] = src[rows, cols]
+            refined_px += cv2.countNonZero(rg.model.mask_bin[rows, cols])
+
+    contours, _ = cv2.findContours(final_defect_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    filtered_contours = _filter_contours(contours, p["min_defect_area"])
+
+    telemetry = {
+        "tiles_total": len(regions),
+        "tiles_refined": len(flagged),
+        "refined_area_frac": refined_px / max(1, cv2.countNonZero(model.mask_bin)),
+        "max_screen_score": float(score.max()) if score.size else 0.0,
+        "screen_s": t_screen,
+        "thresholds_s": t_thr,
+        "thresholds_cached": cached,
+        "refine_s": time.perf_counter() - t_ref - t_thr,
+    }
+    if p["verbose"]:
+        print(f"[Coarse] detect_defects took {time.perf_counter() - start_time:.4f} seconds"
+              f" ({len(flagged)}/{len(regions)} tiles refinados,"
+              f" {100.0 * telemetry['refined_area_frac']:.1f}% da área,"
+              f" limiares {t_thr:.4f} s{' em cache' if cached else ''})")
+    return (final_defect_mask, filtered_contours, darker_mask, brighter_mask, blue_mask, red_mask), telemetry
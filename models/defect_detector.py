@@ -1,6 +1,14 @@
 import cv2
 import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+
+from models import ssim_fast
+from models.defect_table import build_defect_table
+from models.percentile_hist import RoiPercentileEngine
+from models.workspace import DetectorWorkspace, no_scratch, scoped
+from utils.profiler import PROFILER
 
 # =========================
 #  MODO ESTÁTICO (troca aqui)
@@ -20,22 +28,64 @@ SIMPLE_BAND_SIGMA2 = 2.0     # sigma2 para DoG
 SIMPLE_MORPH_KERNEL = 3      # morfologia final do Simple
 SIMPLE_MORPH_ITERS  = 1
 
+def _roi_percentile(img_float01, roi_mask_u8, pct, tmp=no_scratch):
+    """
+    Percentil (0..100) de img dentro do ROI; None se o ROI estiver vazio.
+    tmp: scratch do workspace; em vez de img[roi] (cópia nova por chamada) copia img
+    para um buffer com +inf fora do ROI e parte-o em n: os n primeiros são os valores
+    do ROI (o mesmo multiconjunto, logo o mesmo percentil).
+    """
+    shape = roi_mask_u8.shape[:2]
+    vals = tmp("pct_vals", (shape[0] * shape[1],), img_float01.dtype)
+    if vals is None:
+        vals = img_float01[roi_mask_u8.astype(bool)]
+        if vals.size == 0:
+            return None
+        return np.percentile(vals, float(pct), overwrite_input=True)   # vals já é uma cópia
+    n = cv2.countNonZero(roi_mask_u8)
+    if n == 0:
+        return None
+    np.copyto(vals.reshape(shape), img_float01)
+    if n < vals.size:
+        outside = np.equal(roi_mask_u8, 0, out=tmp("pct_outside", shape, np.bool_))
+        np.copyto(vals.reshape(shape), np.inf, where=outside)
+        vals.partition(n - 1)
+    return np.percentile(vals[:n], float(pct), overwrite_input=True)
+
+def _threshold_bin(img_float01, roi_mask_u8, thr, dst=None):
+    """Binariza img >= thr dentro do ROI (thr=None -> máscara vazia); dst: buffer uint8."""
+    m = np.empty_like(roi_mask_u8, dtype=np.uint8) if dst is None else dst
+    if thr is None:
+        m.fill(0)
+        return m
+    np.greater_equal(img_float01, thr, out=m.view(np.bool_))
+    m *= 255
+    return cv2.bitwise_and(m, roi_mask_u8, dst=m)
+
 def _percentile_bin(img_float01, roi_mask_u8, pct):
     """Binariza img [0..1] por percentil dentro do ROI (0..100)."""
-    roi = roi_mask_u8.astype(bool)
-    vals = img_float01[roi]
-    if vals.size == 0:
-        return np.zeros_like(roi_mask_u8, dtype=np.uint8)
-    thr = np.percentile(vals, float(pct))
-    m = (img_float01 >= thr).astype(np.uint8) * 255
-    return cv2.bitwise_and(m, roi_mask_u8)
+    return _threshold_bin(img_float01, roi_mask_u8, _roi_percentile(img_float01, roi_mask_u8, pct))
+
+def _norm01_range(x, mn, mx, out=None):
+    """
+    Normaliza para [0..1] com (mn, mx) já conhecidos (p.ex. globais a vários tiles).
+    out: buffer float32 do tamanho de x (sem cópias intermédias).
+    """
+    if out is None:
+        x = x.astype(np.float32)
+        if mx <= mn:
+            return np.zeros_like(x, dtype=np.float32)
+        return (x - mn) / (mx - mn)
+    if mx <= mn:
+        out.fill(0)
+        return out
+    np.subtract(x, np.float32(mn), out=out, dtype=np.float32)
+    np.divide(out, np.float32(mx) - np.float32(mn), out=out)
+    return out
 
 def _norm01(x):
     x = x.astype(np.float32)
-    mn, mx = x.min(), x.max()
-    if mx <= mn:
-        return np.zeros_like(x, dtype=np.float32)
-    return (x - mn) / (mx - mn)
+    return _norm01_range(x, x.min(), x.max())
 
 # ---------------------------
 # Helpers MS-SSIM (no skimage)
@@ -46,9 +96,25 @@ def _gaussian_kernel(ksize=7, sigma=1.5):
     w = k @ k.T
     return w / w.sum()
 
-def _gaussian_ssim_map(x, y, ksize=7, sigma=1.5, c1=(0.01*255)**2, c2=(0.03*255)**2):
+def _ssim_stats(x, ksize=7, sigma=1.5):
+    """
+    Estatísticas locais de um só lado do SSIM: (mu, sigma²) com janela gaussiana.
+    Permite pré-computar o lado do template uma única vez (ver TemplateModel).
+    """
+    if x.dtype != np.float32:
+        x = x.astype(np.float32)
+    w = _gaussian_kernel(ksize, sigma)
+    mu = cv2.filter2D(x, -1, w, borderType=cv2.BORDER_REFLECT)
+    sigma2 = cv2.filter2D(x*x, -1, w, borderType=cv2.BORDER_REFLECT) - mu * mu
+    return mu, sigma2
+
+def _gaussian_ssim_map(x, y, ksize=7, sigma=1.5, c1=(0.01*255)**2, c2=(0.03*255)**2, x_stats=None,
+                       tmp=no_scratch):
     """
     SSIM local (mapa) entre x e y (uint8), janela gaussiana.
+    x_stats: (mu_x, sigma_x²) já calculados para x (opcional, ver _ssim_stats).
+    tmp: scratch do workspace (models.workspace) para os 5 buffers float32 do tamanho
+    de y e a máscara den > 0; o mapa devolvido é um deles.
     Retorna mapa SSIM em float32 [0..1].
     """
     if x.dtype != np.float32:
@@ -57,158 +123,651 @@ def _gaussian_ssim_map(x, y, ksize=7, sigma=1.5, c1=(0.01*255)**2, c2=(0.03*255)
         y = y.astype(np.float32)
 
     w = _gaussian_kernel(ksize, sigma)
-    mu_x = cv2.filter2D(x, -1, w, borderType=cv2.BORDER_REFLECT)
-    mu_y = cv2.filter2D(y, -1, w, borderType=cv2.BORDER_REFLECT)
+    if x_stats is None:
+        mu_x = cv2.filter2D(x, -1, w, borderType=cv2.BORDER_REFLECT)
+        sigma_x2 = cv2.filter2D(x*x, -1, w, borderType=cv2.BORDER_REFLECT)
+        sigma_x2 -= mu_x * mu_x
+    else:
+        mu_x, sigma_x2 = x_stats
+    # mesma sequência de operações float32 da fórmula direta, mas em 5 buffers reutilizados
+    shape = y.shape[:2]
+    b_mu_y, b_mu_y2, b_mu_xy, b_t, b_sig_y2 = (tmp(name, shape, np.float32)
+                                               for name in ("mu_y", "mu_y2", "mu_xy", "t", "sigma_y2"))
+    mu_y = cv2.filter2D(y, -1, w, dst=b_mu_y, borderType=cv2.BORDER_REFLECT)
+    mu_y2 = np.multiply(mu_y, mu_y, out=b_mu_y2)
+    mu_xy = np.multiply(mu_x, mu_y, out=b_mu_xy)
+    t = np.multiply(y, y, out=b_t)
+    sigma_y2 = cv2.filter2D(t, -1, w, dst=b_sig_y2, borderType=cv2.BORDER_REFLECT)
+    sigma_y2 -= mu_y2
+    np.multiply(x, y, out=t)
+    sigma_xy = cv2.filter2D(t, -1, w, borderType=cv2.BORDER_REFLECT, dst=mu_y)
+    sigma_xy -= mu_xy
 
-    mu_x2 = mu_x * mu_x
-    mu_y2 = mu_y * mu_y
-    mu_xy = mu_x * mu_y
+    # SSIM por pixel: num = (2*mu_xy + c1) * (2*sigma_xy + c2)
+    num = mu_xy
+    num *= 2
+    num += c1
+    sigma_xy *= 2
+    sigma_xy += c2
+    num *= sigma_xy
+    # den = (mu_x2 + mu_y2 + c1) * (sigma_x2 + sigma_y2 + c2)
+    den = mu_y2
+    np.multiply(mu_x, mu_x, out=t)
+    den += t
+    den += c1
+    sigma_y2 += sigma_x2
+    sigma_y2 += c2
+    den *= sigma_y2
 
-    sigma_x2 = cv2.filter2D(x*x, -1, w, borderType=cv2.BORDER_REFLECT) - mu_x2
-    sigma_y2 = cv2.filter2D(y*y, -1, w, borderType=cv2.BORDER_REFLECT) - mu_y2
-    sigma_xy = cv2.filter2D(x*y, -1, w, borderType=cv2.BORDER_REFLECT) - mu_xy
+    ssim = t
+    ssim.fill(1.0)
+    np.divide(num, den, out=ssim, where=np.greater(den, 0, out=tmp("den_pos", shape, np.bool_)))
+    # estabiliza valores fora de faixa por ruído numérico
+    return np.clip(ssim, 0.0, 1.0, out=ssim)
 
-    # SSIM por pixel
-    num = (2*mu_xy + c1) * (2*sigma_xy + c2)
-    den = (mu_x2 + mu_y2 + c1) * (sigma_x2 + sigma_y2 + c2)
+SSIM_BACKENDS = ("reference",) + ssim_fast.BACKENDS
 
-    ssim = np.ones_like(num, dtype=np.float32)
-    mask = den > 0
-    ssim[mask] = num[mask] / den[mask]
-    # estabiliza valores fora de faixa por ruído numérico
-    return np.clip(ssim, 0.0, 1.0)
+def _check_ssim_backend(backend):
+    if backend not in SSIM_BACKENDS:
+        raise ValueError(f"ssim_backend inválido: {backend!r} (opções: {', '.join(SSIM_BACKENDS)})")
+
+def _ms_ssim_template_pyramid(x,
+                              scales=(1.0, 0.5, 0.25),
+                              ksizes=(7, 5, 3),
+                              sigmas=(1.5, 1.0, 0.8),
+                              backend="reference"):
+    """
+    Lado "x" (template) do MS-SSIM pré-computado por escala:
+    lista de (xs, (mu_x, sigma_x²)) para passar a _ms_ssim_map(x_pyramid=...).
+    """
+    assert len(scales) == len(ksizes) == len(sigmas)
+    _check_ssim_backend(backend)
+    if backend != "reference":
+        return ssim_fast.template_pyramid(x, scales, ksizes, sigmas)
+    if x.dtype != np.float32: x = x.astype(np.float32)
+    pyramid = []
+    for s, ksz, sg in zip(scales, ksizes, sigmas):
+        xs = x if s == 1.0 else cv2.resize(x, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+        pyramid.append((xs, _ssim_stats(xs, ksize=ksz, sigma=sg)))
+    return pyramid
+
+def _ms_ssim_scale(x, y, s, ksize, sigma, out_size, x_level=None, tmp=no_scratch, dst=None):
+    """
+    SSIM de uma escala do MS-SSIM, já em UPSAMPLE para out_size=(W0, H0).
+    x_level: (xs, (mu_x, sigma_x²)) dessa escala (ver _ms_ssim_template_pyramid).
+    tmp: scratch do workspace para y reduzido e os buffers do _gaussian_ssim_map.
+    dst: buffer float32 (H0, W0) para o upsample.
+    """
+    if x_level is not None:
+        xs, x_stats = x_level
+    else:
+        xs = x if s == 1.0 else cv2.resize(x, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+        x_stats = None
+    ys = y if s == 1.0 else cv2.resize(y, None, fx=s, fy=s, dst=tmp("ys", xs.shape, np.float32),
+                                       interpolation=cv2.INTER_AREA)
+
+    ssim_s = _gaussian_ssim_map(xs, ys, ksize=ksize, sigma=sigma, x_stats=x_stats, tmp=tmp)  # [0..1] no tamanho da escala
+    if (ssim_s.shape[1], ssim_s.shape[0]) == tuple(out_size):
+        return ssim_s  # resize para o mesmo tamanho é uma cópia
+    return cv2.resize(ssim_s, out_size, dst=dst, interpolation=cv2.INTER_LINEAR)
+
+def _ms_ssim_combine(ssim_maps, weights, out=None, tmp=None):
+    """
+    Acumula os mapas SSIM por escala (mesmo tamanho) e devolve DSSIM = 1 - MS-SSIM.
+    out/tmp: buffers float32 do tamanho dos mapas (acumulador/produto), opcionais.
+    """
+    shape = ssim_maps[0].shape[:2]
+    acc = np.zeros(shape, dtype=np.float32) if out is None else out
+    if out is not None:
+        acc.fill(0)
+    if tmp is None:
+        tmp = np.empty(shape, dtype=np.float32)
+    wsum = 0.0
+    for ssim_up, w in zip(ssim_maps, weights):
+        acc += np.multiply(ssim_up, w, out=tmp)
+        wsum += w
+    np.divide(acc, max(wsum, 1e-8), out=acc)
+    np.clip(acc, 0.0, 1.0, out=acc)
+    return np.subtract(1.0, acc, out=acc)
 
 def _ms_ssim_map(x, y,
                  scales=(1.0, 0.5, 0.25),
                  ksizes=(7, 5, 3),
                  sigmas=(1.5, 1.0, 0.8),
-                 weights=(0.5, 0.3, 0.2)):
+                 weights=(0.5, 0.3, 0.2),
+                 x_pyramid=None,
+                 backend="reference"):
     """
     MS-SSIM estilo “mapa” combinando escalas.
     Calcula SSIM em cada escala e faz UPSAMPLE para (H0, W0) antes de acumular.
+    x_pyramid: lado do template já calculado (ver _ms_ssim_template_pyramid).
+    backend: "reference" (esta implementação) ou "separable" (models.ssim_fast).
     Retorna DSSIM = 1 - MS-SSIM em float32 [0..1] no tamanho original.
     """
     assert len(scales) == len(ksizes) == len(sigmas) == len(weights)
+    _check_ssim_backend(backend)
+    if backend != "reference":
+        return ssim_fast.ms_ssim_map(x, y, scales, ksizes, sigmas, weights,
+                                     x_pyramid=x_pyramid)
 
     if x.dtype != np.float32: x = x.astype(np.float32)
     if y.dtype != np.float32: y = y.astype(np.float32)
 
     H0, W0 = x.shape[:2]
-    acc = np.zeros((H0, W0), dtype=np.float32)
-    wsum = 0.0
-
-    for s, ksz, sg, w in zip(scales, ksizes, sigmas, weights):
-        if s == 1.0:
-            xs, ys = x, y
-        else:
-            xs = cv2.resize(x, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
-            ys = cv2.resize(y, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
-
-        ssim_s = _gaussian_ssim_map(xs, ys, ksize=ksz, sigma=sg)  # [0..1] no tamanho da escala
-        ssim_up = cv2.resize(ssim_s, (W0, H0), interpolation=cv2.INTER_LINEAR)
-        acc += w * ssim_up
-        wsum += w
-
-    msssim = acc / max(wsum, 1e-8)
-    dssim = 1.0 - np.clip(msssim, 0.0, 1.0)
-    return dssim
+    ssim_maps = []
+    for i, (s, ksz, sg) in enumerate(zip(scales, ksizes, sigmas)):
+        x_level = x_pyramid[i] if x_pyramid is not None else None
+        ssim_maps.append(_ms_ssim_scale(x, y, s, ksz, sg, (W0, H0), x_level=x_level))
+    return _ms_ssim_combine(ssim_maps, weights)
 
 # ---------------------------
 # Morfologia
 # ---------------------------
 
-def _apply_morphological_ops(mask, kernel_size, iterations):
+def _apply_morphological_ops(mask, kernel_size, iterations, dst=None):
+    """Open + close (k<=1 ou it=0 = sem morfologia); dst: buffer uint8 do resultado."""
     k = int(kernel_size)
     it = int(iterations)
     if mask is None:
         return None
     # permitir “sem morfologia”
     if k <= 1 or it <= 0:
-        return mask
+        if dst is None:
+            return mask
+        np.copyto(dst, mask)
+        return dst
     k_eff = k if (k % 2 == 1) else (k + 1)
     kernel = np.ones((k_eff, k_eff), np.uint8)
-    m = cv2.morphologyEx(mask, cv2.MORPH_OPEN,  kernel, iterations=it)
-    m = cv2.morphologyEx(m,    cv2.MORPH_CLOSE, kernel, iterations=it)
+    m = cv2.morphologyEx(mask, cv2.MORPH_OPEN,  kernel, dst=dst, iterations=it)
+    m = cv2.morphologyEx(m,    cv2.MORPH_CLOSE, kernel, dst=m, iterations=it)
     return m
 
+def _morph_ops_reach(kernel_size, iterations):
+    """Alcance (px) de _apply_morphological_ops: open+close = 4*it erosões/dilatações de raio k//2."""
+    k = int(kernel_size)
+    it = int(iterations)
+    if k <= 1 or it <= 0:
+        return 0
+    k_eff = k if (k % 2 == 1) else (k + 1)
+    return 4 * it * (k_eff // 2)
+
 # ---------------------------
-# Detect Defects (+ Simple mode)
+# Estágios locais do modo Full (usados por faixa e por lata)
 # ---------------------------
 
-def detect_defects(tpl, aligned, mask,
-                   dark_threshold, bright_threshold,
-                   dark_morph_kernel_size, dark_morph_iterations,
-                   bright_morph_kernel_size, bright_morph_iterations,
-                   min_defect_area,
-                   dark_gradient_threshold,
-                   blue_threshold, red_threshold,
-                   # ---- MS-SSIM ----
-                   use_ms_ssim=True,
-                   msssim_percentile=99.5,
-                   msssim_weight=0.5,
-                   msssim_kernel_sizes=(7,5,3),
-                   msssim_sigmas=(1.5,1.0,0.8),
-                   msssim_morph_kernel_size=3,
-                   msssim_morph_iterations=1,
-                   # ---- Overexposure handling ----
-                   ignore_overexposed=False,
-                   # ---- ROI/border handling ----
-                   roi_erode_px=2,
-                   suppress_border_width_px=0,
-                   # ---- NOVO: Morfologia L (top/black) ----
-                   use_morph_maps=True,
-                   th_top_percentile=99.5,
-                   th_black_percentile=99.5,
-                   se_top=9,
-                   se_black=9,
-                   # ---- NOVO: Δa/Δb (cor) ----
-                   use_color_delta=True,
-                   color_metric="maxab",  # "maxab" ou "l2ab"
-                   color_percentile=99.0,
-                   # ---- NOVO: Fusão final ----
-                   fusion_mode="or",      # "or" ou "weighted"
-                   w_struct=0.50,
-                   w_top=0.25,
-                   w_black=0.15,
-                   w_color=0.10,
-                   fused_percentile=99.5,
-                   # ---- retornos opcionais ----
-                   return_msssim=False,
-                   return_fusion=False):
+# dst: buffer do resultado; tmp: scratch do workspace (models.workspace) para os
+# temporários. Sem eles (no_scratch) o OpenCV/NumPy alocam, como no modo por lata.
+
+def _overexposed_mask(aligned, safe_roi, dst=None, tmp=no_scratch):
+    """Zonas saturadas (V >= 250) dentro do ROI, dilatadas 1 px."""
+    shape = safe_roi.shape[:2]
+    hsv = cv2.cvtColor(aligned, cv2.COLOR_BGR2HSV, dst=tmp("hsv", shape + (3,)))
+    over_mask = cv2.extractChannel(hsv, 2, dst=tmp("u8_a", shape))
+    cv2.threshold(over_mask, 250, 255, cv2.THRESH_BINARY, dst=over_mask)
+    cv2.bitwise_and(over_mask, safe_roi, dst=over_mask)
+    return cv2.dilate(over_mask, np.ones((3, 3), np.uint8), dst=dst, iterations=1)
+
+def _thin_edges_inv(edge_mask_thin, dst=None):
+    """Inverso das arestas finas (OR dos Canny tpl/aligned) erodidas 3x3 — gate das cores."""
+    edge_mask_thin = cv2.erode(edge_mask_thin, np.ones((3,3), np.uint8), dst=dst, iterations=1)
+    return cv2.bitwise_not(edge_mask_thin, dst=edge_mask_thin)
 
+def _dark_mask(t_blur, a_blur, mask_bin, tpl_micro_blackhat, dark_threshold, dark_gradient_threshold,
+               dst=None, tmp=no_scratch):
+    """Darker (tpl - aligned) com gate de gradiente + booster black-hat 7x7 para micro-pontos."""
+    shape = a_blur.shape[:2]
+    # --- Darker: diff em grayscale liso (tpl - aligned) ---
+    darker_mask = cv2.subtract(t_blur, a_blur, dst=dst)  # ponto preto => positivo
+    cv2.threshold(darker_mask, int(dark_threshold), 255, cv2.THRESH_BINARY, dst=darker_mask)
+
+    # Gate de gradiente (em grayscale liso)
+    if dark_gradient_threshold > 0:
+        gradient_mask_dark = cv2.morphologyEx(a_blur, cv2.MORPH_GRADIENT, np.ones((5, 5), np.uint8),
+                                              dst=tmp("u8_a", shape))
+        cv2.threshold(gradient_mask_dark, int(dark_gradient_threshold), 255, cv2.THRESH_BINARY,
+                      dst=gradient_mask_dark)
+        cv2.bitwise_and(darker_mask, gradient_mask_dark, dst=darker_mask)
+    else:
+        cv2.bitwise_and(darker_mask, mask_bin, dst=darker_mask)
+
+    # --- Booster para micro-pontos escuros (blackhat) ---
+    bh_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))  # testa 5/7/9
+    micro_dark = cv2.morphologyEx(a_blur, cv2.MORPH_BLACKHAT, bh_kernel, dst=tmp("u8_a", shape))
+    cv2.subtract(micro_dark, tpl_micro_blackhat, dst=micro_dark)
+    bh_th = max(6, min(20, int(dark_threshold)//2 + 6))  # auto-ajuste simples
+    cv2.threshold(micro_dark, bh_th, 255, cv2.THRESH_BINARY, dst=micro_dark)
+    cv2.bitwise_and(micro_dark, mask_bin, dst=micro_dark)
+    return cv2.bitwise_or(darker_mask, micro_dark, dst=darker_mask)
+
+def _color_masks(tpl_lab, aligned_lab, edge_mask_inv_thin, bright_threshold, blue_threshold, red_threshold,
+                 dst=(None, None, None), tmp=no_scratch):
+    """LAB: (amarelo, azul, vermelho) com supressão leve de arestas finas."""
+    def _gate(x, y, thr, d):
+        m = cv2.subtract(x, y, dst=d)
+        cv2.threshold(m, int(thr), 255, cv2.THRESH_BINARY, dst=m)
+        return cv2.bitwise_and(m, edge_mask_inv_thin, dst=m)
+
+    # canais extraídos para buffers contíguos (um canal de um view LAB não é contíguo)
+    shape = aligned_lab.shape[:2]
+    a_ch = cv2.extractChannel(aligned_lab, 2, dst=tmp("u8_a", shape))
+    t_ch = cv2.extractChannel(tpl_lab, 2, dst=tmp("u8_b", shape))
+    brighter_mask = _gate(a_ch, t_ch, bright_threshold, dst[0])   # +amarelo
+    blue_mask = _gate(t_ch, a_ch, blue_threshold, dst[1])         # +azul
+    cv2.extractChannel(aligned_lab, 1, dst=a_ch)
+    cv2.extractChannel(tpl_lab, 1, dst=t_ch)
+    red_mask = _gate(a_ch, t_ch, red_threshold, dst[2])           # +vermelho
+    return brighter_mask, blue_mask, red_mask
+
+def _classic_combined(darker, brighter, blue, red,
+                      dark_morph_kernel_size, dark_morph_iterations,
+                      bright_morph_kernel_size, bright_morph_iterations, dst=None, tmp=no_scratch):
+    """Morfologia (k<=1 ou it=0 = sem morfologia) + OR dos 4 mapas antigos (retro-compat)."""
+    shape = darker.shape[:2]
+    darker_clean   = _apply_morphological_ops(darker,   dark_morph_kernel_size,   dark_morph_iterations,
+                                              dst=tmp("u8_a", shape))
+    brighter_clean = _apply_morphological_ops(brighter, bright_morph_kernel_size, bright_morph_iterations,
+                                              dst=tmp("u8_b", shape))
+    combined = cv2.bitwise_or(darker_clean, brighter_clean, dst=dst)
+    for m in (blue, red):
+        m_clean = _apply_morphological_ops(m, bright_morph_kernel_size, bright_morph_iterations,
+                                           dst=tmp("u8_a", shape))
+        cv2.bitwise_or(combined, m_clean, dst=combined)
+    return combined
+
+def _hat_diff(a_blur, tpl_hat, kernel, op, dst=None):
+    """Top-hat/black-hat da imagem menos o do template (score bruto uint8)."""
+    hat = cv2.morphologyEx(a_blur, op, kernel, dst=dst)
+    return cv2.subtract(hat, tpl_hat, dst=hat)
+
+def _color_delta_raw(tpl_lab, aligned_lab, color_metric, out=None, tmp=no_scratch):
+    """Δa/Δb por pixel (float32, não normalizado): max(|Δa|,|Δb|) ou L2."""
+    # |Δa|, |Δb| em uint8 (absdiff de inteiros é exato, igual ao float); float32 só no fim
+    shape = aligned_lab.shape[:2]
+    da = cv2.extractChannel(aligned_lab, 1, dst=tmp("u8_a", shape))
+    cv2.absdiff(da, cv2.extractChannel(tpl_lab, 1, dst=tmp("u8_b", shape)), dst=da)
+    db = cv2.extractChannel(aligned_lab, 2, dst=tmp("u8_b", shape))
+    cv2.absdiff(db, cv2.extractChannel(tpl_lab, 2, dst=tmp("u8_c", shape)), dst=db)
+    if str(color_metric).lower() == "l2ab":
+        d2 = np.multiply(da, da, out=out, dtype=np.float32)
+        d2 += np.multiply(db, db, out=tmp("f32_a", shape, np.float32), dtype=np.float32)
+        return np.sqrt(d2, out=d2)
+    m = cv2.max(da, db, dst=da)
+    if out is None:
+        return m.astype(np.float32)
+    np.copyto(out, m)
+    return out
+
+def _filter_contours(contours, min_defect_area):
+    """Filtros geométricos: área mínima e rejeição de filamentos (circularidade)."""
+    filtered_contours = []
+    min_area = max(1, int(min_defect_area))
+    for cnt in contours:
+        area = cv2.contourArea(cnt)
+        if area < min_area:
+            continue
+        peri = max(cv2.arcLength(cnt, True), 1e-6)
+        circularity = 4.0 * np.pi * area / (peri * peri)
+        if circularity < 0.02 and area > 150:
+            continue
+        filtered_contours.append(cnt)
+    return filtered_contours
+
+# ---------------------------
+# Grafo de estágios (modo Full)
+# ---------------------------
+# Cada estágio declara as dependências já em função dos parâmetros ativos
+# (p.ex. a fusão só depende do MS-SSIM se este entra nela). O detetor corre
+# apenas o fecho dos estágios pedidos pelas saídas; os intermédios partilhados
+# (gray/blur/LAB) são calculados 1x e usados por todos os consumidores.
+
+# saída pedida -> estágio que a produz
+DETECTOR_OUTPUTS = {
+    "final": "final",
+    "contours": "contours",
+    "table": "table",
+    "dark": "dark",
+    "bright": "color",
+    "blue": "color",
+    "red": "color",
+    "msssim": "msssim",
+    "fusion": "fusion",
+}
+
+LEGACY_OUTPUTS = ("final", "contours", "dark", "bright", "blue", "red")
+
+def _full_stage_graph(bright_threshold=30, blue_threshold=25, red_threshold=25,
+                      use_ms_ssim=True, msssim_weight=0.5, use_morph_maps=True, use_color_delta=True,
+                      fusion_mode="or", w_struct=0.50, w_top=0.25, w_black=0.15, w_color=0.10,
+                      ignore_overexposed=False):
+    """{estágio: dependências} para os parâmetros dados (um limiar >= 255 nunca dispara)."""
+    weighted = str(fusion_mode).lower() == "weighted"
+    color_on = min(int(bright_threshold), int(blue_threshold), int(red_threshold)) < 255
+    ms_mask_on = bool(use_ms_ssim) and msssim_weight > 0
+    fusion_in = (
+        ("msssim", (bool(use_ms_ssim) and w_struct > 0) if weighted else ms_mask_on),
+        ("tophat", bool(use_morph_maps) and (not weighted or w_top > 0)),
+        ("blackhat", bool(use_morph_maps) and (not weighted or w_black > 0)),
+        ("color_delta", bool(use_color_delta) and (not weighted or w_color > 0)),
+    )
+    return {
+        "gray": (),
+        "blur": ("gray",),
+        "lab": (),
+        "edges": ("blur",),
+        "overexposed": (),
+        "dark": ("blur",),
+        "color": ("lab", "edges"),
+        "classic": ("dark",) + (("color",) if color_on else ()),
+        "msssim": ("blur",),
+        "tophat": ("blur",),
+        "blackhat": ("blur",),
+        "color_delta": ("lab",),
+        "fusion": tuple(name for name, on in fusion_in if on),
+        "final": (("classic", "fusion") + (("msssim",) if ms_mask_on else ())
+                  + (("overexposed",) if ignore_overexposed else ())),
+        "contours": ("final",),
+        "table": ("final",),
+    }
+
+def _resolve_stages(graph, outputs):
+    """Estágios necessários para as saídas pedidas, por ordem topológica."""
+    order, seen = [], set()
+
+    def _visit(name):
+        if name in seen:
+            return
+        seen.add(name)
+        for dep in graph[name]:
+            _visit(dep)
+        order.append(name)
+
+    for out in outputs:
+        if out not in DETECTOR_OUTPUTS:
+            raise ValueError(f"Saída desconhecida: {out!r} (válidas: {', '.join(DETECTOR_OUTPUTS)})")
+        _visit(DETECTOR_OUTPUTS[out])
+    return order
+
+def _detector_result(outputs, legacy, values):
+    """Tuplo compatível (ordem de outputs) ou {nome: valor} para as saídas pedidas."""
+    if legacy:
+        return tuple(values[name] for name in outputs)
+    return {name: values[name] for name in outputs}
+
+# ---------------------------
+# Execução em tiles (faixas horizontais com halo)
+# ---------------------------
+
+_TILE_POOLS = {}
+
+def _tile_pool(workers):
+    """ThreadPool partilhado por nº de workers (OpenCV e NumPy largam o GIL nos kernels pesados)."""
+    workers = max(1, int(workers))
+    pool = _TILE_POOLS.get(workers)
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="detect_tile")
+        _TILE_POOLS[workers] = pool
+    return pool
+
+def _split_strips(height, n_strips, halo):
+    """
+    Divide [0, height) em n faixas. Cada faixa: (y0, y1, hy0, hy1) com
+    núcleo [y0, y1) e janela com halo [hy0, hy1) (cortada nos limites da imagem).
+    """
+    n = max(1, min(int(n_strips), height))
+    bounds = np.linspace(0, height, n + 1).round().astype(int)
+    strips = []
+    for y0, y1 in zip(bounds[:-1], bounds[1:]):
+        if y1 <= y0:
+            continue
+        strips.append((int(y0), int(y1), max(0, int(y0) - halo), min(height, int(y1) + halo)))
+    return strips
+
+def _run_strips(fn, strips, pool):
+    """Corre fn(strip) em cada faixa (no pool, se houver) e devolve os resultados por ordem."""
+    if pool is None or len(strips) <= 1:
+        return [fn(st) for st in strips]
+    return list(pool.map(fn, strips))
+
+# ---------------------------
+# Template pré-computado
+# ---------------------------
+
+def _binary_mask(mask):
+    """Garante máscara binária 0/255 (uint8)."""
+    if mask.dtype != np.uint8:
+        return (mask > 0).astype(np.uint8) * 255
+    return mask
+
+def _odd_at_least_1(k):
+    k = int(k)
+    if k < 1: k = 1
+    if k % 2 == 0: k += 1
+    return k
+
+class TemplateModel:
+    """
+    Tudo o que só depende do template + máscara, calculado 1x (ao carregar)
+    e reutilizado em todas as folhas: gray/blur, LAB, Canny, black-hat do
+    booster, top/black-hat por SE, estatísticas MS-SSIM por escala, ROI seguro
+    e anel de borda.
+
+    Os intermédios dependentes de parâmetros (SE, erosão, kernels MS-SSIM)
+    ficam em cache por valor, por isso mudar parâmetros no Tuner não obriga a
+    reconstruir o modelo.
+
+    tpl/mask: o template e a máscara tal como seriam passados a detect_defects.
+    apply_mask=True aplica a máscara ao template (bitwise_and) uma única vez.
+    """
+
+    def __init__(self, tpl, mask, apply_mask=False):
+        self.mask_bin = _binary_mask(mask)
+        if apply_mask:
+            tpl = cv2.bitwise_and(tpl, tpl, mask=self.mask_bin)
+        self.tpl = tpl
+        self.shape = tpl.shape[:2]
+        self._cache = {}
+
+    def _cached(self, key, fn):
+        v = self._cache.get(key)
+        if v is None:
+            v = fn()
+            self._cache[key] = v
+        return v
+
+    # --- intermédios fixos ---
+    @cached_property
+    def gray(self):
+        return cv2.cvtColor(self.tpl, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def blur(self):
+        return cv2.GaussianBlur(self.gray, (5, 5), 0)
+
+    @cached_property
+    def lab(self):
+        return cv2.cvtColor(self.tpl, cv2.COLOR_BGR2LAB)
+
+    @cached_property
+    def edges(self):
+        return cv2.Canny(self.blur, 60, 180)
+
+    @cached_property
+    def micro_blackhat(self):
+        bh_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))
+        return cv2.morphologyEx(self.blur, cv2.MORPH_BLACKHAT, bh_kernel)
+
+    # --- intermédios dependentes de parâmetros (cache por valor) ---
+    def safe_roi(self, roi_erode_px):
+        try:
+            erode_px = max(0, int(roi_erode_px))
+        except Exception:
+            erode_px = 0
+        k_safe = 2 * erode_px + 1
+        return self._cached(("safe_roi", k_safe), lambda: cv2.erode(
+            self.mask_bin, np.ones((k_safe, k_safe), np.uint8), 1))
+
+    def percentile_engine(self, roi_erode_px, bins=4096):
+        """Motor de percentis por histograma sobre o ROI seguro (partilhado por todos os mapas)."""
+        roi = self.safe_roi(roi_erode_px)
+        return self._cached(("pct_engine", id(roi), int(bins)), lambda: RoiPercentileEngine(roi, bins=bins))
+
+    def border_ring(self, border_w):
+        k_border = 2 * int(border_w) + 1
+
+        def _ring():
+            inner = cv2.erode(self.mask_bin, np.ones((k_border, k_border), np.uint8), 1)
+            return cv2.subtract(self.mask_bin, inner)
+        return self._cached(("border_ring", k_border), _ring)
+
+    def tophat(self, se):
+        se = _odd_at_least_1(se)
+        k = cv2.getStructuringElement(cv2.MORPH_RECT, (se, se))
+        return self._cached(("tophat", se), lambda: cv2.morphologyEx(self.blur, cv2.MORPH_TOPHAT, k))
+
+    def blackhat(self, se):
+        se = _odd_at_least_1(se)
+        k = cv2.getStructuringElement(cv2.MORPH_RECT, (se, se))
+        return self._cached(("blackhat", se), lambda: cv2.morphologyEx(self.blur, cv2.MORPH_BLACKHAT, k))
+
+    def ms_ssim_pyramid(self, scales, ksizes, sigmas, backend="reference"):
+        key = ("msssim", backend, tuple(scales), tuple(int(k) for k in ksizes), tuple(float(s) for s in sigmas))
+        return self._cached(key, lambda: _ms_ssim_template_pyramid(
+            self.blur, scales=scales, ksizes=ksizes, sigmas=sigmas, backend=backend))
+
+    def screen(self, scale):
+        """(gray, LAB, máscara) reduzidos por `scale` (INTER_AREA) para o rastreio grosseiro."""
+        def _screen():
+            small = cv2.resize(self.tpl, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            mask = cv2.resize(self.mask_bin, (small.shape[1], small.shape[0]), interpolation=cv2.INTER_NEAREST)
+            return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), cv2.cvtColor(small, cv2.COLOR_BGR2LAB), mask
+        return self._cached(("screen", float(scale)), _screen)
+
+    @cached_property
+    def lab_stats(self):
+        """[(média, desvio)] por canal LAB dentro da máscara (normalização fotométrica)."""
+        m = self.mask_bin > 0
+        lab = self.lab.astype(np.float32)
+        return [(float(np.mean(lab[:, :, c][m])), float(np.std(lab[:, :, c][m])))
+                for c in range(3)]
+
+# ---------------------------
+# Detect Defects (+ Simple mode)
+# ---------------------------
+
+def detect_defects(tpl, aligned, mask, *args, **kwargs):
     """
     Detecta defeitos comparando template vs imagem alinhada.
+    Versão compatível: constrói um TemplateModel a cada chamada. Para folhas
+    sucessivas com o mesmo template, usar detect_defects_with_model.
+    Argumentos e retornos: ver detect_defects_with_model.
+    """
+    return detect_defects_with_model(TemplateModel(tpl, mask), aligned, *args, **kwargs)
+
+def detect_defects_with_model(model, aligned,
+                              dark_threshold, bright_threshold,
+                              dark_morph_kernel_size, dark_morph_iterations,
+                              bright_morph_kernel_size, bright_morph_iterations,
+                              min_defect_area,
+                              dark_gradient_threshold,
+                              blue_threshold, red_threshold,
+                              # ---- MS-SSIM ----
+                              use_ms_ssim=True,
+                              msssim_percentile=99.5,
+                              msssim_weight=0.5,
+                              msssim_kernel_sizes=(7,5,3),
+                              msssim_sigmas=(1.5,1.0,0.8),
+                              msssim_morph_kernel_size=3,
+                              msssim_morph_iterations=1,
+                              ssim_backend="reference",  # "reference" ou "separable"
+                              # ---- percentis: "exact" (np.percentile) ou "histogram" ----
+                              percentile_method="exact",
+                              percentile_bins=4096,
+                              # ---- Overexposure handling ----
+                              ignore_overexposed=False,
+                              # ---- ROI/border handling ----
+                              roi_erode_px=2,
+                              suppress_border_width_px=0,
+                              # ---- NOVO: Morfologia L (top/black) ----
+                              use_morph_maps=True,
+                              th_top_percentile=99.5,
+                              th_black_percentile=99.5,
+                              se_top=9,
+                              se_black=9,
+                              # ---- NOVO: Δa/Δb (cor) ----
+                              use_color_delta=True,
+                              color_metric="maxab",  # "maxab" ou "l2ab"
+                              color_percentile=99.0,
+                              # ---- NOVO: Fusão final ----
+                              fusion_mode="or",      # "or" ou "weighted"
+                              w_struct=0.50,
+                              w_top=0.25,
+                              w_black=0.15,
+                              w_color=0.10,
+                              fused_percentile=99.5,
+                              # ---- retornos opcionais ----
+                              return_msssim=False,
+                              return_fusion=False,
+                              outputs=None,
+                              # ---- execução em tiles (modo Full) ----
+                              tiles=None,
+                              workers=None,
+                              verbose=True,
+                              workspace=None):
+
+    """
+    Detecta defeitos comparando o template pré-computado (TemplateModel) vs imagem alinhada.
     Retorna (compatível):
         final_defect_mask, filtered_contours,
         darker_mask_filtered, brighter_mask, blue_mask, red_mask,
         [opcional msssim_mask], [opcional fused_mask]
+
+    outputs: nomes das saídas pedidas (ver DETECTOR_OUTPUTS: "final", "contours",
+    "table", "dark", "bright", "blue", "red", "msssim", "fusion"); devolve {nome: valor} e
+    só corre os estágios necessários para essas saídas (modo Full). Sem outputs
+    mantém o tuplo compatível acima.
+    tiles: nº de faixas horizontais para execução paralela (modo Full). Cada faixa
+    leva um halo do tamanho do maior alcance local (Gaussiana, SE, janela MS-SSIM,
+    morfologia); normalizações e percentis continuam globais sobre a ROI inteira,
+    por isso o resultado é igual ao da execução sem tiles.
+    workers: nº de threads (por omissão = tiles).
+    verbose=False silencia o print do tempo (p.ex. chamadas por lata).
+    workspace: DetectorWorkspace (models.workspace) com os buffers do tamanho da ROI
+    reutilizados entre chamadas (modo Full); as máscaras devolvidas passam a ser
+    vistas desses buffers, válidas até à chamada seguinte.
+    ssim_backend: implementação do MS-SSIM ("reference" = filter2D 2D original;
+    "separable" = models.ssim_fast, mais rápido, desvio medido no benchmark).
+    percentile_method: "exact" (np.percentile sobre img[roi]) ou "histogram"
+    (models.percentile_hist: um histograma de percentile_bins classes por mapa,
+    somado por faixa; erro do limiar < 1/percentile_bins).
     """
     start_time = time.perf_counter()
 
-    # --- garantir máscara binária 0/255 ---
-    if mask.dtype != np.uint8:
-        mask_bin = (mask > 0).astype(np.uint8) * 255
-    else:
-        mask_bin = mask
-    # ROI seguro: afasta borda configurável
-    try:
-        erode_px = max(0, int(roi_erode_px))
-    except Exception:
-        erode_px = 0
-    k_safe = 2 * erode_px + 1
-    if k_safe < 1:
-        k_safe = 1
-    safe_roi = cv2.erode(mask_bin, np.ones((k_safe, k_safe), np.uint8), 1)
+    # --- máscara binária 0/255 e ROI seguro (afasta borda configurável) vêm do modelo ---
+    mask_bin = model.mask_bin
+    safe_roi = model.safe_roi(roi_erode_px)
 
     # --- Grayscale base (sem CLAHE) + desfoque leve ---
-    t_gray = cv2.cvtColor(tpl,     cv2.COLOR_BGR2GRAY)
-    a_gray = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY)
-    t_blur = cv2.GaussianBlur(t_gray, (5, 5), 0)
-    a_blur = cv2.GaussianBlur(a_gray, (5, 5), 0)
+    ws = workspace if workspace is not None else DetectorWorkspace()
+    H, W = safe_roi.shape[:2]
+    sp = PROFILER.start("detect.blur")
+    a_gray = cv2.cvtColor(aligned, cv2.COLOR_BGR2GRAY, dst=ws.get("a_gray", (H, W)))
+    t_blur = model.blur
+    a_blur = cv2.GaussianBlur(a_gray, (5, 5), 0, dst=ws.get("a_blur", (H, W)))
+    sp.stop()
+
+    # --- LAB (para cor): o do template vem do modelo; o da imagem só se algum estágio o usar ---
+    tpl_lab     = model.lab
 
-    # --- LAB (para cor) ---
-    tpl_lab     = cv2.cvtColor(tpl,     cv2.COLOR_BGR2LAB)
-    aligned_lab = cv2.cvtColor(aligned, cv2.COLOR_BGR2LAB)
+    legacy = outputs is None
+    if legacy:
+        outputs = LEGACY_OUTPUTS + (("msssim",) if return_msssim else ()) + (("fusion",) if return_fusion else ())
+
+    msssim_scales = (1.0, 0.5, 0.25)
+    msssim_weights = (0.5, 0.3, 0.2)
+    _check_ssim_backend(ssim_backend)
+    pct_engine = None
+    if str(percentile_method).lower() == "histogram":
+        pct_engine = model.percentile_engine(roi_erode_px, percentile_bins)
 
     # =========================
     #        SIMPLE MODE
@@ -217,10 +776,12 @@ def detect_defects(tpl, aligned, mask,
         # 1) DSSIM(L)
         dssim = _ms_ssim_map(
             t_blur, a_blur,
-            scales=(1.0, 0.5, 0.25),
+            scales=msssim_scales,
             ksizes=msssim_kernel_sizes,
             sigmas=msssim_sigmas,
-            weights=(0.5, 0.3, 0.2)
+            weights=(0.5, 0.3, 0.2),
+            x_pyramid=model.ms_ssim_pyramid(msssim_scales, msssim_kernel_sizes, msssim_sigmas, ssim_backend),
+            backend=ssim_backend
         )  # [0..1]
 
         # 2) Residual passa-banda (DoG no |tpl - img|)
@@ -235,6 +796,7 @@ def detect_defects(tpl, aligned, mask,
         rband = _norm01(rband)
 
         # 3) Cor (Δa/Δb) normalizada
+        aligned_lab = cv2.cvtColor(aligned, cv2.COLOR_BGR2LAB)
         da = cv2.absdiff(aligned_lab[:,:,1], tpl_lab[:,:,1]).astype(np.float32)
         db = cv2.absdiff(aligned_lab[:,:,2], tpl_lab[:,:,2]).astype(np.float32)
         color = np.maximum(da, db)  # mais simples e rápido
@@ -245,222 +807,421 @@ def detect_defects(tpl, aligned, mask,
         score = _norm01(score)
 
         # 5) Binarização por percentil + morfologia leve
-        mask_bin_simple = _percentile_bin(score, safe_roi, SIMPLE_PERCENTILE)
+        if pct_engine is not None:
+            mask_bin_simple = _threshold_bin(score, safe_roi, pct_engine.percentile(score, SIMPLE_PERCENTILE))
+        else:
+            mask_bin_simple = _percentile_bin(score, safe_roi, SIMPLE_PERCENTILE)
         mask_bin_simple = _apply_morphological_ops(mask_bin_simple, SIMPLE_MORPH_KERNEL, SIMPLE_MORPH_ITERS)
 
         final_defect_mask = cv2.bitwise_and(mask_bin_simple, mask_bin_simple, mask=safe_roi)
 
         # --- Contornos + filtros geométricos ---
-        contours, _ = cv2.findContours(final_defect_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        filtered_contours = []
-        min_area = max(1, int(min_defect_area))
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            if area < min_area:
-                continue
-            peri = max(cv2.arcLength(cnt, True), 1e-6)
-            circularity = 4.0 * np.pi * area / (peri * peri)
-            if circularity < 0.02 and area > 150:
-                continue
-            filtered_contours.append(cnt)
-
-        print(f"[Simple] detect_defects took {time.perf_counter() - start_time:.4f} seconds")
+        filtered_contours = table = None
+        if "contours" in outputs:
+            contours, _ = cv2.findContours(final_defect_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            filtered_contours = _filter_contours(contours, min_defect_area)
+        if "table" in outputs:
+            table = build_defect_table(final_defect_mask, None, min_defect_area)
+
+        if verbose:
+            print(f"[Simple] detect_defects took {time.perf_counter() - start_time:.4f} seconds")
 
         # preencher retornos “antigos” como zeros (compat)
         zeros = np.zeros_like(safe_roi, dtype=np.uint8)
-        ret = [final_defect_mask, filtered_contours, zeros, zeros, zeros, zeros]
-        # (opcional) devolver score binário/contínuo para debug: usa return_fusion/return_msssim se quiseres
-        if return_msssim:
+        msssim_mask = None
+        if "msssim" in outputs:
             # threshold por percentil no dssim para manter semântico
-            msssim_mask = _percentile_bin(dssim, safe_roi, max(98.5, min(99.9, SIMPLE_PERCENTILE)))
-            ret.append(msssim_mask)
-        if return_fusion:
-            ret.append(mask_bin_simple)
-        return tuple(ret)
+            ms_pct = max(98.5, min(99.9, SIMPLE_PERCENTILE))
+            if pct_engine is not None:
+                msssim_mask = _threshold_bin(dssim, safe_roi, pct_engine.percentile(dssim, ms_pct))
+            else:
+                msssim_mask = _percentile_bin(dssim, safe_roi, ms_pct)
+        return _detector_result(outputs, legacy, {
+            "final": final_defect_mask, "contours": filtered_contours, "table": table,
+            "dark": zeros, "bright": zeros, "blue": zeros, "red": zeros,
+            "msssim": msssim_mask, "fusion": mask_bin_simple,
+        })
 
     # =========================
     #          FULL MODE
     # =========================
+    # Fases:
+    #   0) global: a_blur/LAB/Canny (a histerese do Canny não é local) e escalas
+    #      grosseiras do MS-SSIM (resize/upsample dependem do tamanho total)
+    #   1) por faixa c/ halo: mapas locais (diffs, gates, morfologia, top/black-hat, SSIM s=1)
+    #   2) global: min/max e percentis sobre a ROI INTEIRA
+    #   3) por faixa c/ halo: binarização, morfologia MS-SSIM, fusão e máscara final
+    #   4) global: contornos na máscara costurada
+    # Sem tiles (tiles<=1) tudo corre como uma única faixa sem halo.
+    # Só correm os estágios do grafo necessários para as saídas pedidas (run).
+    run = set(_resolve_stages(_full_stage_graph(
+        bright_threshold, blue_threshold, red_threshold, use_ms_ssim, msssim_weight,
+        use_morph_maps, use_color_delta, fusion_mode, w_struct, w_top, w_black, w_color,
+        ignore_overexposed), outputs))
+    n_tiles = max(1, int(tiles or 1))
+    pool = _tile_pool(workers or n_tiles) if n_tiles > 1 else None
+    fusion_weighted = str(fusion_mode).lower() == "weighted"
+    use_msssim_mask = use_ms_ssim and msssim_weight > 0
+    run_ms = use_ms_ssim and "msssim" in run     # saída "msssim" com use_ms_ssim=False -> None
+    run_top = "tophat" in run
+    run_black = "blackhat" in run
+    run_delta = "color_delta" in run
 
-    # --- Overexposed mask (optional) ---
-    over_mask = None
-    if ignore_overexposed:
-        hsv = cv2.cvtColor(aligned, cv2.COLOR_BGR2HSV)
-        v = hsv[:, :, 2]
-        _, over_mask = cv2.threshold(v, 250, 255, cv2.THRESH_BINARY)
-        over_mask = cv2.bitwise_and(over_mask, safe_roi)
-        over_mask = cv2.dilate(over_mask, np.ones((3, 3), np.uint8), iterations=1)
-
-    # --- Edges finas (para cores) ---
-    edges_tpl = cv2.Canny(t_blur,  60, 180)
-    edges_aln = cv2.Canny(a_blur,  60, 180)
-    edge_mask_thin = cv2.bitwise_or(edges_tpl, edges_aln)
-    edge_mask_thin = cv2.erode(edge_mask_thin, np.ones((3,3), np.uint8), 1)
-    edge_mask_inv_thin = cv2.bitwise_not(edge_mask_thin)
+    se_top_eff = _odd_at_least_1(se_top)
+    se_black_eff = _odd_at_least_1(se_black)
+    k_top = cv2.getStructuringElement(cv2.MORPH_RECT, (se_top_eff, se_top_eff))
+    k_blk = cv2.getStructuringElement(cv2.MORPH_RECT, (se_black_eff, se_black_eff))
 
-    # --- Darker: diff em grayscale liso (tpl - aligned) ---
-    diff_dark_raw = cv2.subtract(t_blur, a_blur)         # ponto preto => positivo
-    _, darker_mask = cv2.threshold(diff_dark_raw, int(dark_threshold), 255, cv2.THRESH_BINARY)
+    # --- 0) LAB (cor) e edges finas (para cores): Canny global ---
+    if "lab" in run:
+        sp = PROFILER.start("detect.lab")
+        aligned_lab = cv2.cvtColor(aligned, cv2.COLOR_BGR2LAB, dst=ws.get("a_lab", (H, W, 3)))
+        sp.stop()
+    if "edges" in run:
+        sp = PROFILER.start("detect.edges")
+        edges_tpl = model.edges
+        edges_aln = cv2.Canny(a_blur,  60, 180, edges=ws.get("a_edges", (H, W)))
+        edge_mask_thin = cv2.bitwise_or(edges_tpl, edges_aln, dst=ws.get("edge_mask_thin", (H, W)))
+        sp.stop()
 
-    # Gate de gradiente (em grayscale liso)
-    morph_grad = cv2.morphologyEx(a_blur, cv2.MORPH_GRADIENT, np.ones((5, 5), np.uint8))
-    if dark_gradient_threshold <= 0:
-        gradient_mask_dark = mask_bin.copy()
-    else:
-        _, gradient_mask_dark = cv2.threshold(morph_grad, int(dark_gradient_threshold), 255, cv2.THRESH_BINARY)
+    # --- 0) MS-SSIM: escalas < 1 globais; s=1 fica para as faixas ---
+    ms_pyr = None
+    ms_coarse = {}
+    ms_fast_coarse = (None, 0.0)
+    if run_ms:
+        sp = PROFILER.start("detect.msssim_coarse")
+        ms_pyr = model.ms_ssim_pyramid(msssim_scales, msssim_kernel_sizes, msssim_sigmas, ssim_backend)
+        a_blur_f = ws.get("a_blur_f", (H, W), np.float32)
+        np.copyto(a_blur_f, a_blur)
+        tmp = ws.scratch("ms_coarse_tmp") if workspace is not None else no_scratch
+        if ssim_backend != "reference":
+            ms_fast_coarse = ssim_fast.ms_ssim_coarse(a_blur_f, ms_pyr, msssim_scales, msssim_kernel_sizes,
+                                                      msssim_sigmas, msssim_weights, tmp=tmp,
+                                                      out=ws.get("ms_coarse", (H, W), np.float32))
+        else:
+            for i, (sc, ksz, sg) in enumerate(zip(msssim_scales, msssim_kernel_sizes, msssim_sigmas)):
+                if sc != 1.0:
+                    ms_coarse[i] = _ms_ssim_scale(None, a_blur_f, sc, ksz, sg, (W, H), x_level=ms_pyr[i],
+                                                  tmp=scoped(tmp, i),
+                                                  dst=ws.get(("ms_coarse", i), (H, W), np.float32))
+        sp.stop()
 
-    darker_mask_filtered = cv2.bitwise_and(darker_mask, gradient_mask_dark)
+    # --- halo da fase 1: maior alcance entre as cadeias locais ---
+    halo1 = 0
+    if pool is not None:
+        halo1 = max(
+            1,                                                              # dilate over_mask 3x3
+            1 + _morph_ops_reach(bright_morph_kernel_size, bright_morph_iterations),  # erode arestas + morfologia cor
+            6 + _morph_ops_reach(dark_morph_kernel_size, dark_morph_iterations),      # black-hat 7x7 / gradiente 5x5 + morfologia
+            2 * (se_top_eff // 2) if run_top else 0,
+            2 * (se_black_eff // 2) if run_black else 0,
+            max((int(k) // 2 for sc, k in zip(msssim_scales, msssim_kernel_sizes) if sc == 1.0), default=0)
+            if run_ms else 0,
+        )
 
-    # --- Booster para micro-pontos escuros (blackhat) ---
-    bh_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))  # testa 5/7/9
-    bh_tpl = cv2.morphologyEx(t_blur, cv2.MORPH_BLACKHAT, bh_kernel)
-    bh_cur = cv2.morphologyEx(a_blur, cv2.MORPH_BLACKHAT, bh_kernel)
-    bh_diff = cv2.subtract(bh_cur, bh_tpl)
-    bh_th = max(6, min(20, int(dark_threshold)//2 + 6))  # auto-ajuste simples
-    _, micro_dark = cv2.threshold(bh_diff, bh_th, 255, cv2.THRESH_BINARY)
-    micro_dark = cv2.bitwise_and(micro_dark, mask_bin)
-    darker_mask_filtered = cv2.bitwise_or(darker_mask_filtered, micro_dark)
-
-    # --- LAB para cores (com supressão leve de arestas finas) ---
-    diff_bright_yellow_raw = cv2.subtract(aligned_lab[:, :, 2], tpl_lab[:, :, 2])  # +amarelo
-    _, brighter_mask = cv2.threshold(diff_bright_yellow_raw, int(bright_threshold), 255, cv2.THRESH_BINARY)
-    brighter_mask = cv2.bitwise_and(brighter_mask, edge_mask_inv_thin)
-
-    diff_blue_raw = cv2.subtract(tpl_lab[:, :, 2], aligned_lab[:, :, 2])           # +azul
-    _, blue_mask = cv2.threshold(diff_blue_raw, int(blue_threshold), 255, cv2.THRESH_BINARY)
-    blue_mask = cv2.bitwise_and(blue_mask, edge_mask_inv_thin)
-
-    diff_red_raw = cv2.subtract(aligned_lab[:, :, 1], tpl_lab[:, :, 1])            # +vermelho
-    _, red_mask = cv2.threshold(diff_red_raw, int(red_threshold), 255, cv2.THRESH_BINARY)
-    red_mask = cv2.bitwise_and(red_mask, edge_mask_inv_thin)
-
-    # --- MS-SSIM (opcional) no canal L ---
-    msssim_mask = None
-    if use_ms_ssim:
-        dssim = _ms_ssim_map(
-            t_blur, a_blur,
-            scales=(1.0, 0.5, 0.25),
-            ksizes=msssim_kernel_sizes,
-            sigmas=msssim_sigmas,
-            weights=(0.5, 0.3, 0.2)
-        )  # float32 [0..1]
-
-        roi_vals = dssim[safe_roi.astype(bool)]
-        thr = np.percentile(roi_vals, float(msssim_percentile)) if roi_vals.size > 0 else 1.0
-        msssim_mask = (dssim >= thr).astype(np.uint8) * 255
-        msssim_mask = cv2.bitwise_and(msssim_mask, safe_roi)
-        msssim_mask = _apply_morphological_ops(msssim_mask, msssim_morph_kernel_size, msssim_morph_iterations)
-
-    # --- Morfologia (permitindo k<=1 ou it=0 = sem morfologia) ---
-    darker_clean   = _apply_morphological_ops(darker_mask_filtered, dark_morph_kernel_size,   dark_morph_iterations)
-    brighter_clean = _apply_morphological_ops(brighter_mask,         bright_morph_kernel_size, bright_morph_iterations)
-    blue_clean     = _apply_morphological_ops(blue_mask,             bright_morph_kernel_size, bright_morph_iterations)
-    red_clean      = _apply_morphological_ops(red_mask,              bright_morph_kernel_size, bright_morph_iterations)
-
-    # --- Combinar mapas antigos (retro-compat) ---
-    combined = cv2.bitwise_or(darker_clean, brighter_clean)
-    combined = cv2.bitwise_or(combined,     blue_clean)
-    combined = cv2.bitwise_or(combined,     red_clean)
-
-    if use_ms_ssim and msssim_mask is not None and msssim_weight > 0:
-        combined = cv2.bitwise_or(combined, msssim_mask)
-
-    # ---- NOVO: Top-hat / Black-hat em L ----
-    top_score = np.zeros_like(a_blur, dtype=np.float32)
-    black_score = np.zeros_like(a_blur, dtype=np.float32)
-    top_bin = np.zeros_like(safe_roi, dtype=np.uint8)
-    black_bin = np.zeros_like(safe_roi, dtype=np.uint8)
-
-    if use_morph_maps:
-        se_top_eff = int(se_top)
-        se_black_eff = int(se_black)
-        if se_top_eff < 1: se_top_eff = 1
-        if se_black_eff < 1: se_black_eff = 1
-        if se_top_eff % 2 == 0: se_top_eff += 1
-        if se_black_eff % 2 == 0: se_black_eff += 1
-        k_top = cv2.getStructuringElement(cv2.MORPH_RECT, (se_top_eff, se_top_eff))
-        k_blk = cv2.getStructuringElement(cv2.MORPH_RECT, (se_black_eff, se_black_eff))
-
-        th_tpl = cv2.morphologyEx(t_blur, cv2.MORPH_TOPHAT, k_top)
-        th_cur = cv2.morphologyEx(a_blur, cv2.MORPH_TOPHAT, k_top)
-        th_diff = cv2.subtract(th_cur, th_tpl)
-        top_score = _norm01(th_diff)
-        top_bin = _percentile_bin(top_score, safe_roi, th_top_percentile)
-
-        bh_tpl2 = cv2.morphologyEx(t_blur, cv2.MORPH_BLACKHAT, k_blk)
-        bh_cur2 = cv2.morphologyEx(a_blur, cv2.MORPH_BLACKHAT, k_blk)
-        bh_diff2 = cv2.subtract(bh_cur2, bh_tpl2)
-        black_score = _norm01(bh_diff2)
-        black_bin = _percentile_bin(black_score, safe_roi, th_black_percentile)
-
-    # ---- NOVO: Δa/Δb (cor) ----
-    color_score = np.zeros_like(a_blur, dtype=np.float32)
-    color_bin = np.zeros_like(safe_roi, dtype=np.uint8)
-
-    if use_color_delta:
-        da = np.abs(aligned_lab[:, :, 1].astype(np.float32) - tpl_lab[:, :, 1].astype(np.float32))
-        db = np.abs(aligned_lab[:, :, 2].astype(np.float32) - tpl_lab[:, :, 2].astype(np.float32))
-        if str(color_metric).lower() == "l2ab":
-            color_score = np.sqrt(da*da + db*db)
-        else:
-            color_score = np.maximum(da, db)
-        color_score = _norm01(color_score)
-        color_bin = _percentile_bin(color_score, safe_roi, color_percentile)
-
-    # ---- Fusão final (novo) ----
-    struct_score = dssim if (use_ms_ssim and 'dssim' in locals()) else np.zeros_like(a_blur, dtype=np.float32)
-
-    if str(fusion_mode).lower() == "weighted":
-        fused_score = (w_struct * struct_score +
-                       w_top    * top_score +
-                       w_black  * black_score +
-                       w_color  * color_score)
-        fused_score = _norm01(fused_score)
-        fused_mask = _percentile_bin(fused_score, safe_roi, fused_percentile)
+    # buffers completos do workspace (cada faixa escreve só as suas linhas do núcleo);
+    # máscaras de cor de um estágio que não corre ficam a zeros (retorno compatível)
+    over_mask = ws.get("over_mask", (H, W)) if "overexposed" in run else None
+    darker_mask_filtered = ws.get("darker", (H, W)) if "dark" in run else None
+    color_off = "color" not in run
+    brighter_mask = ws.get("brighter", (H, W), zero=color_off)
+    blue_mask = ws.get("blue", (H, W), zero=color_off)
+    red_mask = ws.get("red", (H, W), zero=color_off)
+    combined = ws.get("combined", (H, W)) if "classic" in run else None
+    th_diff = ws.get("th_diff", (H, W)) if run_top else None
+    bh_diff2 = ws.get("bh_diff", (H, W)) if run_black else None
+    color_raw = ws.get("color_raw", (H, W), np.float32) if run_delta else None
+    dssim = ws.get("dssim", (H, W), np.float32) if run_ms else None
+
+    def _local_maps(strip):
+        y0, y1, hy0, hy1 = strip
+        c0, c1 = y0 - hy0, y1 - hy0          # núcleo dentro da janela
+        win = slice(hy0, hy1)
+        t_b, a_b = t_blur[win], a_blur[win]
+        sroi, mbin = safe_roi[win], mask_bin[win]
+        aln = aligned[win]
+        stats = {}
+        direct = hy0 == y0 and hy1 == y1      # sem halo: os estágios escrevem direto nos buffers
+        # temporários da faixa (nome pela faixa: estáveis entre folhas); os estágios
+        # correm em sequência e partilham-nos. Sem workspace externo ficam temporários.
+        tmp = ws.scratch("strip", hy0) if workspace is not None else no_scratch
+        win_shape = (hy1 - hy0, W)
+
+        def _dst(buf, name):
+            return buf[y0:y1] if direct else tmp(name, win_shape)
+
+        def _keep(buf, res):
+            if not direct:
+                buf[y0:y1] = res[c0:c1]
+
+        # --- Overexposed mask (optional) ---
+        if over_mask is not None:
+            sp = PROFILER.start("detect.overexposed")
+            _keep(over_mask, _overexposed_mask(aln, sroi, dst=_dst(over_mask, "over"), tmp=tmp))
+            sp.stop()
+
+        if "dark" in run:
+            sp = PROFILER.start("detect.dark")
+            darker_f = _dark_mask(t_b, a_b, mbin, model.micro_blackhat[win], dark_threshold, dark_gradient_threshold,
+                                  dst=_dst(darker_mask_filtered, "darker"), tmp=tmp)
+            _keep(darker_mask_filtered, darker_f)
+            sp.stop()
+        if "color" in run:
+            sp = PROFILER.start("detect.color")
+            edge_inv = _thin_edges_inv(edge_mask_thin[win], dst=tmp("edge_inv", win_shape))
+            brighter, blue, red = _color_masks(tpl_lab[win], aligned_lab[win], edge_inv,
+                                               bright_threshold, blue_threshold, red_threshold,
+                                               dst=(_dst(brighter_mask, "brighter"), _dst(blue_mask, "blue"),
+                                                    _dst(red_mask, "red")), tmp=tmp)
+            _keep(brighter_mask, brighter)
+            _keep(blue_mask, blue)
+            _keep(red_mask, red)
+            sp.stop()
+        if "classic" in run:
+            sp = PROFILER.start("detect.classic")
+            if "color" in run:
+                comb = _classic_combined(darker_f, brighter, blue, red,
+                                         dark_morph_kernel_size, dark_morph_iterations,
+                                         bright_morph_kernel_size, bright_morph_iterations,
+                                         dst=_dst(combined, "combined"), tmp=tmp)
+            else:
+                # cores desligadas (limiares >= 255): só o darker conta
+                comb = _apply_morphological_ops(darker_f, dark_morph_kernel_size, dark_morph_iterations,
+                                                dst=_dst(combined, "combined"))
+            _keep(combined, comb)
+            sp.stop()
+
+        # ---- Top-hat / Black-hat em L (score bruto; normalização é global) ----
+        if run_top:
+            sp = PROFILER.start("detect.tophat")
+            th = _hat_diff(a_b, model.tophat(se_top_eff)[win], k_top, cv2.MORPH_TOPHAT, dst=_dst(th_diff, "hat"))
+            _keep(th_diff, th)
+            th = th_diff[y0:y1]
+            stats["top"] = (th.min(), th.max())
+            sp.stop()
+        if run_black:
+            sp = PROFILER.start("detect.blackhat")
+            bh2 = _hat_diff(a_b, model.blackhat(se_black_eff)[win], k_blk, cv2.MORPH_BLACKHAT,
+                            dst=_dst(bh_diff2, "hat"))
+            _keep(bh_diff2, bh2)
+            bh2 = bh_diff2[y0:y1]
+            stats["black"] = (bh2.min(), bh2.max())
+            sp.stop()
+
+        # ---- Δa/Δb (cor, bruto) ----
+        if run_delta:
+            sp = PROFILER.start("detect.color_delta")
+            core = slice(y0, y1)
+            cr = _color_delta_raw(tpl_lab[core], aligned_lab[core], color_metric, out=color_raw[core],
+                                  tmp=scoped(tmp, "core"))
+            stats["color"] = (cr.min(), cr.max())
+            sp.stop()
+
+        # ---- MS-SSIM: escala 1 na janela + escalas grosseiras globais ----
+        sp = PROFILER.start("detect.msssim") if run_ms else None
+        if run_ms and ssim_backend != "reference":
+            xs, (mu_x, sig_x) = ms_pyr[0]
+            ssim1 = ssim_fast.ssim_map(xs[win], a_blur_f[win], ksize=msssim_kernel_sizes[0], sigma=msssim_sigmas[0],
+                                       x_stats=(mu_x[win], sig_x[win]), tmp=scoped(tmp, "ssim"))
+            coarse_acc, coarse_wsum = ms_fast_coarse
+            ssim_fast.combine_dssim(
+                ssim1[c0:c1], msssim_weights[0],
+                None if coarse_acc is None else coarse_acc[y0:y1], coarse_wsum, out=dssim[y0:y1])
+        elif run_ms:
+            maps = []
+            for i, (sc, ksz, sg) in enumerate(zip(msssim_scales, msssim_kernel_sizes, msssim_sigmas)):
+                if sc == 1.0:
+                    xs, (mu_x, sig_x) = ms_pyr[i]
+                    x_level = (xs[win], (mu_x[win], sig_x[win]))
+                    ssim1 = _ms_ssim_scale(None, a_blur_f[hy0:hy1], sc, ksz, sg,
+                                           (W, hy1 - hy0), x_level=x_level, tmp=scoped(tmp, "ssim"))
+                    maps.append(ssim1[c0:c1])
+                else:
+                    maps.append(ms_coarse[i][y0:y1])
+            _ms_ssim_combine(maps, msssim_weights, out=dssim[y0:y1], tmp=tmp("ms_tmp", (y1 - y0, W), np.float32))
+        if sp is not None:
+            sp.stop()
+        return stats
+
+    strips1 = _split_strips(H, n_tiles, halo1)
+    stats1 = _run_strips(_local_maps, strips1, pool)
+
+    # --- 2) reduções globais (min/max por faixa -> globais) ---
+    def _global_range(key):
+        mins = [np.float32(st[key][0]) for st in stats1]
+        maxs = [np.float32(st[key][1]) for st in stats1]
+        return min(mins), max(maxs)
+
+    strips0 = _split_strips(H, n_tiles, 0)
+    top_score = black_score = color_score = None
+    if run_top:
+        top_rng = _global_range("top")
+        top_score = ws.get("top_score", (H, W), np.float32)
+    if run_black:
+        black_rng = _global_range("black")
+        black_score = ws.get("black_score", (H, W), np.float32)
+    if run_delta:
+        color_rng = _global_range("color")
+        color_score = ws.get("color_score", (H, W), np.float32)
+
+    def _normalize(strip):
+        y0, y1 = strip[0], strip[1]
+        if run_top:
+            _norm01_range(th_diff[y0:y1], *top_rng, out=top_score[y0:y1])
+        if run_black:
+            _norm01_range(bh_diff2[y0:y1], *black_rng, out=black_score[y0:y1])
+        if run_delta:
+            _norm01_range(color_raw[y0:y1], *color_rng, out=color_score[y0:y1])
+
+    if run_top or run_black or run_delta:
+        sp = PROFILER.start("detect.normalize")
+        _run_strips(_normalize, strips0, pool)
+        sp.stop()
+
+    # ---- Fusão ponderada: score bruto por faixa, normalização global ----
+    # (um mapa com peso 0 não corre: contribuiria 0 * score = 0)
+    fused_score = None
+    if fusion_weighted and "fusion" in run:
+        sp = PROFILER.start("detect.fusion")
+        fused_raw = ws.get("fused_raw", (H, W), np.float32)
+        fuse_tmp = ws.get("fuse_tmp", (H, W), np.float32)
+
+        def _fuse(strip):
+            # w_struct*st + w_top*tp + w_black*bk + w_color*cl, pela mesma ordem, in-place
+            # (um mapa que não corre contribuiria w*0 = 0)
+            y0, y1 = strip[0], strip[1]
+            fr, tmp = fused_raw[y0:y1], fuse_tmp[y0:y1]
+            fr.fill(0)
+            for on, w, sc in ((run_ms, w_struct, dssim), (run_top, w_top, top_score),
+                              (run_black, w_black, black_score), (run_delta, w_color, color_score)):
+                if on:
+                    np.multiply(sc[y0:y1], w, out=tmp)
+                    fr += tmp
+            return fr.min(), fr.max()
+
+        fr_stats = _run_strips(_fuse, strips0, pool)
+        fused_rng = (min(np.float32(a) for a, _ in fr_stats), max(np.float32(b) for _, b in fr_stats))
+        fused_score = ws.get("fused_score", (H, W), np.float32)
+
+        def _normalize_fused(strip):
+            y0, y1 = strip[0], strip[1]
+            _norm01_range(fused_raw[y0:y1], *fused_rng, out=fused_score[y0:y1])
+
+        _run_strips(_normalize_fused, strips0, pool)
+        sp.stop()
+
+    # ---- percentis sobre a ROI inteira ----
+    pct_tmp = ws.scratch("pct") if workspace is not None else no_scratch
+
+    def _pct(score, pct):
+        if pct_engine is None:
+            return _roi_percentile(score, safe_roi, pct, tmp=pct_tmp)
+        # histogramas por faixa (em paralelo) somados = histograma da ROI inteira
+        hists = _run_strips(lambda st: pct_engine.histogram(score, slice(st[0], st[1])), strips0, pool)
+        return pct_engine.thresholds(np.sum(hists, axis=0), [pct])[0]
+
+    sp = PROFILER.start("detect.percentiles")
+    thr_ms = thr_top = thr_black = thr_color = thr_fused = None
+    if run_ms:
+        thr_ms = _pct(dssim, msssim_percentile)
+        if thr_ms is None:
+            thr_ms = 1.0
+    if fusion_weighted:
+        if "fusion" in run:
+            thr_fused = _pct(fused_score, fused_percentile)
     else:
-        fused_mask = np.zeros_like(safe_roi, dtype=np.uint8)
-        if use_morph_maps:
-            fused_mask = cv2.bitwise_or(fused_mask, top_bin)
-            fused_mask = cv2.bitwise_or(fused_mask, black_bin)
-        if use_color_delta:
-            fused_mask = cv2.bitwise_or(fused_mask, color_bin)
-        if use_ms_ssim and msssim_mask is not None and msssim_weight > 0:
-            fused_mask = cv2.bitwise_or(fused_mask, msssim_mask)
-
-    combined_fused = cv2.bitwise_or(combined, fused_mask)
-    final_defect_mask = cv2.bitwise_and(combined_fused, combined_fused, mask=safe_roi)
-    # opcional: suprimir anel de borda da máscara (para evitar falsos na fronteira)
+        if run_top:
+            thr_top = _pct(top_score, th_top_percentile)
+        if run_black:
+            thr_black = _pct(black_score, th_black_percentile)
+        if run_delta:
+            thr_color = _pct(color_score, color_percentile)
+    sp.stop()
+
+    # --- 3) binarização + fusão + máscara final por faixa ---
+    halo3 = _morph_ops_reach(msssim_morph_kernel_size, msssim_morph_iterations) if (pool is not None and run_ms) else 0
+    msssim_mask = ws.get("msssim_mask", (H, W)) if run_ms else None
+    fused_mask = ws.get("fused_mask", (H, W)) if "fusion" in run else None
+    final_defect_mask = ws.get("final", (H, W)) if "final" in run else None
     try:
         border_w = max(0, int(suppress_border_width_px))
     except Exception:
         border_w = 0
-    if border_w > 0:
-        k_border = 2 * border_w + 1
-        inner = cv2.erode(mask_bin, np.ones((k_border, k_border), np.uint8), 1)
-        border_ring = cv2.subtract(mask_bin, inner)
-        final_defect_mask = cv2.bitwise_and(final_defect_mask, cv2.bitwise_not(border_ring))
-    if ignore_overexposed and over_mask is not None:
-        final_defect_mask = cv2.bitwise_and(final_defect_mask, cv2.bitwise_not(over_mask))
-
-    # --- Contornos + filtros geométricos ---
-    contours, _ = cv2.findContours(final_defect_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    filtered_contours = []
-    min_area = max(1, int(min_defect_area))
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if area < min_area:
-            continue
-        peri = max(cv2.arcLength(cnt, True), 1e-6)
-        circularity = 4.0 * np.pi * area / (peri * peri)
-        if circularity < 0.02 and area > 150:
-            continue
-        filtered_contours.append(cnt)
+    border_ring = model.border_ring(border_w) if border_w > 0 else None
+
+    def _finalize(strip):
+        y0, y1, hy0, hy1 = strip
+        c0, c1 = y0 - hy0, y1 - hy0
+        core = slice(y0, y1)
+        sroi = safe_roi[core]
+        tmp = ws.scratch("finalize", hy0) if workspace is not None else no_scratch
+        core_shape = (y1 - y0, W)
+
+        ms_m = None
+        if run_ms:
+            win = slice(hy0, hy1)
+            ms_m = _threshold_bin(dssim[win], safe_roi[win], thr_ms, dst=tmp("ms_bin", (hy1 - hy0, W)))
+            if hy0 == y0 and hy1 == y1:
+                ms_m = _apply_morphological_ops(ms_m, msssim_morph_kernel_size, msssim_morph_iterations,
+                                                dst=msssim_mask[core])
+            else:
+                ms_m = _apply_morphological_ops(ms_m, msssim_morph_kernel_size, msssim_morph_iterations,
+                                                dst=tmp("ms_morph", (hy1 - hy0, W)))
+                msssim_mask[core] = ms_m[c0:c1]
+            ms_m = msssim_mask[core]
+
+        if fused_mask is None:
+            return
+        fm = fused_mask[core]
+        if fusion_weighted:
+            _threshold_bin(fused_score[core], sroi, thr_fused, dst=fm)
+        else:
+            fm.fill(0)
+            for on, score, thr in ((run_top, top_score, thr_top), (run_black, black_score, thr_black),
+                                   (run_delta, color_score, thr_color)):
+                if on:
+                    cv2.bitwise_or(fm, _threshold_bin(score[core], sroi, thr, dst=tmp("u8", core_shape)), dst=fm)
+            if use_msssim_mask:
+                cv2.bitwise_or(fm, ms_m, dst=fm)
+
+        if final_defect_mask is None:
+            return
+        fin = cv2.bitwise_or(combined[core], fm, dst=final_defect_mask[core])
+        if use_msssim_mask:
+            cv2.bitwise_or(fin, ms_m, dst=fin)
+        # = bitwise_and(fin, fin, mask=sroi), mas no próprio buffer (com mask= o dst fora do ROI não é zerado)
+        cv2.bitwise_and(fin, cv2.compare(sroi, 0, cv2.CMP_NE, dst=tmp("u8", core_shape)), dst=fin)
+        # opcional: suprimir anel de borda da máscara (para evitar falsos na fronteira)
+        for off in (border_ring, over_mask):
+            if off is not None:
+                cv2.bitwise_and(fin, cv2.bitwise_not(off[core], dst=tmp("u8", core_shape)), dst=fin)
+
+    if run_ms or fused_mask is not None:
+        sp = PROFILER.start("detect.finalize")
+        _run_strips(_finalize, _split_strips(H, n_tiles, halo3), pool)
+        sp.stop()
+
+    # --- 4) Contornos + filtros geométricos (na máscara costurada) ---
+    filtered_contours = None
+    if "contours" in run:
+        sp = PROFILER.start("detect.contours")
+        contours, _ = cv2.findContours(final_defect_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        filtered_contours = _filter_contours(contours, min_defect_area)
+        sp.stop()
+    # tabela vetorizada (models.defect_table), tipo dominante pelas máscaras de tipo
+    table = None
+    if "table" in run:
+        sp = PROFILER.start("detect.table")
+        table = build_defect_table(final_defect_mask, {
+            "dark": darker_mask_filtered, "bright": brighter_mask, "blue": blue_mask, "red": red_mask,
+        }, min_defect_area)
+        sp.stop()
 
-    print(f"[Full] detect_defects took {time.perf_counter() - start_time:.4f} seconds")
-    ret = [final_defect_mask, filtered_contours,
-           darker_mask_filtered, brighter_mask, blue_mask, red_mask]
-    if return_msssim:
-        ret.append(msssim_mask)
-    if return_fusion:
-        ret.append(fused_mask)
-    return tuple(ret)
+    if verbose:
+        print(f"[Full] detect_defects took {time.perf_counter() - start_time:.4f} seconds"
+              + (f" ({len(strips1)} tiles)" if pool is not None else ""))
+    return _detector_result(outputs, legacy, {
+        "final": final_defect_mask, "contours": filtered_contours, "table": table,
+        "dark": darker_mask_filtered, "bright": brighter_mask, "blue": blue_mask, "red": red_mask,
+        "msssim": msssim_mask, "fusion": fused_mask,
+    })
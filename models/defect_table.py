@@ -0,0 +1,193 @@
+import cv2
+import numpy as np
+
+# ---------------------------
+# Tabela de defeitos vetorizada (struct-of-arrays)
+# ---------------------------
+# Um connectedComponentsWithStats sobre a máscara final dá, de uma vez, área,
+# bbox e centróide de todos os blobs (conectividade 8 = um blob por contorno
+# externo do findContours). O resto sai de bincounts pesados pelos rótulos:
+#   - tipo dominante: pixels de cada máscara de tipo dentro do blob;
+#   - lata: rótulo mais frequente de um mapa de latas (opcional; a área por
+#     lata sai depois de mais um bincount, area_per_can).
+# Os filtros são os do _filter_contours (área mínima; filamento = circularidade
+# < 0.02 com área > 150), com contourArea/arcLength do contorno externo
+# (findContours RETR_EXTERNAL + CHAIN_APPROX_SIMPLE, como no detetor): uma
+# linha de 1 px tem área de contorno 0, não o nº de pixels, e um anel de 1 px
+# conta o buraco. Só os blobs com (w-1)*(h-1) >= área mínima precisam do
+# contorno (o polígono passa pelos centros dos pixels da bbox); um blob dentro
+# do buraco de outro não tem contorno externo e fica de fora, como no
+# _filter_contours.
+
+DEFECT_TYPES = ("dark", "bright", "blue", "red")
+
+
+def _dominant_can(lab, cid, n):
+    """Lata mais frequente por rótulo (0..n-1; -1 sem lata): bincount sobre (rótulo, lata) achatados."""
+    cid = cid.astype(np.int64)
+    inside = cid > 0
+    can = np.full(n, -1, np.int32)
+    if not inside.any():
+        return can
+    n_cans = int(cid.max()) + 1
+    hist = np.bincount(lab[inside] * n_cans + cid[inside], minlength=n * n_cans).reshape(n, n_cans)
+    has = hist.sum(axis=1) > 0
+    can[has] = np.argmax(hist[has], axis=1)
+    return can
+
+
+def _project(pts, H):
+    """pts (N, 2) por H: matriz 3x3 (perspectiveTransform) ou função (N, 2) -> (N, 2)."""
+    if callable(H):
+        return np.asarray(H(pts), np.float64).reshape(-1, 2)
+    return cv2.perspectiveTransform(pts.reshape(-1, 1, 2), np.asarray(H, np.float64)).reshape(-1, 2)
+
+
+class DefectTable:
+    """Defeitos da máscara final, uma posição por blob em cada array (coords da máscara)."""
+
+    def __init__(self, labels, label, area, bbox, centroid, perimeter, contour_area, dtype, can):
+        self.labels = labels          # int32 (H, W): rótulo do connectedComponents (0 = fundo)
+        self.label = label            # (N,) rótulo de cada defeito em labels
+        self.area = area              # (N,) pixels
+        self.bbox = bbox              # (N, 4) x, y, w, h
+        self.centroid = centroid      # (N, 2) x, y
+        self.perimeter = perimeter    # (N,) cv2.arcLength do contorno externo
+        self.contour_area = contour_area  # (N,) cv2.contourArea do contorno externo
+        self.type = dtype             # (N,) índice em DEFECT_TYPES
+        self.can = can                # (N,) nº da lata (-1 = sem lata)
+
+    def __len__(self):
+        return int(self.label.shape[0])
+
+    @property
+    def circularity(self):
+        peri = np.maximum(self.perimeter.astype(np.float64), 1e-6)
+        return 4.0 * np.pi * self.contour_area / (peri * peri)
+
+    @property
+    def type_names(self):
+        return [DEFECT_TYPES[t] for t in self.type]
+
+    def select(self, keep):
+        """Sub-tabela com as linhas keep (máscara booleana ou índices)."""
+        return DefectTable(self.labels, self.label[keep], self.area[keep], self.bbox[keep],
+                           self.centroid[keep], self.perimeter[keep], self.contour_area[keep], self.type[keep],
+                           self.can[keep])
+
+    def with_cans(self, can_map):
+        """Mesma tabela com a coluna can a partir de um can_map uint8 (tabela feita sem mapa, p.ex. no detetor)."""
+        if len(self) == 0:
+            return self
+        x, y, w, h = (self.bbox[:, k] for k in range(4))
+        win = (slice(y.min(), (y + h).max()), slice(x.min(), (x + w).max()))
+        lab = self.labels[win].ravel()
+        fg = np.flatnonzero(lab)
+        can = _dominant_can(lab[fg], can_map[win].ravel()[fg], int(self.labels.max()) + 1)
+        return DefectTable(self.labels, self.label, self.area, self.bbox, self.centroid, self.perimeter,
+                           self.contour_area, self.type, can[self.label])
+
+    def area_per_can(self, minlength=0):
+        """Pixels de defeito por nº de lata (um bincount; índice = nº da lata, sem as de can -1)."""
+        has = self.can >= 0
+        return np.bincount(self.can[has], weights=self.area[has], minlength=minlength).astype(np.int64)
+
+    def circles(self, H=None, offset=(0, 0), min_radius=8.0):
+        """
+        Círculo que cobre cada bbox: (cx, cy, r) float64, com offset somado e, se H
+        for dado, reprojetados por H (3x3, ou função de pontos) numa só chamada.
+        """
+        x, y, w, h = (self.bbox[:, k].astype(np.float64) for k in range(4))
+        cx, cy = x + 0.5 * w + offset[0], y + 0.5 * h + offset[1]
+        r = np.maximum(0.5 * np.hypot(w, h), min_radius)
+        if H is None or len(self) == 0:
+            return cx, cy, r
+        pts = np.stack([np.stack([cx, cy], 1), np.stack([cx + r, cy], 1)])   # (2, N, 2): centro, centro + r
+        pts = _project(pts.reshape(-1, 2), H).reshape(2, -1, 2)
+        r_c = np.hypot(*(pts[1] - pts[0]).T)
+        return pts[0, :, 0], pts[0, :, 1], np.maximum(1.0, r_c)
+
+    def contours(self, H=None, offset=(0, 0)):
+        """
+        Contorno externo de cada defeito, pela ordem da tabela (um findContours só
+        sobre os blobs da tabela), com offset e reprojeção por H (3x3 ou função de
+        pontos) numa só chamada. Devolve lista de (K, 1, 2) int32.
+        """
+        if len(self) == 0:
+            return []
+        lut = np.zeros(int(self.labels.max()) + 1, np.uint8)
+        lut[self.label] = 255
+        contours, _ = cv2.findContours(lut[self.labels], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # um contorno externo por blob: o rótulo está no 1º ponto do contorno
+        first = np.array([c[0, 0] for c in contours], np.int64)
+        row_of_label = np.full(lut.shape[0], -1, np.int64)
+        row_of_label[self.label] = np.arange(len(self))
+        order = np.argsort(row_of_label[self.labels[first[:, 1], first[:, 0]]], kind="stable")
+        contours = [contours[i] for i in order]
+        sizes = [len(c) for c in contours]
+        pts = np.concatenate(contours).reshape(-1, 1, 2).astype(np.float64) + offset
+        if H is not None:
+            pts = _project(pts.reshape(-1, 2), H).reshape(-1, 1, 2)
+        pts = pts.astype(np.int32)
+        return np.split(pts, np.cumsum(sizes)[:-1])
+
+
+def build_defect_table(final_mask, type_masks=None, min_defect_area=0, can_map=None):
+    """
+    DefectTable dos blobs de final_mask (uint8), já com os filtros geométricos do
+    detetor (área mínima e rejeição de filamentos).
+    type_masks: {tipo: máscara uint8} com tipos de DEFECT_TYPES (tipos em falta contam 0;
+    empate -> o primeiro de DEFECT_TYPES, como o max() do _show_defects).
+    can_map: uint8 (H, W) com o nº da lata por pixel (0 = sem lata; can_layout.can_label_map), opcional.
+    """
+    # CCL_GRANA (BBDT, conectividade 8): no Pi/x86 a 1 thread é ~3x mais rápido que o default
+    n, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+        final_mask, 8, cv2.CV_32S, cv2.CCL_GRANA)
+    area = stats[1:, cv2.CC_STAT_AREA]
+    bbox = stats[1:, :4]
+
+    # só os pixels do primeiro plano entram nos bincounts (rótulo de cada um),
+    # dentro da bbox que cobre todos os blobs
+    if n <= 1:
+        empty = np.zeros(0, np.int32)
+        return DefectTable(labels, empty, empty, np.zeros((0, 4), np.int32), np.zeros((0, 2)),
+                           np.zeros(0), np.zeros(0), np.zeros(0, np.int8), empty)
+    # +1 px: o findContours não pode ver o corte como primeiro plano
+    H, W = final_mask.shape[:2]
+    ux0, uy0 = max(0, bbox[:, 0].min() - 1), max(0, bbox[:, 1].min() - 1)
+    ux1 = min(W, (bbox[:, 0] + bbox[:, 2]).max() + 1)
+    uy1 = min(H, (bbox[:, 1] + bbox[:, 3]).max() + 1)
+    win = (slice(uy0, uy1), slice(ux0, ux1))
+    fm = final_mask[win]
+    fg = np.flatnonzero(fm)
+    lab = labels[win].ravel()[fg]
+
+    # contourArea/arcLength por contorno externo, só nos blobs que podem passar a área mínima
+    min_area = max(1, int(min_defect_area))
+    perimeter, contour_area = np.zeros(n - 1), np.zeros(n - 1)
+    candidate = (bbox[:, 2] - 1) * (bbox[:, 3] - 1) >= min_area
+    if candidate.any():
+        lab_win = labels[win]
+        contours, _ = cv2.findContours(fm, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for c in contours:
+            k = lab_win[c[0, 0, 1], c[0, 0, 0]] - 1
+            if candidate[k]:
+                contour_area[k] = cv2.contourArea(c)
+                perimeter[k] = cv2.arcLength(c, True)
+
+    counts = np.zeros((len(DEFECT_TYPES), n - 1), np.int64)
+    for k, name in enumerate(DEFECT_TYPES):
+        m = None if type_masks is None else type_masks.get(name)
+        if m is not None:
+            counts[k] = np.bincount(lab[m[win].ravel()[fg] > 0], minlength=n)[1:]
+    dtype = np.argmax(counts, axis=0).astype(np.int8)
+
+    can = np.full(n - 1, -1, np.int32)
+    if can_map is not None:
+        can = _dominant_can(lab, can_map[win].ravel()[fg], n)[1:]
+
+    table = DefectTable(labels, np.arange(1, n, dtype=np.int32), area, bbox, centroids[1:],
+                        perimeter, contour_area, dtype, can)
+    keep = contour_area >= min_area
+    keep &= ~((table.circularity < 0.02) & (contour_area > 150))
+    return table.select(keep)
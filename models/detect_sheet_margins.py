@@ -45,3 +45,163 @@ def detect_folha_bordas(aligned_img, config_path="config/config_detect_borda.jso
 
     print(f"Coordenadas da folha salvas em {save_path}: {coords}")
     return coords
+
+
+# ---------------------------
+# Cantos da folha (quad a baixa resolução + refinamento subpíxel)
+# ---------------------------
+# 1) Quad grosseiro: imagem reduzida (scale), Otsu nas duas polaridades; a
+#    folha é a maior componente que não toca na borda da imagem, aproximada
+#    a 4 vértices (approxPolyDP).
+# 2) Refinamento: em cada lado, perfis perpendiculares na imagem completa
+#    (um remap por lado); o bordo é o máximo do gradiente do perfil com
+#    interpolação parabólica (só com a polaridade folha/tapete do lado); recta
+#    por cv2.fitLine (Huber, depois L2 só com os pontos a <= 2 px) e cantos =
+#    interseções das rectas vizinhas.
+# 3) Fiabilidade: quad convexo, área dentro de [min_area_frac, 0.98] da
+#    imagem, ângulos internos a <= max_angle_dev graus de 90, preenchimento
+#    do contorno >= 0.95, RMS das rectas <= max_line_rms px e cantos
+#    refinados a <= max_corner_shift px dos grosseiros.
+
+def _order_corners(pts):
+    """4 pontos (x, y) em ordem horária a partir do canto superior esquerdo."""
+    pts = np.asarray(pts, np.float64).reshape(4, 2)
+    c = pts.mean(axis=0)
+    pts = pts[np.argsort(np.arctan2(pts[:, 1] - c[1], pts[:, 0] - c[0]))]
+    start = int(np.argmin(pts.sum(axis=1)))
+    return np.roll(pts, -start, axis=0)
+
+
+def _quad_angles(quad):
+    """Ângulos internos (graus) do quad ordenado."""
+    out = []
+    for i in range(4):
+        a, b, c = quad[i - 1], quad[i], quad[(i + 1) % 4]
+        v1, v2 = a - b, c - b
+        cosang = np.dot(v1, v2) / max(1e-9, np.linalg.norm(v1) * np.linalg.norm(v2))
+        out.append(np.degrees(np.arccos(np.clip(cosang, -1.0, 1.0))))
+    return np.array(out)
+
+
+def detect_sheet_quad(img, scale=0.125, min_area_frac=0.2):
+    """
+    Quad grosseiro da folha em coords da imagem completa (4x2 float64, ordem
+    horária desde o canto superior esquerdo) e o preenchimento do contorno;
+    (None, 0.0) se não houver candidato.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (5, 5), 0)
+    h, w = small.shape
+    _, th = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    best, best_area = None, min_area_frac * h * w
+    for binary in (th, cv2.bitwise_not(th)):
+        binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for cnt in contours:
+            x, y, cw, ch = cv2.boundingRect(cnt)
+            if x <= 0 or y <= 0 or x + cw >= w or y + ch >= h:
+                continue   # toca na borda: fundo/tapete, não a folha
+            area = cv2.contourArea(cnt)
+            if area > best_area:
+                best, best_area = cnt, area
+    if best is None:
+        return None, 0.0
+    approx = cv2.approxPolyDP(best, 0.02 * cv2.arcLength(best, True), True)
+    if len(approx) != 4:
+        return None, 0.0
+    quad = _order_corners((approx.reshape(4, 2) + 0.5) / scale - 0.5)
+    fill = best_area / max(1e-9, cv2.contourArea(approx))
+    return quad, float(fill)
+
+
+def refine_sheet_corners(gray, quad, half_width=24, samples=64, min_grad=8.0):
+    """
+    Cantos subpíxel a partir do quad grosseiro (ver detect_sheet_quad).
+    Devolve (cantos 4x2, RMS máximo das rectas em px) ou (None, inf).
+    """
+    gray = gray.astype(np.float32) if gray.dtype != np.float32 else gray
+    offsets = np.arange(-half_width, half_width + 1, dtype=np.float32)
+    lines, worst_rms = [], 0.0
+    for i in range(4):
+        p0, p1 = quad[i], quad[(i + 1) % 4]
+        d = (p1 - p0) / max(1e-9, np.linalg.norm(p1 - p0))
+        n = np.array([-d[1], d[0]])
+        t = np.linspace(0.1, 0.9, samples)[:, None]                # evita os cantos
+        base = p0 + t * (p1 - p0)                                  # (samples, 2)
+        map_x = (base[:, 0:1] + offsets[None, :] * n[0]).astype(np.float32)
+        map_y = (base[:, 1:2] + offsets[None, :] * n[1]).astype(np.float32)
+        prof = cv2.remap(gray, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        # n aponta para dentro (ordem horária): polaridade do bordo folha/tapete do lado inteiro,
+        # para não agarrar arestas da impressão com o sinal contrário
+        diff = np.diff(prof, axis=1)                               # bordo entre amostras k e k+1
+        polarity = 1.0 if np.median(prof[:, -3:]) >= np.median(prof[:, :3]) else -1.0
+        grad = np.maximum(diff * polarity, 0.0)
+        k = np.clip(np.argmax(grad, axis=1), 1, grad.shape[1] - 2)
+        rows = np.arange(samples)
+        g0, g1, g2 = grad[rows, k - 1], grad[rows, k], grad[rows, k + 1]
+        den = g0 - 2 * g1 + g2
+        delta = np.where(np.abs(den) > 1e-6, 0.5 * (g0 - g2) / np.where(den == 0, 1, den), 0.0)
+        s = offsets[0] + k + 0.5 + np.clip(delta, -0.5, 0.5)
+        good = g1 >= min_grad
+        if good.sum() < samples // 4:
+            return None, float("inf")
+        pts = (base + s[:, None] * n)[good].astype(np.float32)
+        vx, vy, x0, y0 = cv2.fitLine(pts, cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+        # 2ª passagem só com os pontos a <= 2 px da 1ª recta (arestas da impressão ficam de fora)
+        dist = np.abs((pts[:, 0] - x0) * vy - (pts[:, 1] - y0) * vx)
+        inl = dist <= 2.0
+        if inl.sum() < max(4, good.sum() // 2):
+            return None, float("inf")
+        pts = pts[inl]
+        vx, vy, x0, y0 = cv2.fitLine(pts, cv2.DIST_L2, 0, 0.01, 0.01).ravel()
+        dist = np.abs((pts[:, 0] - x0) * vy - (pts[:, 1] - y0) * vx)
+        worst_rms = max(worst_rms, float(np.sqrt(np.mean(dist ** 2))))
+        lines.append((np.array([x0, y0], np.float64), np.array([vx, vy], np.float64)))
+
+    corners = []
+    for i in range(4):
+        (a, u), (b, v) = lines[i - 1], lines[i]               # lado anterior e lado seguinte ao canto i
+        m = np.array([u, -v]).T
+        if abs(np.linalg.det(m)) < 1e-9:
+            return None, float("inf")
+        t_u = np.linalg.solve(m, b - a)[0]
+        corners.append(a + t_u * u)
+    return np.array(corners), worst_rms
+
+
+def sheet_corners(img, scale=0.125, min_area_frac=0.2, max_angle_dev=20.0,
+                  max_line_rms=1.5, max_corner_shift=None):
+    """
+    Cantos da folha com verificação de fiabilidade. Devolve (cantos 4x2 ou None,
+    info) com info = {"ok", "reason", "fill", "line_rms", "corner_shift"}.
+    """
+    info = {"ok": False, "reason": "", "fill": 0.0, "line_rms": None, "corner_shift": None}
+    quad, fill = detect_sheet_quad(img, scale, min_area_frac)
+    info["fill"] = fill
+    if quad is None:
+        info["reason"] = "sem quad"
+        return None, info
+    h, w = img.shape[:2]
+    area = cv2.contourArea(quad.astype(np.float32))
+    if not cv2.isContourConvex(quad.astype(np.float32)) or area > 0.98 * h * w or fill < 0.95:
+        info["reason"] = "quad inválido"
+        return None, info
+    if np.max(np.abs(_quad_angles(quad) - 90.0)) > max_angle_dev:
+        info["reason"] = "ângulos"
+        return None, info
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    half_width = int(np.ceil(3.0 / scale))                     # ~3 px de erro na escala reduzida
+    corners, rms = refine_sheet_corners(gray, quad, half_width=half_width)
+    info["line_rms"] = rms
+    if corners is None or rms > max_line_rms:
+        info["reason"] = "rectas"
+        return None, info
+    shift = float(np.max(np.linalg.norm(corners - quad, axis=1)))
+    info["corner_shift"] = shift
+    if shift > (max_corner_shift if max_corner_shift is not None else 2.0 * half_width):
+        info["reason"] = "cantos"
+        return None, info
+    info["ok"] = True
+    return corners, info
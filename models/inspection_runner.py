@@ -0,0 +1,907 @@
+import itertools
+import time
+
+import cv2
+import numpy as np
+
+from config.utils import load_params
+from models.align_image import AlignmentEngine, alignment_decision, alignment_report
+from models.can_detector import (
+    build_can_regions, can_regions_pad, detect_defects_per_can, estimate_can_offsets, sheet_thresholds,
+)
+from models.can_layout import can_label_map, load_can_layout
+from models.coarse_fine import detect_defects_coarse_to_fine
+from models.defect_detector import TemplateModel, detect_defects_with_model, SSIM_BACKENDS
+from models.defect_table import build_defect_table
+from models.lens_calibration import load_lens_model
+from models.workspace import DetectorWorkspace
+from utils.pipeline import DROP_POLICIES, SheetPipeline
+from utils.profiler import PROFILER
+from utils.reject_output import FAILSAFE_VERDICTS, OUTPUT_MODES, open_reject_output
+from utils.sheet_telemetry import SHEET_TELEMETRY_PATH, append_sheet_telemetry, sheet_telemetry_row
+from utils.trigger import TRIGGER_EDGES, LatencyStats
+
+# ---------------------------
+# Inspeção sem GUI (InspectionRunner)
+# ---------------------------
+# Tudo o que a inspeção de uma folha precisa, sem PySide6: template + máscara,
+# parâmetros (config/inspection_params.json), AlignmentEngine, TemplateModel,
+# layout das latas e os estágios captura -> alinhamento -> deteção ->
+# classificação -> render. Uma folha é um dict que passa pelos estágios; a
+# fonte de frames (utils/frame_sources.py: câmara, pasta vigiada ou lista
+# gravada) dá o item (wait) e o frame (read, no estágio de captura).
+#
+# A InspectionWindow é um consumidor: cria o runner com a CameraSource, corre
+# os estágios no SheetPipeline do runner e trata finish() na thread da GUI. O
+# run() faz o mesmo sem ecrã (e é o benchmark de ponta a ponta da linha). Os
+# estágios só leem o estado do runner; o que produzem vai no dict da folha.
+
+PARAMS_PATH = "config/inspection_params.json"
+FORMA_BASE_PATH = "data/mask/forma_base.json"
+INSTANCIAS_PATH = "data/mask/instancias_poligonos.txt"
+
+
+def sheet_verdict(sheet):
+    """
+    Veredicto de uma folha concluída: {"seq", "name", "decision", "ok", "defects",
+    "cans_with_defects", "can_ids", "can_area", "total_ms", "trigger_latency_ms", "output",
+    "deadline_slack_ms"} (can_area: {nº da lata: pixels de defeito}).
+    """
+    can_ids = sorted(sheet.get("can_ids", ()))
+    return {
+        "seq": sheet["seq"],
+        "name": sheet.get("name"),
+        "decision": sheet["decision"],
+        "ok": sheet["decision"] != "reject" and not sheet["defect_data"],
+        "defects": None if sheet["skip"] else len(sheet["defect_data"]),
+        "cans_with_defects": None if sheet["skip"] else len(can_ids),
+        "can_ids": can_ids,
+        "can_area": sheet.get("can_area", {}),
+        "total_ms": sheet.get("total_ms"),
+        "trigger_latency_ms": sheet.get("trigger_latency_ms"),
+        "output": sheet.get("output"),
+        "deadline_slack_ms": sheet.get("deadline_slack_ms"),
+    }
+
+
+class InspectionRunner:
+    """Inspeção de folhas sem GUI: estágios, pipeline e veredictos a partir de uma fonte de frames."""
+
+    def __init__(self, template_path, mask_path, params_path=PARAMS_PATH, source=None, render=True,
+                 forma_base_path=FORMA_BASE_PATH, instancias_path=INSTANCIAS_PATH):
+        self.template_path = template_path
+        self.mask_path = mask_path
+        self.params_path = params_path
+        self.source = source
+        self.render = bool(render)
+        self._sheet_seq = itertools.count(1)   # new_sheet vem da GUI e da thread do GPIO
+        self.trigger_latency = LatencyStats()  # trigger -> frame capturado (ms)
+        self.reject_output = None              # saída para o desviador (start_reject_output)
+        self.last_sheet_telemetry = None  # última linha de telemetria (utils/sheet_telemetry.py)
+
+        try:
+            cv2.setUseOptimized(True)
+            cv2.setNumThreads(4)  # Pi 5 tem 4 cores
+        except Exception:
+            pass
+
+        # Carrega template e máscara
+        self.template_full = cv2.imread(template_path)
+        if self.template_full is None:
+            raise ValueError(f"Não foi possível ler o template: {template_path}")
+        self.mask_full = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        if self.mask_full is None:
+            raise ValueError(f"Não foi possível ler a máscara: {mask_path}")
+
+        # --- pré-computos do template (1x) ---
+        # features ORB do template em cache (ficheiro .npz ao lado do template)
+        # lente calibrada (config/camera_calibration.json, se existir): distorção + H num só remap
+        lens = load_lens_model(image_size=self.template_full.shape[1::-1])
+        if lens is None:
+            print("[INFO] Sem calibração da lente (python -m models.lens_calibration): só homografia.")
+        # mask_full: keypoints só na folha quando "feature_mask" está ativo na config de alinhamento
+        self.align_engine = AlignmentEngine(self.template_full, template_path=template_path, lens=lens,
+                                            mask=self.mask_full)
+
+        # Carrega parâmetros primeiro (para usar margem ROI)
+        self._load_params()
+
+        # ROI seguro (afasta borda da máscara) + cache bbox
+        k = 2 * max(0, int(self.roi_erode_px)) + 1
+        self.safe_mask = cv2.erode(self.mask_full, np.ones((k, k), np.uint8), 1)
+        nz = cv2.findNonZero(self.safe_mask)
+        x0, y0, w0, h0 = cv2.boundingRect(nz) if nz is not None else (0, 0, self.mask_full.shape[1], self.mask_full.shape[0])
+        self._mask_bbox = (x0, y0, w0, h0)
+        # o alinhamento só warpa a bbox da máscara (remap em cache quando a H se repete)
+        self.align_engine.set_roi(self._mask_bbox)
+
+        # Template da ROI já mascarado + pré-computos do detetor (1x)
+        self._build_template_model()
+
+        # Carrega forma_base e instâncias; mapa nº da lata por pixel na ROI do template
+        # (coords do detetor), com as lacunas entre latas preenchidas pela lata mais próxima
+        self.can_regions = []
+        self.can_map = None
+        try:
+            self.can_layout = load_can_layout(forma_base_path, instancias_path)
+            self.can_map = can_label_map(self.can_layout, self.template_model.shape, origin=(x0, y0))
+            print(f"[INFO] Carregadas {len(self.can_layout)} instâncias de latas.")
+        except Exception as e:
+            self.can_layout = []
+            print("❌ Erro ao carregar forma_base ou instâncias:", e)
+        self._build_can_regions()
+
+        if self.reject_output_enabled:
+            try:
+                self.start_reject_output()
+            except ValueError as e:
+                print("⚠️ Saída para o desviador desligada:", e)
+
+    def _load_params(self, params=None):
+        """Parâmetros da inspeção (config/inspection_params.json por omissão), com clamps."""
+        if params is None:
+            params = load_params(self.params_path) or {}
+
+        # ---- existentes ----
+        self.dark_threshold           = int(params.get("dark_threshold", 30))
+        self.bright_threshold         = int(params.get("bright_threshold", 30))
+        self.dark_morph_kernel_size   = int(params.get("dark_morph_kernel_size", 3))
+        self.dark_morph_iterations    = int(params.get("dark_morph_iterations", 1))
+        self.bright_morph_kernel_size = int(params.get("bright_morph_kernel_size", 3))
+        self.bright_morph_iterations  = int(params.get("bright_morph_iterations", 1))
+        # aceita detect_area (antigo) OU min_defect_area (novo)
+        self.min_defect_area          = int(params.get("detect_area", params.get("min_defect_area", 1)))
+        self.dark_gradient_threshold  = int(params.get("dark_gradient_threshold", 10))
+        self.blue_threshold           = int(params.get("blue_threshold", 25))
+        self.red_threshold            = int(params.get("red_threshold", 25))
+
+        # ---- NOVOS: MS-SSIM ----
+        self.use_ms_ssim              = bool(int(params.get("use_ms_ssim", 1)))
+        self.msssim_percentile        = float(params.get("msssim_percentile", 99.5))
+        self.msssim_weight            = float(params.get("msssim_weight", 0.5))
+
+        # kernels por escala (ímpares)
+        k1 = int(params.get("msssim_kernel_size_s1", 7))
+        k2 = int(params.get("msssim_kernel_size_s2", 5))
+        k3 = int(params.get("msssim_kernel_size_s3", 3))
+        if k1 < 1: k1 = 1
+        if k2 < 1: k2 = 1
+        if k3 < 1: k3 = 1
+        if k1 % 2 == 0: k1 += 1
+        if k2 % 2 == 0: k2 += 1
+        if k3 % 2 == 0: k3 += 1
+        self.msssim_kernel_sizes = (k1, k2, k3)
+
+        # sigmas por escala
+        s1 = float(params.get("msssim_sigma_s1", 1.5))
+        s2 = float(params.get("msssim_sigma_s2", 1.0))
+        s3 = float(params.get("msssim_sigma_s3", 0.8))
+        self.msssim_sigmas = (s1, s2, s3)
+
+        # morfologia do mapa MS-SSIM
+        self.msssim_morph_kernel_size = int(params.get("msssim_morph_kernel_size", 3))
+        if self.msssim_morph_kernel_size < 1:
+            self.msssim_morph_kernel_size = 1
+        if self.msssim_morph_kernel_size % 2 == 0:
+            self.msssim_morph_kernel_size += 1
+
+        self.msssim_morph_iterations  = int(params.get("msssim_morph_iterations", 1))
+        if self.msssim_morph_iterations < 0:
+            self.msssim_morph_iterations = 0
+
+        # backend do MS-SSIM: "reference" ou "separable" (ver models/ssim_fast.py)
+        self.ssim_backend = str(params.get("ssim_backend", "reference"))
+        if self.ssim_backend not in SSIM_BACKENDS:
+            self.ssim_backend = "reference"
+
+        # ---- NOVOS: Mapas morfológicos L, Δa/Δb e Fusão ----
+        self.use_morph_maps      = bool(int(params.get("use_morph_maps", 1)))
+        self.th_top_percentile   = float(params.get("th_top_percentile", 99.5))
+        self.th_black_percentile = float(params.get("th_black_percentile", 99.5))
+        # clamps percentis
+        self.th_top_percentile   = max(0.0, min(100.0, self.th_top_percentile))
+        self.th_black_percentile = max(0.0, min(100.0, self.th_black_percentile))
+
+        self.se_top   = int(params.get("se_top", 9))
+        self.se_black = int(params.get("se_black", 9))
+        if self.se_top < 1: self.se_top = 1
+        if self.se_black < 1: self.se_black = 1
+        if self.se_top % 2 == 0: self.se_top += 1
+        if self.se_black % 2 == 0: self.se_black += 1
+
+        self.use_color_delta  = bool(int(params.get("use_color_delta", 1)))
+        self.color_metric     = str(params.get("color_metric", "maxab"))
+        self.color_percentile = float(params.get("color_percentile", 99.0))
+        self.color_percentile = max(0.0, min(100.0, self.color_percentile))
+
+        self.fusion_mode = str(params.get("fusion_mode", "or"))
+        self.w_struct    = float(params.get("w_struct", 0.50))
+        self.w_top       = float(params.get("w_top", 0.25))
+        self.w_black     = float(params.get("w_black", 0.15))
+        self.w_color     = float(params.get("w_color", 0.10))
+        self.fused_percentile = float(params.get("fused_percentile", 99.5))
+        # clamps
+        for attr in ("w_struct","w_top","w_black","w_color"):
+            v = getattr(self, attr)
+            setattr(self, attr, max(0.0, min(1.0, float(v))))
+        self.fused_percentile = max(0.0, min(100.0, self.fused_percentile))
+
+        # "exact" (np.percentile, por omissão) ou "histogram" (ver models/percentile_hist.py:
+        # mais rápido, limiar com erro < 1 classe); escolhe-se no inspection_params.json
+        self.percentile_method = str(params.get("percentile_method", "exact"))
+        self.percentile_bins   = max(256, int(params.get("percentile_bins", 4096)))
+
+        # ---- ROI / Border handling ----
+        self.roi_erode_px = int(params.get("roi_erode_px", 2))
+        self.roi_erode_px = max(0, self.roi_erode_px)
+        self.suppress_border_width_px = int(params.get("suppress_border_width_px", 0))
+        self.suppress_border_width_px = max(0, self.suppress_border_width_px)
+        # overexposed handling
+        self.ignore_overexposed = bool(int(params.get("ignore_overexposed", params.get("ignore_overexposed", 0))))
+
+        # ---- Execução do detetor em faixas paralelas (Pi 5 tem 4 cores) ----
+        self.detect_tiles = max(1, int(params.get("detect_tiles", 4)))
+
+        # ---- Deteção por folha ("sheet"), por lata ("per_can", ver models/can_detector.py)
+        #      ou coarse-to-fine ("coarse", ver models/coarse_fine.py) ----
+        self.detect_mode = str(params.get("detect_mode", "sheet")).lower()
+        if self.detect_mode not in ("sheet", "per_can", "coarse"):
+            self.detect_mode = "sheet"
+        # coarse: tiles com score de rastreio >= margem (1.0 = limiares do modo Full) são refinados
+        self.coarse_screen_margin = max(0.0, float(params.get("coarse_screen_margin", 0.25)))
+        self.coarse_tile_size     = max(32, int(params.get("coarse_tile_size", 256)))
+        # per_can/coarse: limiares de percentil da folha numa amostra de 1 em cada N tiles
+        self.threshold_sample_stride = max(1, int(params.get("threshold_sample_stride", 4)))
+        # ... reutilizados em até N folhas seguintes enquanto a exposição (média BGR) variar <= drift níveis
+        self.threshold_max_reuse = max(0, int(params.get("threshold_max_reuse", 25)))
+        self.threshold_max_drift = max(0.0, float(params.get("threshold_max_drift", 2.0)))
+        # per_can: lata rejeitada na fase barata não corre os mapas caros
+        self.detect_verdict_only = bool(int(params.get("detect_verdict_only", 0)))
+        # per_can: translação local por lata (correlação de fase) depois da H global
+        self.can_refine = bool(int(params.get("can_refine", 0)))
+        self.can_refine_max_shift = max(0.0, float(params.get("can_refine_max_shift", 4.0)))
+        self.can_refine_min_response = max(0.0, float(params.get("can_refine_min_response", 0.1)))
+
+        # ---- Alinhamento não fiável: "reject" (folha rejeitada, sem deteção) ou
+        #      "inspect" (deteção sobre o recorte do frame sem alinhar, como antes) ----
+        self.align_on_unreliable = str(params.get("align_on_unreliable", "reject")).lower()
+        if self.align_on_unreliable not in ("reject", "inspect"):
+            self.align_on_unreliable = "reject"
+        # ---- Telemetria por folha (alinhamento + defeitos) em CSV ----
+        self.sheet_telemetry = bool(int(params.get("sheet_telemetry", 1)))
+        self.sheet_telemetry_path = str(params.get("sheet_telemetry_path", SHEET_TELEMETRY_PATH))
+
+        # ---- Pipeline (captura -> alinhamento -> deteção -> classificação -> render em threads) ----
+        #      "drop_newest" por omissão: um trigger com o pipeline cheio é descartado, a GUI não espera
+        self.pipeline_enabled = bool(int(params.get("pipeline_enabled", 1)))
+        self.pipeline_queue_size = max(1, int(params.get("pipeline_queue_size", 2)))
+        self.pipeline_drop_policy = str(params.get("pipeline_drop_policy", "drop_newest")).lower()
+        if self.pipeline_drop_policy not in DROP_POLICIES:
+            self.pipeline_drop_policy = "drop_newest"
+        self.pipeline_block_timeout_s = max(0.0, float(params.get("pipeline_block_timeout_s", 2.0)))
+        self.throughput_window_s = max(1.0, float(params.get("throughput_window_s", 60.0)))
+
+        # ---- Trigger da folha por interrupção (utils/trigger.py): sensor de folha em posição ----
+        self.trigger_enabled = bool(int(params.get("trigger_enabled", 1)))
+        pins = params.get("trigger_pins", [22])
+        self.trigger_pins = [int(p) for p in (pins if isinstance(pins, (list, tuple)) else [pins])]
+        self.trigger_edge = str(params.get("trigger_edge", "falling")).lower()   # pull-up: ativo a 0
+        if self.trigger_edge not in TRIGGER_EDGES:
+            self.trigger_edge = "falling"
+        self.trigger_debounce_ms = max(0.0, float(params.get("trigger_debounce_ms", 50.0)))
+        # "auto" (RPi.GPIO se existir) ou "fake" (FakeGPIO a reproduzir gpio_fake_schedule)
+        self.gpio_backend = str(params.get("gpio_backend", "auto")).lower()
+        self.gpio_fake_schedule = str(params.get("gpio_fake_schedule", ""))
+
+        # ---- Saída rejeitar/aceitar para o desviador (utils/reject_output.py) ----
+        #      prazo contado desde o trigger; sem veredicto a tempo sai o fail-safe
+        self.reject_output_enabled = bool(int(params.get("reject_output_enabled", 0)))
+        self.reject_pin = int(params.get("reject_pin", 17))
+        accept_pin = int(params.get("accept_pin", -1))
+        self.accept_pin = accept_pin if accept_pin >= 0 else None
+        self.reject_output_active_high = bool(int(params.get("reject_output_active_high", 1)))
+        self.reject_pulse_ms = max(1.0, float(params.get("reject_pulse_ms", 100.0)))
+        self.reject_deadline_ms = max(1.0, float(params.get("reject_deadline_ms", 1500.0)))
+        self.reject_failsafe = str(params.get("reject_failsafe", "reject")).lower()
+        if self.reject_failsafe not in FAILSAFE_VERDICTS:
+            self.reject_failsafe = "reject"
+        self.reject_output_mode = str(params.get("reject_output_mode", "asap")).lower()
+        if self.reject_output_mode not in OUTPUT_MODES:
+            self.reject_output_mode = "asap"
+
+        # ---- Profiler por estágio (utils/profiler.py) ----
+        if bool(int(params.get("profile_enabled", 0))):
+            PROFILER.enabled = True
+
+        # ---- clamps básicos úteis ----
+        self.dark_threshold   = max(0, min(255, self.dark_threshold))
+        self.bright_threshold = max(0, min(255, self.bright_threshold))
+        self.blue_threshold   = max(0, min(255, self.blue_threshold))
+        self.red_threshold    = max(0, min(255, self.red_threshold))
+
+        # kernels ímpares nas morfologias principais
+        if self.dark_morph_kernel_size < 1: self.dark_morph_kernel_size = 1
+        if self.dark_morph_kernel_size % 2 == 0: self.dark_morph_kernel_size += 1
+        if self.bright_morph_kernel_size < 1: self.bright_morph_kernel_size = 1
+        if self.bright_morph_kernel_size % 2 == 0: self.bright_morph_kernel_size += 1
+
+        self.dark_morph_iterations   = max(0, self.dark_morph_iterations)
+        self.bright_morph_iterations = max(0, self.bright_morph_iterations)
+
+        self.min_defect_area = max(1, self.min_defect_area)
+
+    def _build_template_model(self):
+        """Recorta template/máscara na bbox, aplica a máscara 1x e cria o TemplateModel do detetor."""
+        x0, y0, w0, h0 = self._mask_bbox
+        tpl_roi  = self.template_full[y0:y0+h0, x0:x0+w0]
+        mask_roi = self.safe_mask[y0:y0+h0, x0:x0+w0]
+        self.template_model = TemplateModel(tpl_roi, mask_roi, apply_mask=True)
+        self.tpl_masked_roi = self.template_model.tpl
+        # buffers do detetor reutilizados entre cliques (ROI fixa)
+        self.detector_workspace = DetectorWorkspace()
+
+    def _build_can_regions(self):
+        """Recortes por lata (modo per_can) a partir do TemplateModel da ROI e do layout."""
+        self.can_regions = []
+        if self.detect_mode != "per_can" or not getattr(self, "can_layout", None):
+            return
+        pad = can_regions_pad(self.msssim_kernel_sizes, self.se_top, self.se_black,
+                              self.dark_morph_kernel_size, self.dark_morph_iterations,
+                              self.bright_morph_kernel_size, self.bright_morph_iterations,
+                              self.msssim_morph_kernel_size, self.msssim_morph_iterations)
+        x0, y0 = self._mask_bbox[:2]
+        self.can_regions = build_can_regions(self.template_model, self.can_layout, origin=(x0, y0), pad=pad)
+        print(f"[INFO] {len(self.can_regions)} recortes de lata para deteção por lata.")
+
+    @staticmethod
+    def _normalize_lab_to_template(tpl_bgr, img_bgr, mask, tpl_stats=None):
+        """tpl_stats: [(média, desvio)] LAB do template já calculados (TemplateModel.lab_stats)."""
+        eps = 1e-6
+        if tpl_stats is None:
+            tpl_lab = cv2.cvtColor(tpl_bgr, cv2.COLOR_BGR2LAB).astype(np.float32)
+        img_lab = cv2.cvtColor(img_bgr,  cv2.COLOR_BGR2LAB).astype(np.float32)
+        m = (mask > 0)
+        norm = img_lab.copy()
+        for c in range(3):
+            if tpl_stats is None:
+                mu_t, sd_t = float(np.mean(tpl_lab[:,:,c][m])), float(np.std(tpl_lab[:,:,c][m]) + eps)
+            else:
+                mu_t, sd_t = tpl_stats[c][0], tpl_stats[c][1] + eps
+            mu_i, sd_i = float(np.mean(img_lab[:,:,c][m])), float(np.std(img_lab[:,:,c][m]) + eps)
+            gain = sd_t / sd_i
+            # clamp to avoid over/under-correction jitter
+            gain = max(0.8, min(1.25, gain))
+            bias = mu_t - gain * mu_i
+            bias = max(-10.0, min(10.0, bias))
+            norm[:,:,c] = gain * img_lab[:,:,c] + bias
+        norm = np.clip(norm, 0, 255).astype(np.uint8)
+        return cv2.cvtColor(norm, cv2.COLOR_LAB2BGR)
+
+    # ---------------------------
+    # Estágios
+    # ---------------------------
+    # Uma folha é um dict que passa por _stage_capture -> _stage_align ->
+    # _stage_detect -> _stage_classify -> _stage_render (fn(folha) -> folha, pela
+    # ordem de stages()) e fecha em finish(). Correm na mesma thread (inspect) ou
+    # uma thread por estágio (SheetPipeline de make_pipeline, filas limitadas):
+    # a folha N+1 é capturada enquanto a N ainda está na deteção. Os estágios só
+    # leem o estado do runner (parâmetros, template, layout); o que produzem vai
+    # no dict da folha. O warp inteiro para visualização (warp_full, fora dos
+    # estágios) só usa caches do AlignmentEngine que toleram acesso concorrente.
+
+    def stages(self):
+        return [("capture", self._stage_capture), ("align", self._stage_align),
+                ("detect", self._stage_detect), ("classify", self._stage_classify),
+                ("render", self._stage_render)]
+
+    def new_sheet(self, item=None, name=None):
+        """Folha vazia para o 1.º estágio: item da fonte (caminho / evento do trigger)."""
+        # com um evento de trigger (utils/trigger.py) o tempo total conta desde o flanco
+        t0 = item["t"] if isinstance(item, dict) and "t" in item else time.perf_counter()
+        sheet = {"seq": next(self._sheet_seq), "t0": t0, "item": item,
+                 "name": name if name is not None else (item if isinstance(item, str) else None)}
+        if self.reject_output is not None:
+            self.reject_output.arm(sheet["seq"], t0)    # prazo corre mesmo que a folha seja descartada
+        return sheet
+
+    def _stage_capture(self, sheet):
+        if self.source is None:
+            raise ValueError("InspectionRunner sem fonte de frames.")
+        sp = PROFILER.start("capture")
+        item = sheet["item"]
+        sheet["frame"] = self.source.read(item)
+        sp.stop()
+        if isinstance(item, dict) and "t" in item:
+            sheet["name"] = sheet["name"] or item.get("name")
+            sheet["trigger_latency_ms"] = (time.perf_counter() - item["t"]) * 1000.0
+            self.trigger_latency.add(sheet["trigger_latency_ms"])
+        return sheet
+
+    def _stage_align(self, sheet):
+        # 2) Alinhamento (current -> template): homografias recentes verificadas a baixa
+        #    resolução (correlação de fase por quadrante); ORB completo só se nenhuma servir.
+        #    O relatório de qualidade decide: reutilizar (cache), realinhar ou rejeitar.
+        frame = sheet["frame"]
+        try:
+            with PROFILER.span("align"):
+                aligned_roi, H, align_info = self.align_engine.align_verified(frame)
+        except Exception as e:
+            aligned_roi, H = None, None
+            align_info = {"source": "orb", "backend": None, "tried": 0, "time_ms": 0.0,
+                          "quality": alignment_report(None, frame.shape, error=str(e))}
+        decision = alignment_decision(align_info)
+        if align_info["source"] != "cache" and align_info["tried"]:
+            print(f"[Align] H recente rejeitada ({align_info['tried']} candidata(s)), realinhado")
+        print(f"[Align] {decision}: {align_info['source']} (backend {align_info['backend']}): "
+              f"{align_info['time_ms']:.1f} ms")
+        sheet.update(align_info=align_info, decision=decision, skip=False)
+        if decision == "reject":
+            print("⚠️ Alinhamento não fiável:", "; ".join(align_info["quality"]["reasons"]))
+            if self.align_on_unreliable == "reject":
+                sheet.update(aligned_roi=None, H=None, H_inv=None, skip=True)
+                return sheet
+            print("⚠️ Usando imagem original (align_on_unreliable = inspect)")
+            aligned_roi = None
+            H = np.eye(3, dtype=np.float32)
+
+        # Inversa: template -> current (para reprojetar desenho; com lente, função de pontos)
+        try:
+            H_inv = self.align_engine.template_to_current(H)
+        except Exception:
+            H_inv = np.eye(3, dtype=np.float32)
+        sheet.update(aligned_roi=aligned_roi, H=H, H_inv=H_inv)
+        return sheet
+
+    def _stage_detect(self, sheet):
+        if sheet["skip"]:
+            return sheet
+        # 3) ROI da máscara (bbox calculada 1x no arranque)
+        x0, y0, w0, h0 = self._mask_bbox
+
+        # 4) ROI no espaço do TEMPLATE (o alinhamento já devolve só a bbox da máscara)
+        #    (template mascarado + pré-computos vêm do TemplateModel, feitos 1x no arranque)
+        if getattr(self, "template_model", None) is None:
+            self._build_template_model()
+        if sheet["aligned_roi"] is None:   # alinhamento falhou: recorte do frame original
+            cur_roi = sheet["frame"][y0:y0+h0, x0:x0+w0]
+        else:
+            cur_roi = sheet["aligned_roi"]
+        mask_roi = self.template_model.mask_bin
+
+        # Normalização fotométrica sempre aplicada para estabilidade
+        sp = PROFILER.start("lab_normalize")
+        cur_masked_roi = cv2.bitwise_and(cur_roi, cur_roi, mask=mask_roi)
+        cur_masked_roi = self._normalize_lab_to_template(
+            self.tpl_masked_roi, cur_masked_roi, mask_roi, tpl_stats=self.template_model.lab_stats)
+        sp.stop()
+
+        # 5) Deteção de defeitos (em coords do TEMPLATE/ROI)
+        det_args = (
+            self.dark_threshold, self.bright_threshold,
+            self.dark_morph_kernel_size,  self.dark_morph_iterations,
+            self.bright_morph_kernel_size, self.bright_morph_iterations,
+            self.min_defect_area, self.dark_gradient_threshold,
+            self.blue_threshold, self.red_threshold,
+        )
+        det_kwargs = dict(
+            # ---- MS-SSIM ----
+            use_ms_ssim=self.use_ms_ssim,
+            msssim_percentile=self.msssim_percentile,
+            msssim_weight=self.msssim_weight,
+            msssim_kernel_sizes=self.msssim_kernel_sizes,
+            msssim_sigmas=self.msssim_sigmas,
+            msssim_morph_kernel_size=self.msssim_morph_kernel_size,
+            msssim_morph_iterations=self.msssim_morph_iterations,
+            ssim_backend=self.ssim_backend,
+            # ---- ROI / Borders ----
+            roi_erode_px=self.roi_erode_px,
+            suppress_border_width_px=self.suppress_border_width_px,
+            # ---- Overexposed ----
+            ignore_overexposed=self.ignore_overexposed,
+            # ---- Mapas adicionais + Fusão ----
+            use_morph_maps=self.use_morph_maps,
+            th_top_percentile=self.th_top_percentile,
+            th_black_percentile=self.th_black_percentile,
+            se_top=self.se_top,
+            se_black=self.se_black,
+            use_color_delta=self.use_color_delta,
+            color_metric=self.color_metric,
+            color_percentile=self.color_percentile,
+            fusion_mode=self.fusion_mode,
+            w_struct=self.w_struct,
+            w_top=self.w_top,
+            w_black=self.w_black,
+            w_color=self.w_color,
+            fused_percentile=self.fused_percentile,
+            percentile_method=self.percentile_method,
+            percentile_bins=self.percentile_bins,
+        )
+        table = None
+        sp = PROFILER.start("detect")
+        if self.detect_mode == "per_can" and self.can_regions:
+            offsets = None
+            if self.can_refine:
+                with PROFILER.span("detect.can_refine"):
+                    offsets = estimate_can_offsets(self.can_regions, cur_masked_roi,
+                                                   max_shift=self.can_refine_max_shift,
+                                                   min_response=self.can_refine_min_response,
+                                                   workers=self.detect_tiles)
+                shifts = [np.hypot(dx, dy) for dx, dy, _ in offsets.values()]
+                if shifts:
+                    print(f"[CanRefine] desvio local médio {np.mean(shifts):.2f} px, máx {np.max(shifts):.2f} px")
+            sheet["can_offsets"] = offsets
+            # limiares da folha antes da saída cedo: o veredicto de uma lata não depende das outras
+            with PROFILER.span("detect.sheet_thresholds"):
+                thresholds = sheet_thresholds(self.template_model, cur_masked_roi, *det_args,
+                                              tile_size=self.coarse_tile_size,
+                                              sample_stride=self.threshold_sample_stride,
+                                              max_reuse=self.threshold_max_reuse,
+                                              max_drift=self.threshold_max_drift,
+                                              workers=self.detect_tiles, **det_kwargs)
+            per_can = detect_defects_per_can(self.can_regions, cur_masked_roi, *det_args,
+                                             verdict_only=self.detect_verdict_only,
+                                             workers=self.detect_tiles, offsets=offsets, thresholds=thresholds,
+                                             **det_kwargs)
+            # costura por lata -> mesmas máscaras do modo folha (coords da ROI)
+            final_mask = np.zeros_like(mask_roi)
+            darker_mask_roi, brighter_mask_roi, blue_mask_roi, red_mask_roi = (
+                np.zeros_like(mask_roi) for _ in range(4))
+            for rg in self.can_regions:
+                res = per_can[rg.numero_lata]
+                wx0, wy0, wx1, wy1 = rg.window
+                for dst, src in zip((final_mask, darker_mask_roi, brighter_mask_roi, blue_mask_roi, red_mask_roi),
+                                    res["masks"]):
+                    win = dst[wy0:wy1, wx0:wx1]
+                    cv2.bitwise_or(win, cv2.bitwise_and(src, rg.model.mask_bin), dst=win)
+        elif self.detect_mode == "coarse":
+            result, sheet["coarse_telemetry"] = detect_defects_coarse_to_fine(
+                self.template_model, cur_masked_roi, *det_args,
+                screen_margin=self.coarse_screen_margin, tile_size=self.coarse_tile_size,
+                sample_stride=self.threshold_sample_stride, max_reuse=self.threshold_max_reuse,
+                max_drift=self.threshold_max_drift,
+                workers=self.detect_tiles, **det_kwargs)
+            final_mask, _, darker_mask_roi, brighter_mask_roi, blue_mask_roi, red_mask_roi = result
+        else:
+            # só as saídas usadas aqui (o detetor salta os estágios de que não dependem)
+            result = detect_defects_with_model(
+                self.template_model, cur_masked_roi, *det_args,
+                tiles=self.detect_tiles, outputs=("final", "table", "dark", "bright", "blue", "red"),
+                workspace=self.detector_workspace, **det_kwargs)
+            final_mask, table = result["final"], result["table"]
+            darker_mask_roi, brighter_mask_roi = result["dark"], result["bright"]
+            blue_mask_roi, red_mask_roi = result["blue"], result["red"]
+        sp.stop()
+        sheet.update(final_mask=final_mask, table=table, masks={
+            "dark": darker_mask_roi, "bright": brighter_mask_roi, "blue": blue_mask_roi, "red": red_mask_roi})
+        return sheet
+
+    def _stage_classify(self, sheet):
+        """Classificação e, com a saída ligada, veredicto para o desviador logo a seguir (antes do render)."""
+        sheet = self._classify(sheet)
+        if self.reject_output is not None:
+            ok = sheet["decision"] != "reject" and not sheet["defect_data"]
+            res = self.reject_output.deliver(sheet["seq"], ok)
+            sheet.update(output=res["output"], deadline_slack_ms=res["slack_ms"])
+        return sheet
+
+    def _classify(self, sheet):
+        """Tabela de defeitos, reprojeção para o frame (sem warp) e nº da lata de cada defeito."""
+        if sheet["skip"]:
+            sheet.update(defect_data=[], can_ids=set(), can_area={}, contours=[])
+            return sheet
+        x0, y0 = self._mask_bbox[:2]
+        H_inv = sheet["H_inv"]
+
+        # tabela de defeitos (um blob por linha) + reprojeção em lote para CURRENT (sem warp)
+        sp = PROFILER.start("defect_table")
+        table = sheet["table"]
+        if table is None:
+            table = build_defect_table(sheet["final_mask"], sheet["masks"], self.min_defect_area,
+                                       can_map=self.can_map)
+        elif self.can_map is not None:
+            table = table.with_cans(self.can_map)    # tabela do detetor: lata num só lookup
+        cx_c, cy_c, r_c = table.circles(H_inv, offset=(x0, y0), min_radius=8.0)
+        r_c = np.maximum(24.0, r_c + 6.0)
+        sheet["contours"] = table.contours(H_inv, offset=(x0, y0))
+        sp.stop()
+
+        defect_data = []
+        for i, label in enumerate(table.type_names):
+            cxi, cyi, ri = int(round(cx_c[i])), int(round(cy_c[i])), int(round(r_c[i]))
+
+            # nº da lata: lata mais frequente do blob no can_map (coords do template)
+            lata_id = int(table.can[i]) if table.can[i] >= 0 else None
+            xr, yr, wr, hr = (int(v) for v in table.bbox[i])
+            defect_data.append({
+                "lata": lata_id,
+                "tipo": label,
+                "area": int(table.area[i]),  # pixels no template
+                "bbox": (xr + x0, yr + y0, wr, hr),  # bbox ainda em template-space, se precisares reprojeta os 4 cantos
+                "cx": int(cxi), "cy": int(cyi), "r": int(ri)
+            })
+        sheet["defect_data"] = defect_data
+        area = table.area_per_can()
+        sheet["can_area"] = {int(c): int(area[c]) for c in np.flatnonzero(area)}
+        sheet["can_ids"] = set(sheet["can_area"])
+        return sheet
+
+    def _stage_render(self, sheet):
+        # 6) Visualizações sobre a IMAGEM ORIGINAL (sem warp); headless só se forem pedidas
+        if not self.render:
+            sheet.update(vis_bw=None, vis_color=None)
+            return sheet
+        sp = PROFILER.start("render")
+        gray_full = cv2.cvtColor(sheet["frame"], cv2.COLOR_BGR2GRAY)
+        vis_bw    = cv2.cvtColor(gray_full, cv2.COLOR_GRAY2BGR)
+        vis_color = sheet["frame"].copy()
+
+        color_map = {
+            "dark":   (0, 255, 0),
+            "bright": (255, 255, 0),
+            "blue":   (0, 0, 255),
+            "red":    (255, 0, 255)
+        }
+        for d in sheet["defect_data"]:
+            color = color_map[d["tipo"]]
+            cxi, cyi, ri, lata_id = d["cx"], d["cy"], d["r"], d["lata"]
+            cv2.circle(vis_bw,    (cxi, cyi), ri, color, 3, lineType=cv2.LINE_AA)
+            cv2.circle(vis_bw,    (cxi, cyi), 2,  color, -1, lineType=cv2.LINE_AA)
+            cv2.circle(vis_color, (cxi, cyi), ri, color, 3, lineType=cv2.LINE_AA)
+            cv2.circle(vis_color, (cxi, cyi), 2,  color, -1, lineType=cv2.LINE_AA)
+            if lata_id is not None:
+                cv2.putText(vis_bw,    f"#{lata_id}", (max(cxi - ri, 0), max(cyi - ri - 6, 0)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+                cv2.putText(vis_color, f"#{lata_id}", (max(cxi - ri, 0), max(cyi - ri - 6, 0)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+        sheet.update(vis_bw=vis_bw, vis_color=vis_color)
+        sp.stop()
+        return sheet
+
+    # ---------------------------
+    # Conclusão, pipeline e execução sem GUI
+    # ---------------------------
+
+    def finish(self, sheet):
+        """Fecha uma folha (tempo total, veredicto, telemetria); devolve o veredicto."""
+        sheet["total_ms"] = (time.perf_counter() - sheet["t0"]) * 1000.0
+        verdict = sheet_verdict(sheet)
+        sheet["verdict"] = verdict
+        row = sheet_telemetry_row(sheet["seq"], sheet["decision"], sheet["align_info"], verdict["defects"],
+                                  verdict["cans_with_defects"], sheet["total_ms"])
+        self.last_sheet_telemetry = row
+        if self.sheet_telemetry:
+            try:
+                append_sheet_telemetry(row, self.sheet_telemetry_path)
+            except OSError as e:
+                print("⚠️ Não foi possível escrever a telemetria da folha:", e)
+        return verdict
+
+    def start_reject_output(self, backend=None):
+        """Liga a saída rejeitar/aceitar com os parâmetros reject_* (backend: gpio_backend por omissão)."""
+        if self.reject_output is None:
+            self.reject_output = open_reject_output(
+                self.reject_pin, self.accept_pin, backend=backend or self.gpio_backend,
+                active_high=self.reject_output_active_high, deadline_ms=self.reject_deadline_ms,
+                pulse_ms=self.reject_pulse_ms, failsafe=self.reject_failsafe, mode=self.reject_output_mode)
+        return self.reject_output
+
+    def close(self):
+        """Pára a saída para o desviador (watchdog + pinos a inativo)."""
+        if self.reject_output is not None:
+            self.reject_output.stop()
+            self.reject_output.gpio.cleanup()
+            self.reject_output = None
+
+    def inspect(self, item=None):
+        """Uma folha, todos os estágios na thread de quem chama (um trace do profiler por folha)."""
+        sheet = self.new_sheet(item)
+        with PROFILER.sheet():
+            for _, stage in self.stages():
+                sheet = stage(sheet)
+        self.finish(sheet)
+        return sheet
+
+    def make_pipeline(self, on_result=None, on_drop=None, on_error=None, drop_policy=None):
+        """SheetPipeline com os estágios e a configuração dos parâmetros (ainda parado)."""
+        return SheetPipeline(
+            self.stages(), queue_size=self.pipeline_queue_size,
+            drop_policy=drop_policy or self.pipeline_drop_policy,
+            block_timeout_s=self.pipeline_block_timeout_s,
+            on_result=on_result, on_drop=on_drop, on_error=on_error,
+            throughput_window_s=self.throughput_window_s)
+
+    def run(self, max_sheets=None, pipeline=True, drop_policy="block", on_result=None):
+        """
+        Inspeciona as folhas da fonte até ela acabar (ou max_sheets). on_result(folha, veredicto)
+        corre na thread do último estágio. "block" por omissão: folhas gravadas não se descartam.
+        Devolve {"sheets", "completed", "rejected", "with_defects", "errors", "dropped",
+        "elapsed_s", "sheets_per_min", "trigger_latency", "reject_output"} (trigger_latency:
+        LatencyStats.summary() ou None; reject_output: RejectOutput.stats() ou None).
+        """
+        if self.source is None:
+            raise ValueError("InspectionRunner sem fonte de frames.")
+        counts = {"completed": 0, "rejected": 0, "with_defects": 0, "errors": 0}
+
+        def done(sheet):
+            verdict = self.finish(sheet)
+            counts["completed"] += 1
+            if verdict["decision"] == "reject":
+                counts["rejected"] += 1
+            elif verdict["defects"]:
+                counts["with_defects"] += 1
+            if on_result is not None:
+                on_result(sheet, verdict)
+
+        def failed(sheet, stage, e):
+            print(f"❌ Erro no estágio {stage} (folha {sheet.get('seq')}, {sheet.get('name')}):", e)
+
+        pl = self.make_pipeline(done, on_error=failed, drop_policy=drop_policy).start() if pipeline else None
+        submitted = 0
+        t0 = time.perf_counter()
+        try:
+            while max_sheets is None or submitted < max_sheets:
+                item = self.source.wait()
+                if item is None:
+                    break
+                sheet = self.new_sheet(item)
+                submitted += 1
+                if pl is not None:
+                    pl.submit(sheet)
+                    continue
+                try:
+                    with PROFILER.sheet():
+                        for name, stage in self.stages():
+                            sheet = stage(sheet)
+                except Exception as e:
+                    counts["errors"] += 1
+                    failed(sheet, name, e)
+                    continue
+                done(sheet)
+        except KeyboardInterrupt:
+            print("Interrompido: a terminar as folhas em curso...")
+        finally:
+            if pl is not None:
+                pl.stop(drain=True)
+        elapsed = time.perf_counter() - t0
+        if self.reject_output is not None:    # prazos ainda abertos (folhas com erro) acabam no fail-safe
+            self.reject_output.wait_idle(self.reject_deadline_ms / 1000.0 + 0.5)
+
+        stats = pl.stats() if pl is not None else {"errors": counts["errors"], "dropped": 0}
+        return {
+            "sheets": submitted, "completed": counts["completed"], "rejected": counts["rejected"],
+            "with_defects": counts["with_defects"], "errors": stats["errors"], "dropped": stats["dropped"],
+            "elapsed_s": elapsed,
+            "sheets_per_min": 60.0 * counts["completed"] / elapsed if elapsed > 0 else 0.0,
+            "trigger_latency": self.trigger_latency.summary(),
+            "reject_output": self.reject_output.stats() if self.reject_output is not None else None,
+        }
+
+
+if __name__ == "__main__":
+    # python -m models.inspection_runner template.jpg mascara.png (--files "data/raw/*.jpg" | --folder DIR
+    #        [--watch] | --camera) [--params config/inspection_params.json] [--max N] [--out DIR]
+    #        [--sync] [--render] [--loop] [--trigger | --fake-trigger 0.5,1.5,2.5 [--bounces N]
+    #        | --trigger-schedule flancos.json] [--reject-output]
+    import csv
+    import os
+    import sys
+
+    from utils.frame_sources import CameraSource, FileListSource, FolderSource, open_camera
+    from utils.gpio_rapsberry import pulse_schedule
+    from utils.trigger import SheetTrigger, TriggerSource, load_trigger_schedule, open_trigger_gpio
+
+    args = sys.argv[1:]
+    opts = {"--files": None, "--folder": None, "--params": PARAMS_PATH, "--max": None,
+            "--out": os.path.join("logs", "runner"), "--fake-trigger": None, "--bounces": "0",
+            "--trigger-schedule": None}
+    flags = {f: f in args for f in ("--watch", "--camera", "--sync", "--render", "--loop", "--trigger",
+                                    "--reject-output")}
+    args = [a for a in args if a not in flags]
+    for key in list(opts):
+        if key in args:
+            i = args.index(key)
+            opts[key] = args[i + 1]
+            del args[i:i + 2]
+    if len(args) != 2 or sum(bool(v) for v in (opts["--files"], opts["--folder"], flags["--camera"])) != 1:
+        print('uso: python -m models.inspection_runner template.jpg mascara.png (--files "data/raw/*.jpg" | '
+              '--folder DIR [--watch] | --camera) [--params p.json] [--max N] [--out DIR] [--sync] [--render] [--loop] '
+              '[--trigger | --fake-trigger 0.5,1.5 [--bounces N] | --trigger-schedule flancos.json] [--reject-output]')
+        sys.exit(1)
+
+    picam2 = None
+    if opts["--files"]:
+        source = FileListSource(opts["--files"].split(","), loop=flags["--loop"])
+    elif opts["--folder"]:
+        source = FolderSource(opts["--folder"], watch=flags["--watch"])
+    else:
+        picam2 = open_camera()
+        source = CameraSource(picam2)
+
+    runner = InspectionRunner(args[0], args[1], params_path=opts["--params"], source=source,
+                              render=flags["--render"])
+
+    # trigger por interrupção: real (--trigger) ou FakeGPIO a reproduzir pulsos / flancos gravados
+    trigger = None
+    fake = bool(opts["--fake-trigger"] or opts["--trigger-schedule"])
+    if flags["--reject-output"]:
+        # saída para o desviador; com trigger simulado também é simulada (FakeGPIO.outputs)
+        runner.start_reject_output("fake" if fake else None)
+    if flags["--trigger"] or fake:
+        gpio = open_trigger_gpio(runner.trigger_pins, "fake" if fake else "auto")
+        trigger = SheetTrigger(gpio, runner.trigger_pins, edge=runner.trigger_edge,
+                               debounce_ms=runner.trigger_debounce_ms)
+        if not trigger.start():
+            raise ValueError("Sem deteção de flancos no GPIO (RPi.GPIO em falta?): usar --fake-trigger.")
+        schedule = None
+        if opts["--trigger-schedule"]:
+            schedule = load_trigger_schedule(opts["--trigger-schedule"])
+        elif fake:
+            times = [float(t) for t in opts["--fake-trigger"].split(",")]
+            schedule = pulse_schedule(times, runner.trigger_pins[0], active_low=runner.trigger_edge == "falling",
+                                      bounce_ms=5.0, bounces=int(opts["--bounces"]))
+        # replay: acaba 2 s depois do maior intervalo entre flancos; o sensor real espera para sempre (Ctrl+C)
+        idle = None
+        if schedule:
+            t = sorted(e[0] for e in schedule)
+            idle = 2.0 + max([t[0]] + [b - a for a, b in zip(t, t[1:])])
+        runner.source = TriggerSource(trigger, source, idle_timeout_s=idle)
+        if schedule:
+            gpio.gpio.replay(schedule)
+
+    out_dir = opts["--out"]
+    os.makedirs(out_dir, exist_ok=True)
+    ts = time.strftime("%Y%m%d_%H%M%S")
+    verdict_fields = ["seq", "name", "decision", "ok", "defects", "cans_with_defects", "can_ids", "can_area",
+                      "total_ms", "trigger_latency_ms", "output", "deadline_slack_ms"]
+    defect_fields = ["seq", "name", "lata", "tipo", "area", "cx", "cy", "r", "bbox"]
+
+    with open(os.path.join(out_dir, f"verdicts_{ts}.csv"), "w", newline="", encoding="utf-8") as fv, \
+            open(os.path.join(out_dir, f"defects_{ts}.csv"), "w", newline="", encoding="utf-8") as fd:
+        verdicts = csv.DictWriter(fv, fieldnames=verdict_fields, delimiter=";")
+        defects = csv.DictWriter(fd, fieldnames=defect_fields, delimiter=";", extrasaction="ignore")
+        verdicts.writeheader()
+        defects.writeheader()
+
+        def on_result(sheet, verdict):
+            total, latency = verdict["total_ms"], verdict["trigger_latency_ms"]
+            slack = verdict["deadline_slack_ms"]
+            verdicts.writerow({**verdict, "can_ids": " ".join(str(c) for c in verdict["can_ids"]),
+                               "can_area": " ".join(f"{c}:{a}" for c, a in sorted(verdict["can_area"].items())),
+                               "total_ms": f"{total:.1f}",
+                               "trigger_latency_ms": f"{latency:.1f}" if latency is not None else "",
+                               "output": verdict["output"] or "",
+                               "deadline_slack_ms": f"{slack:.1f}" if slack is not None else ""})
+            for d in sheet["defect_data"]:
+                defects.writerow({"seq": verdict["seq"], "name": verdict["name"], **d})
+            if sheet.get("vis_bw") is not None:
+                cv2.imwrite(os.path.join(out_dir, f"sheet_{verdict['seq']:05d}.jpg"), sheet["vis_bw"])
+            state = "OK" if verdict["ok"] else ("REJEITADA" if verdict["decision"] == "reject"
+                                                else f"{verdict['defects']} defeito(s)")
+            print(f"[{verdict['seq']}] {verdict['name'] or ''} {state} ({total:.0f} ms)")
+
+        try:
+            summary = runner.run(max_sheets=int(opts["--max"]) if opts["--max"] else None,
+                                 pipeline=not flags["--sync"], on_result=on_result)
+        finally:
+            if trigger is not None:
+                trigger.stop()
+                trigger.gpio.cleanup()
+            runner.close()
+            if picam2 is not None:
+                picam2.stop()
+
+    print(f"{summary['completed']}/{summary['sheets']} folha(s) em {summary['elapsed_s']:.1f} s "
+          f"({summary['sheets_per_min']:.1f} folhas/min): {summary['with_defects']} com defeitos, "
+          f"{summary['rejected']} rejeitada(s), {summary['errors']} erro(s), {summary['dropped']} descartada(s)")
+    if summary["trigger_latency"] is not None:
+        lat = summary["trigger_latency"]
+        print(f"trigger -> captura: p50 {lat['p50_ms']:.1f} ms, p95 {lat['p95_ms']:.1f} ms, máx {lat['max_ms']:.1f} ms "
+              f"({trigger.triggers} trigger(s), {trigger.bounces} ressalto(s) ignorado(s))")
+    if summary["reject_output"] is not None:
+        ro = summary["reject_output"]
+        slack = ro["slack"] or {}
+        print(f"saída desviador: {ro['rejects']} rejeitar / {ro['accepts']} aceitar, {ro['misses']} prazo(s) "
+              f"falhado(s) ({100.0 * ro['miss_rate']:.1f}%, fail-safe {runner.reject_failsafe}), "
+              f"{ro['late']} veredicto(s) tardio(s); folga p5 {slack.get('p5_ms', float('nan')):.0f} ms, "
+              f"p50 {slack.get('p50_ms', float('nan')):.0f} ms")
+    print("resultados em", out_dir)
@@ -0,0 +1,178 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+# ---------------------------
+# Calibração da lente (intrínsecos + distorção) a partir de xadrezes
+# ---------------------------
+# calibrate_from_checkerboards() corre o calibrateCamera sobre imagens de um
+# xadrez guardadas em disco; o resultado fica em config/camera_calibration.json
+# (ao lado do camera_params.json). O LensModel converte pontos entre pixels
+# com distorção (frame da câmara) e pixels sem distorção (mesma K), que é
+# onde a homografia template <-> frame é válida: o AlignmentEngine estima a H
+# com pontos sem distorção e compõe distorção + H num único mapa de remap.
+
+CALIBRATION_PATH = "config/camera_calibration.json"
+
+_SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 1e-3)
+_UNDISTORT_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 20, 1e-6)
+
+
+def find_checkerboard(img, pattern_size):
+    """Cantos interiores (N, 1, 2) float32 de um xadrez pattern_size = (colunas, linhas), ou None."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    found, corners = cv2.findChessboardCornersSB(gray, pattern_size, flags=cv2.CALIB_CB_ACCURACY)
+    if not found:
+        found, corners = cv2.findChessboardCorners(
+            gray, pattern_size, flags=cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE)
+        if not found:
+            return None
+        corners = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), _SUBPIX_CRITERIA)
+    return corners.astype(np.float32)
+
+
+def calibrate_from_checkerboards(image_paths, pattern_size=(9, 6), square_size=1.0, rational_model=False):
+    """
+    Intrínsecos e distorção a partir de fotos de um xadrez (todas com o mesmo tamanho).
+    Devolve {"camera_matrix", "dist_coeffs", "image_size" [w, h], "rms_px",
+    "pattern_size", "square_size", "images" (usadas), "rejected"}.
+    """
+    cols, rows = pattern_size
+    obj = np.zeros((cols * rows, 3), np.float32)
+    obj[:, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2) * float(square_size)
+
+    obj_pts, img_pts, used, rejected = [], [], [], []
+    image_size = None
+    for path in image_paths:
+        img = cv2.imread(path)
+        if img is None:
+            rejected.append(path)
+            continue
+        size = (img.shape[1], img.shape[0])
+        if image_size is None:
+            image_size = size
+        elif size != image_size:
+            raise ValueError(f"Tamanho diferente das restantes imagens: {path} {size} != {image_size}")
+        corners = find_checkerboard(img, pattern_size)
+        if corners is None:
+            rejected.append(path)
+            continue
+        obj_pts.append(obj)
+        img_pts.append(corners)
+        used.append(path)
+
+    if len(used) < 3:
+        raise ValueError(f"Xadrez encontrado em {len(used)} imagem(ns); são precisas pelo menos 3.")
+
+    flags = cv2.CALIB_RATIONAL_MODEL if rational_model else 0
+    rms, K, dist, _, _ = cv2.calibrateCamera(obj_pts, img_pts, image_size, None, None, flags=flags)
+    return {
+        "camera_matrix": K.tolist(),
+        "dist_coeffs": dist.ravel().tolist(),
+        "image_size": list(image_size),
+        "rms_px": float(rms),
+        "pattern_size": [int(cols), int(rows)],
+        "square_size": float(square_size),
+        "images": used,
+        "rejected": rejected,
+    }
+
+
+def save_calibration(calib, path=CALIBRATION_PATH):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(calib, f, indent=4)
+    return path
+
+
+def load_calibration(path=CALIBRATION_PATH):
+    """Calibração guardada ou None se ainda não houver ficheiro."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class LensModel:
+    """Distorção da lente: pixels do frame (com distorção) <-> pixels sem distorção (mesma K)."""
+
+    def __init__(self, camera_matrix, dist_coeffs, image_size):
+        self.K = np.asarray(camera_matrix, np.float64).reshape(3, 3)
+        self.dist = np.asarray(dist_coeffs, np.float64).ravel()
+        self.image_size = (int(image_size[0]), int(image_size[1]))
+
+    @classmethod
+    def from_calibration(cls, calib):
+        return cls(calib["camera_matrix"], calib["dist_coeffs"], calib["image_size"])
+
+    def for_size(self, image_size):
+        """Modelo para outra resolução do mesmo sensor (mesma proporção): K reescalada."""
+        w, h = int(image_size[0]), int(image_size[1])
+        if (w, h) == self.image_size:
+            return self
+        sx, sy = w / self.image_size[0], h / self.image_size[1]
+        if abs(sx - sy) > 1e-3:
+            raise ValueError(f"Calibração {self.image_size} não serve para imagens {w}x{h} (proporção diferente).")
+        S = np.array([[sx, 0.0, 0.5 * sx - 0.5], [0.0, sy, 0.5 * sy - 0.5], [0.0, 0.0, 1.0]])
+        return LensModel(S @ self.K, self.dist, (w, h))
+
+    def undistort_points(self, pts):
+        """(N, 2) pixels com distorção -> (N, 2) pixels sem distorção."""
+        pts = np.asarray(pts, np.float64).reshape(-1, 1, 2)
+        if hasattr(cv2, "undistortPointsIter"):      # OpenCV 4.x
+            out = cv2.undistortPointsIter(pts, self.K, self.dist, None, self.K, _UNDISTORT_CRITERIA)
+        else:                                         # OpenCV 5: critério no undistortPoints
+            out = cv2.undistortPoints(pts, self.K, self.dist, R=None, P=self.K, criteria=_UNDISTORT_CRITERIA)
+        return out.reshape(-1, 2)
+
+    def distort_points(self, pts):
+        """(N, 2) pixels sem distorção -> (N, 2) pixels com distorção."""
+        pts = np.asarray(pts, np.float64).reshape(-1, 2)
+        fx, fy, cx, cy = self.K[0, 0], self.K[1, 1], self.K[0, 2], self.K[1, 2]
+        rays = np.empty((len(pts), 1, 3), np.float64)
+        rays[:, 0, 0] = (pts[:, 0] - cx) / fx
+        rays[:, 0, 1] = (pts[:, 1] - cy) / fy
+        rays[:, 0, 2] = 1.0
+        out, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3), self.K, self.dist)
+        return out.reshape(-1, 2)
+
+
+def load_lens_model(path=CALIBRATION_PATH, image_size=None):
+    """LensModel da calibração guardada (reescalado para image_size), ou None sem calibração."""
+    calib = load_calibration(path)
+    if calib is None:
+        return None
+    lens = LensModel.from_calibration(calib)
+    return lens.for_size(image_size) if image_size is not None else lens
+
+
+if __name__ == "__main__":
+    # python -m models.lens_calibration "calib/*.png" [--pattern 9x6] [--square 25] [--rational]
+    import glob
+    import sys
+
+    args = sys.argv[1:]
+    opts = {"--pattern": "9x6", "--square": "1.0"}
+    for key in list(opts):
+        if key in args:
+            i = args.index(key)
+            opts[key] = args[i + 1]
+            del args[i:i + 2]
+    rational = "--rational" in args
+    args = [a for a in args if a != "--rational"]
+    if not args:
+        print('uso: python -m models.lens_calibration "calib/*.png" [--pattern 9x6] [--square 25] [--rational]')
+        sys.exit(1)
+
+    paths = sorted(p for pattern in args for p in glob.glob(pattern))
+    pattern_size = tuple(int(v) for v in opts["--pattern"].lower().split("x"))
+    calib = calibrate_from_checkerboards(paths, pattern_size, float(opts["--square"]), rational)
+    print(f"RMS de reprojeção: {calib['rms_px']:.3f} px ({len(calib['images'])} imagens, "
+          f"{len(calib['rejected'])} rejeitadas)")
+    print("K =", np.round(np.array(calib["camera_matrix"]), 2).tolist())
+    print("dist =", np.round(calib["dist_coeffs"], 5).tolist())
+    print("guardado em", save_calibration(calib))
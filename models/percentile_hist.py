@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+# ---------------------------
+# Percentis por histograma (substitui np.percentile sobre img[roi])
+# ---------------------------
+# Cada mapa de score [vmin..vmax] é quantizado num histograma de `bins` classes
+# restrito ao ROI (cv2.calcHist com máscara: sem cópia img[roi] nem partição).
+# Todos os percentis pedidos saem do mesmo histograma acumulado.
+#
+# Precisão: o limiar devolvido é o limite inferior de uma classe, escolhido
+# para selecionar as mesmas estatísticas de ordem que np.percentile(linear):
+#   - `img >= thr` é sempre um SUPERCONJUNTO da máscara exata;
+#   - os pixels a mais têm todos valor na mesma classe que o limiar exato,
+#     i.e. a menos de uma largura de classe (vmax - vmin) / bins dele
+#     (4096 classes em [0..1] -> 2.4e-4);
+#   - mapas com valores discretos mais espaçados que a classe (p.ex. scores
+#     normalizados a partir de diffs uint8) dão exatamente a mesma máscara.
+
+
+class RoiPercentileEngine:
+    """
+    Motor de percentis para um ROI fixo (reutilizável entre mapas e folhas).
+
+    roi_mask: uint8 (0 = fora). bins/vmin/vmax: quantização dos scores.
+    share_index=True guarda o índice linear do ROI (np.flatnonzero) 1x e usa
+    np.bincount sobre ele em vez de cv2.calcHist com máscara; útil quando o
+    mesmo ROI é usado por muitos mapas e é esparso face à bbox.
+    """
+
+    def __init__(self, roi_mask, bins=4096, vmin=0.0, vmax=1.0, share_index=False):
+        self.roi_mask = roi_mask if roi_mask.dtype == np.uint8 else (roi_mask > 0).astype(np.uint8) * 255
+        self.bins = int(bins)
+        self.vmin = float(vmin)
+        # margem mínima para que vmax caia na última classe (calcHist exclui o limite superior)
+        self.vmax = float(vmax) + (float(vmax) - float(vmin)) * 1e-6
+        self.bin_width = (self.vmax - self.vmin) / self.bins
+        self.count = int(cv2.countNonZero(self.roi_mask))
+        self.roi_index = np.flatnonzero(self.roi_mask.ravel()) if share_index else None
+
+    def histogram(self, score, rows=None):
+        """
+        Histograma (float64, `bins`) de score (float32) dentro do ROI. rows: slice de linhas
+        (para somar histogramas de faixas calculados em paralelo).
+        """
+        if self.roi_index is not None and rows is None:
+            vals = np.take(score.ravel(), self.roi_index)
+            q = ((vals - self.vmin) * (1.0 / self.bin_width)).astype(np.int32)
+            np.clip(q, 0, self.bins - 1, out=q)
+            return np.bincount(q, minlength=self.bins).astype(np.float64)
+        img = score if rows is None else score[rows]
+        msk = self.roi_mask if rows is None else self.roi_mask[rows]
+        if img.dtype != np.float32:
+            img = img.astype(np.float32)
+        # nota: calcHist ignora valores fora de [vmin, vmax] (os scores do detetor já estão em [0..1])
+        h = cv2.calcHist([img], [0], msk, [self.bins], [self.vmin, self.vmax])
+        return h.ravel().astype(np.float64)
+
+    def thresholds(self, hist, pcts):
+        """Percentis (0..100) a partir de um histograma; None para ROI vazio."""
+        cum = np.cumsum(hist)
+        n = cum[-1] if cum.size else 0.0
+        if n <= 0:
+            return [None for _ in pcts]
+        out = []
+        for p in pcts:
+            # posição 0-based como np.percentile(method="linear"): v[k] + frac*(v[k+1]-v[k])
+            r = min(max(float(p), 0.0), 100.0) / 100.0 * (n - 1)
+            k = int(np.floor(r))
+            frac = r - k
+            b = int(np.searchsorted(cum, k, side="right"))            # classe de v[k]
+            if frac > 0 and k + 1 < n:
+                b_hi = int(np.searchsorted(cum, k + 1, side="right"))  # classe de v[k+1]
+                # limiar exato em (v[k], v[k+1]]: se v[k+1] está noutra classe,
+                # o limite inferior dessa classe seleciona exatamente v >= v[k+1]
+                if b_hi > b:
+                    b = b_hi
+            b = min(b, self.bins - 1)
+            out.append(self.vmin + b * self.bin_width)
+        return out
+
+    def percentiles(self, score, pcts):
+        """Todos os percentis pedidos a partir de uma única passagem pelo mapa."""
+        return self.thresholds(self.histogram(score), pcts)
+
+    def percentile(self, score, pct):
+        return self.percentiles(score, [pct])[0]
@@ -0,0 +1,229 @@
+import time
+
+import cv2
+import numpy as np
+
+from models.workspace import no_scratch, scoped
+
+# ---------------------------
+# Backend SSIM rápido (separável)
+# ---------------------------
+# Alternativa a _gaussian_ssim_map/_ms_ssim_map do defect_detector:
+#   - Gaussiana separável (sepFilter2D com o kernel 1D) em vez de filter2D com k @ k.T,
+#     um filtro por momento (y, y², x·y) em float32: empacotar os momentos num
+#     só Mat multi-canal (merge + split) saía mais caro do que o filtro poupava
+#   - sem janela "box" (média uniforme): medida só ~1.06x mais rápida que a
+#     referência e com desvio ~1.4e-2 no DSSIM, contra ~1.2-1.5x e ~2e-4 da separável
+#   - MS-SSIM em cascata: cada escala reduz a partir da anterior e as escalas
+#     grosseiras acumulam-se na resolução intermédia antes de um único upsample
+# Os resultados não são bit-a-bit iguais à referência: ver benchmark_ssim_backends
+# para o desvio máximo.
+
+BACKENDS = ("separable",)
+
+C1 = (0.01 * 255) ** 2
+C2 = (0.03 * 255) ** 2
+
+
+def _as_f32(x):
+    return x if x.dtype == np.float32 else x.astype(np.float32)
+
+
+def _window_kernel(ksize, sigma):
+    k = cv2.getGaussianKernel(ksize, sigma).astype(np.float32)
+    k /= k.sum()
+    return k
+
+
+def _window_filter(img, ksize, sigma, dst=None):
+    """Média local (gaussiana separável) de um momento float32 (1 canal)."""
+    k = _window_kernel(ksize, sigma)
+    return cv2.sepFilter2D(img, -1, k, k, dst=dst, borderType=cv2.BORDER_REFLECT)
+
+
+def ssim_stats(x, ksize=7, sigma=1.5):
+    """(mu_x, sigma_x²): um filtro por momento (x, x²)."""
+    x = _as_f32(x)
+    mu = _window_filter(x, ksize, sigma)
+    sigma2 = _window_filter(np.multiply(x, x), ksize, sigma)
+    sigma2 -= mu * mu
+    return mu, sigma2
+
+
+def ssim_map(x, y, ksize=7, sigma=1.5, c1=C1, c2=C2, x_stats=None, tmp=no_scratch):
+    """
+    Mapa SSIM float32 [0..1]. Com x_stats=(mu_x, sigma_x²) filtra só os 3 momentos
+    de y (y, y², x·y), um sepFilter2D por momento (sem merge/split de
+    canais, que custava mais do que o filtro poupava); temporários reaproveitados.
+    tmp: scratch do workspace (models.workspace) para os 5 temporários float32;
+    o mapa devolvido é um deles.
+    """
+    x = _as_f32(x)
+    y = _as_f32(y)
+    if x_stats is None:
+        x_stats = ssim_stats(x, ksize, sigma)
+    mu_x, sigma_x2 = x_stats
+    shape = y.shape[:2]
+
+    mu_y = _window_filter(y, ksize, sigma, dst=tmp("mu_y", shape, np.float32))
+    t = np.multiply(y, y, out=tmp("t", shape, np.float32))
+    sigma_y2 = _window_filter(t, ksize, sigma, dst=tmp("sigma_y2", shape, np.float32))
+    np.multiply(x, y, out=t)
+    sigma_xy = _window_filter(t, ksize, sigma, dst=tmp("sigma_xy", shape, np.float32))
+
+    mu_xy = np.multiply(mu_x, mu_y, out=tmp("mu_xy", shape, np.float32))
+    np.multiply(mu_y, mu_y, out=mu_y)          # mu_y -> mu_y²
+    sigma_y2 -= mu_y
+    sigma_xy -= mu_xy
+
+    # num = (2*mu_xy + c1) * (2*sigma_xy + c2)
+    num = mu_xy
+    num *= 2.0
+    num += c1
+    sigma_xy *= 2.0
+    sigma_xy += c2
+    num *= sigma_xy
+    # den = (mu_x² + mu_y² + c1) * (sigma_x² + sigma_y² + c2)
+    den = mu_y
+    np.multiply(mu_x, mu_x, out=t)
+    den += t
+    den += c1
+    sigma_y2 += sigma_x2
+    sigma_y2 += c2
+    den *= sigma_y2
+    # den > 0 sempre (c1, c2 > 0); divide direto
+    np.divide(num, den, out=num)
+    return np.clip(num, 0.0, 1.0, out=num)
+
+
+def template_pyramid(x, scales=(1.0, 0.5, 0.25), ksizes=(7, 5, 3), sigmas=(1.5, 1.0, 0.8)):
+    """Lado do template por escala [(xs, (mu, sigma²))], com redução em cascata."""
+    x = _as_f32(x)
+    pyramid = []
+    prev, prev_s = x, 1.0
+    for s, ksz, sg in zip(scales, ksizes, sigmas):
+        xs = prev if s == prev_s else cv2.resize(prev, None, fx=s / prev_s, fy=s / prev_s,
+                                                 interpolation=cv2.INTER_AREA)
+        pyramid.append((xs, ssim_stats(xs, ksize=ksz, sigma=sg)))
+        prev, prev_s = xs, s
+    return pyramid
+
+
+def ms_ssim_coarse(y, x_pyramid, scales=(1.0, 0.5, 0.25), ksizes=(7, 5, 3), sigmas=(1.5, 1.0, 0.8),
+                   weights=(0.5, 0.3, 0.2), tmp=no_scratch, out=None):
+    """
+    Contribuição das escalas < 1 do MS-SSIM, já ponderada e no tamanho de y:
+    devolve (acc, wsum) com acc = Σ w_s · SSIM_s(upsampled).
+    As escalas reduzem em cascata e acumulam-se da mais grosseira para a mais
+    fina, com um único upsample final para a resolução total.
+    tmp: scratch das escalas reduzidas; out: buffer float32 do tamanho de y para acc.
+    """
+    y = _as_f32(y)
+    H0, W0 = y.shape[:2]
+    levels = []
+    prev, prev_s = y, 1.0
+    for i, (s, ksz, sg, w) in enumerate(zip(scales, ksizes, sigmas, weights)):
+        if s == 1.0:
+            continue
+        xs, x_stats = x_pyramid[i]
+        ys = cv2.resize(prev, None, fx=s / prev_s, fy=s / prev_s, dst=tmp(("ys", i), xs.shape, np.float32),
+                        interpolation=cv2.INTER_AREA)
+        levels.append((w, ssim_map(xs, ys, ksize=ksz, sigma=sg, x_stats=x_stats, tmp=scoped(tmp, i))))
+        prev, prev_s = ys, s
+
+    if not levels:
+        return None, 0.0
+    acc = None
+    wsum = 0.0
+    for j, (w, ssim_s) in enumerate(reversed(levels)):
+        acc_buf = tmp(("acc", j), ssim_s.shape, np.float32)
+        if acc is None:
+            acc = np.multiply(ssim_s, np.float32(w), out=acc_buf)
+        else:
+            acc = cv2.resize(acc, (ssim_s.shape[1], ssim_s.shape[0]), dst=acc_buf, interpolation=cv2.INTER_LINEAR)
+            acc += np.multiply(ssim_s, np.float32(w), out=ssim_s)
+        wsum += w
+    acc = cv2.resize(acc, (W0, H0), dst=out, interpolation=cv2.INTER_LINEAR)
+    return acc, wsum
+
+
+def combine_dssim(ssim_full, w_full, coarse_acc=None, coarse_wsum=0.0, out=None):
+    """
+    DSSIM = 1 - MS-SSIM a partir da escala 1 e da contribuição grosseira (ms_ssim_coarse).
+    out: buffer float32 do tamanho de ssim_full (pode ser o próprio ssim_full).
+    """
+    acc = np.multiply(ssim_full, np.float32(w_full), out=out)
+    if coarse_acc is not None:
+        acc += coarse_acc
+    acc /= np.float32(max(w_full + coarse_wsum, 1e-8))
+    np.clip(acc, 0.0, 1.0, out=acc)
+    np.subtract(1.0, acc, out=acc)
+    return acc
+
+
+def ms_ssim_map(x, y, scales=(1.0, 0.5, 0.25), ksizes=(7, 5, 3), sigmas=(1.5, 1.0, 0.8),
+                weights=(0.5, 0.3, 0.2), x_pyramid=None):
+    """Equivalente rápido de defect_detector._ms_ssim_map (DSSIM float32 [0..1])."""
+    assert len(scales) == len(ksizes) == len(sigmas) == len(weights)
+    assert scales[0] == 1.0, "a primeira escala do MS-SSIM tem de ser 1.0"
+    if x_pyramid is None:
+        x_pyramid = template_pyramid(x, scales, ksizes, sigmas)
+    xs, x_stats = x_pyramid[0]
+    ssim_full = ssim_map(xs, y, ksize=ksizes[0], sigma=sigmas[0], x_stats=x_stats)
+    coarse_acc, coarse_wsum = ms_ssim_coarse(y, x_pyramid, scales, ksizes, sigmas, weights)
+    return combine_dssim(ssim_full, weights[0], coarse_acc, coarse_wsum)
+
+
+# ---------------------------
+# Benchmark vs implementação atual
+# ---------------------------
+
+def benchmark_ssim_backends(x, y, repeats=3, scales=(1.0, 0.5, 0.25), ksizes=(7, 5, 3),
+                            sigmas=(1.5, 1.0, 0.8), weights=(0.5, 0.3, 0.2)):
+    """
+    Mede o MS-SSIM (lado do template pré-computado, como no detetor) para cada
+    backend e compara com a referência. Devolve {backend: {"ms", "speedup", "max_dev"}},
+    onde max_dev é o desvio absoluto máximo do DSSIM face à referência.
+    """
+    from models.defect_detector import _ms_ssim_map, _ms_ssim_template_pyramid
+
+    x = _as_f32(x)
+    y = _as_f32(y)
+
+    def _time(fn):
+        fn()  # aquecimento
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            out = fn()
+        return (time.perf_counter() - t0) / repeats * 1000.0, out
+
+    ref_pyr = _ms_ssim_template_pyramid(x, scales, ksizes, sigmas)
+    ref_ms, ref = _time(lambda: _ms_ssim_map(x, y, scales, ksizes, sigmas, weights, x_pyramid=ref_pyr))
+    report = {"reference": {"ms": ref_ms, "speedup": 1.0, "max_dev": 0.0}}
+    for backend in BACKENDS:
+        pyr = template_pyramid(x, scales, ksizes, sigmas)
+        ms, out = _time(lambda: ms_ssim_map(x, y, scales, ksizes, sigmas, weights, x_pyramid=pyr))
+        report[backend] = {"ms": ms, "speedup": ref_ms / max(ms, 1e-9),
+                           "max_dev": float(np.max(np.abs(out - ref)))}
+    return report
+
+
+if __name__ == "__main__":
+    # python -m models.ssim_fast [template.jpg alinhada.jpg]
+    import sys
+
+    if len(sys.argv) >= 3:
+        tpl = cv2.imread(sys.argv[1], cv2.IMREAD_GRAYSCALE)
+        cur = cv2.imread(sys.argv[2], cv2.IMREAD_GRAYSCALE)
+        if tpl is None or cur is None:
+            sys.exit("Não consegui ler as imagens.")
+    else:
+        rng = np.random.default_rng(0)
+        tpl = cv2.GaussianBlur(rng.integers(0, 256, (2400, 3200), dtype=np.uint8), (7, 7), 0)
+        cur = cv2.add(tpl, rng.integers(0, 6, tpl.shape, dtype=np.uint8))
+    tpl = cv2.GaussianBlur(tpl, (5, 5), 0)
+    cur = cv2.GaussianBlur(cur, (5, 5), 0)
+
+    print(f"MS-SSIM {tpl.shape[1]}x{tpl.shape[0]}")
+    for name, r in benchmark_ssim_backends(tpl, cur).items():
+        print(f"  {name:<10} {r['ms']:9.1f} ms   x{r['speedup']:5.2f}   max|ΔDSSIM| = {r['max_dev']:.2e}")
@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from models.align_image import AlignmentEngine, _ratio_matches, _small_gray
+
+# ---------------------------
+# Conjunto estável de keypoints do template (escolhido offline)
+# ---------------------------
+# Alinha-se cada folha gravada com o engine completo e, com essa H, conta-se
+# para cada keypoint do template quantas folhas o reencontram: match knn +
+# ratio test cujo ponto no frame, levado pela H, cai a <= tol_px do keypoint.
+# Ficam os que reaparecem em >= min_rate das folhas (os mais frequentes
+# primeiro, até max_keep). Os índices vão para <template>.stable_<hash>.npz;
+# o hash é o das features do template, por isso mudar o ORB, o bucketing, as
+# faixas ou a máscara invalida o conjunto. Liga-se com "stable_keypoints": true
+# em config_alignment.json.
+
+
+def select_stable_keypoints(template_img, sheets, config_path="config/config_alignment.json",
+                            template_path=None, lens=None, mask=None, tol_px=3.0, min_rate=0.6,
+                            max_keep=None, ratio=0.8):
+    """
+    Devolve {"indices" (nas features completas do template), "rate" (fração de folhas
+    em que cada keypoint reapareceu), "hash", "sheets" (alinhadas), "total"}.
+    """
+    with open(config_path, "r") as f:
+        cfg = json.load(f)
+    cfg["stable_keypoints"] = False          # contagem sobre todas as features do template
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_config = os.path.join(tmp, "config_alignment.json")
+        with open(tmp_config, "w") as f:
+            json.dump(cfg, f)
+        engine = AlignmentEngine(template_img, config_path=tmp_config, template_path=template_path,
+                                 lens=lens, mask=mask)
+        tpl_pts = engine._template_points()
+        hits = np.zeros(len(tpl_pts), np.int64)
+        aligned = 0
+        for img in sheets:
+            try:
+                _, H = engine.align(img)
+            except (ValueError, cv2.error) as e:
+                print("⚠️ Folha não alinhada, ignorada:", e)
+                continue
+            aligned += 1
+            kpts, desc = engine._features(_small_gray(img, engine.resize_scale), engine._tpl_params)
+            if desc is None:
+                continue
+            cur_idx, tpl_idx, _ = _ratio_matches(engine._knn_matcher("knn").knnMatch(desc, k=2), ratio)
+            if len(cur_idx) == 0:
+                continue
+            pts = np.float32([kpts[i].pt for i in cur_idx]) / engine.resize_scale
+            if engine.lens is not None:
+                pts = engine.lens.undistort_points(pts)
+            mapped = cv2.perspectiveTransform(pts.reshape(-1, 1, 2).astype(np.float64), H).reshape(-1, 2)
+            ok = np.hypot(*(mapped - tpl_pts[tpl_idx]).T) <= tol_px
+            hits[np.unique(tpl_idx[ok])] += 1
+
+    if aligned == 0:
+        raise ValueError("Nenhuma folha alinhada: não há conjunto estável.")
+    rate = hits / aligned
+    order = np.argsort(-rate, kind="stable")
+    order = order[rate[order] >= min_rate]
+    if max_keep is not None:
+        order = order[:int(max_keep)]
+    if len(order) < 4:
+        raise ValueError(f"Só {len(order)} keypoints estáveis (min_rate={min_rate}); baixar min_rate ou tol_px.")
+    indices = np.sort(order)
+    return {"indices": indices, "rate": rate[indices], "hash": engine.template_hash,
+            "sheets": aligned, "total": int(len(tpl_pts)), "path": engine.stable_keypoints_path()}
+
+
+def save_stable_keypoints(selection, path=None):
+    path = path or selection["path"]
+    if path is None:
+        raise ValueError("Sem caminho para o conjunto estável (template_path em falta).")
+    np.savez(path, hash=selection["hash"], indices=selection["indices"], rate=selection["rate"],
+             sheets=selection["sheets"])
+    return path
+
+
+if __name__ == "__main__":
+    # python -m models.stable_keypoints template.jpg "data/raw/*.jpg" [--mask mascara.png]
+    #        [--min-rate 0.6] [--tol 3] [--max-keep N]
+    import glob
+    import sys
+
+    from models.lens_calibration import load_lens_model
+
+    args = sys.argv[1:]
+    opts = {"--mask": None, "--min-rate": "0.6", "--tol": "3.0", "--max-keep": None}
+    for key in list(opts):
+        if key in args:
+            i = args.index(key)
+            opts[key] = args[i + 1]
+            del args[i:i + 2]
+    if len(args) < 2:
+        print('uso: python -m models.stable_keypoints template.jpg "data/raw/*.jpg" [--mask m.png] '
+              '[--min-rate 0.6] [--tol 3] [--max-keep N]')
+        sys.exit(1)
+
+    template = cv2.imread(args[0])
+    if template is None:
+        raise ValueError(f"Não foi possível ler o template: {args[0]}")
+    mask = cv2.imread(opts["--mask"], cv2.IMREAD_GRAYSCALE) if opts["--mask"] else None
+    paths = sorted(p for pattern in args[1:] for p in glob.glob(pattern) if p != args[0])
+    sheets = [img for img in (cv2.imread(p) for p in paths) if img is not None]
+    sel = select_stable_keypoints(
+        template, sheets, template_path=args[0], mask=mask,
+        lens=load_lens_model(image_size=template.shape[1::-1]),
+        tol_px=float(opts["--tol"]), min_rate=float(opts["--min-rate"]),
+        max_keep=int(opts["--max-keep"]) if opts["--max-keep"] else None)
+    print(f"{len(sel['indices'])} de {sel['total']} keypoints estáveis em {sel['sheets']} folhas "
+          f"(taxa média {sel['rate'].mean():.2f})")
+    print("guardado em", save_stable_keypoints(sel))
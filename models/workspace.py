@@ -0,0 +1,127 @@
+import numpy as np
+
+# ---------------------------
+# Workspace do detetor (buffers pré-alocados reutilizados entre folhas)
+# ---------------------------
+# detect_defects_with_model(..., workspace=ws) vai buscar aqui todos os
+# buffers do tamanho da ROI (gray/blur/LAB da imagem, máscaras, scores,
+# fusão, DSSIM) e escreve neles via dst=/out=. Os temporários dos estágios
+# (diffs, gates, morfologia, conversões float, escalas do MS-SSIM, cópia do
+# percentil exato) vêm de ws.scratch(...) por faixa: os estágios de uma faixa
+# correm em sequência e partilham os mesmos nomes.
+# Garantia (modo Full): depois da 1ª folha com a mesma ROI/tiles não há
+# alocações NumPy do tamanho da ROI por chamada; ficam só as saídas que
+# dependem da folha (contornos, tabela) e objetos pequenos. O scratch interno
+# do OpenCV (linhas de filtros/morfologia) não passa pelo NumPy.
+# Custo: o workspace segura todos os buffers ao mesmo tempo, por isso o pico
+# de RSS é maior do que sem workspace (os temporários antigos tinham vidas
+# disjuntas); o ganho é não haver alocação/libertação por folha.
+# Os modos Simple, por lata e coarse-to-fine não usam workspace.
+# Atenção: as máscaras devolvidas são vistas destes buffers e são
+# reescritas na chamada seguinte (copiar se for preciso guardá-las).
+
+
+def no_scratch(name, shape, dtype=np.uint8):
+    """Sem workspace: None nos dst=/out= e o OpenCV/NumPy alocam o resultado."""
+    return None
+
+
+def scoped(tmp, *prefix):
+    """tmp com nomes prefixados (p.ex. uma escala do MS-SSIM dentro da faixa)."""
+    if tmp is no_scratch:
+        return tmp
+    return lambda name, shape, dtype=np.uint8: tmp(prefix + (name,), shape, dtype)
+
+
+class DetectorWorkspace:
+    """Buffers por nome; um buffer só é realocado se mudar a forma ou o dtype."""
+
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8, zero=False):
+        shape = tuple(int(v) for v in shape)
+        dtype = np.dtype(dtype)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self._buffers[name] = buf
+            self.allocations += 1
+        if zero:
+            buf.fill(0)
+        return buf
+
+    def scratch(self, *prefix):
+        """tmp(nome, forma, dtype) -> buffer com chave prefix + (nome,) (ver no_scratch)."""
+        return lambda name, shape, dtype=np.uint8: self.get(prefix + (name,), shape, dtype)
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self._buffers.values())
+
+
+# ---------------------------
+# Medição de pico de RSS (com e sem workspace)
+# ---------------------------
+
+def _peak_rss_worker(use_workspace, shape, n_calls, queue):
+    import resource
+    import tracemalloc
+
+    import cv2
+    from models.defect_detector import TemplateModel, detect_defects_with_model
+
+    rng = np.random.default_rng(0)
+    H, W = shape
+    tpl = cv2.GaussianBlur(rng.integers(0, 256, (H, W, 3), dtype=np.uint8), (7, 7), 0)
+    cur = cv2.add(tpl, rng.integers(0, 6, tpl.shape, dtype=np.uint8))
+    mask = np.full((H, W), 255, np.uint8)
+    model = TemplateModel(tpl, mask)
+    ws = DetectorWorkspace() if use_workspace else None
+    args = (30, 30, 3, 1, 3, 1, 5, 10, 25, 25)
+    # só as máscaras: contornos/tabela são saídas por folha (milhares de blobs nesta imagem de ruído)
+    outputs = ("final", "dark", "bright", "blue", "red", "msssim", "fusion")
+
+    for _ in range(2):                                                           # aquecimento
+        detect_defects_with_model(model, cur, *args, outputs=outputs, workspace=ws, verbose=False)
+    tracemalloc.start()
+    for _ in range(n_calls):
+        detect_defects_with_model(model, cur, *args, outputs=outputs, workspace=ws, verbose=False)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss: KiB em Linux
+    queue.put({"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+               "traced_peak_mb": traced_peak / 2**20,
+               "workspace_mb": ws.nbytes / 2**20 if ws is not None else 0.0})
+
+
+def measure_peak_rss(shape=(3000, 4000), n_calls=3):
+    """
+    Pico de RSS (processo novo por variante, para o máximo não contaminar a
+    outra) e pico de memória Python/NumPy por folha (tracemalloc) sem e com
+    DetectorWorkspace, só com as saídas de máscara (sem contornos/tabela).
+    Devolve {"no_workspace": {...}, "workspace": {...}}.
+    """
+    import multiprocessing as mp
+
+    ctx = mp.get_context("spawn")
+    report = {}
+    for name, use_ws in (("no_workspace", False), ("workspace", True)):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_peak_rss_worker, args=(use_ws, shape, n_calls, queue))
+        proc.start()
+        report[name] = queue.get()
+        proc.join()
+    return report
+
+
+if __name__ == "__main__":
+    # python -m models.workspace [altura largura]
+    import sys
+
+    shape = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) >= 3 else (3000, 4000)
+    print(f"detect_defects {shape[1]}x{shape[0]} (modo Full, parâmetros por omissão, saídas de máscara)")
+    for name, r in measure_peak_rss(shape).items():
+        print(f"  {name:<13} pico RSS {r['peak_rss_mb']:8.1f} MB   pico alocado/folha {r['traced_peak_mb']:8.1f} MB"
+              f"   workspace {r['workspace_mb']:7.1f} MB")
@@ -0,0 +1,48 @@
+import cv2
+import pytest
+
+from models.coarse_fine import detect_defects_coarse_to_fine
+from models.defect_detector import detect_defects_with_model
+from tests.test_per_can import DET_KWARGS, _template
+
+# Coarse-to-fine vs modo Full na mesma folha: mesmo veredicto (folha limpa sem
+# defeitos, folha com defeitos nos mesmos sítios). Os limiares de percentil vêm
+# da folha (sheet_thresholds), não dos tiles que o rastreio marcou.
+
+DET_ARGS = (154, 124, 3, 1, 3, 1, 19, 255, 78, 112)
+DEFECTS = ((300, 400, 12, (0, 0, 0)), (800, 200, 9, (255, 255, 255)))
+
+
+def _boxes(contours):
+    return sorted(cv2.boundingRect(c) for c in contours)
+
+
+def _overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+@pytest.mark.parametrize("defective", [False, True])
+def test_coarse_agrees_with_full(defective):
+    model, sheet = _template()
+    if defective:
+        for x, y, r, color in DEFECTS:
+            cv2.circle(sheet, (x, y), r, color, -1)
+    full = detect_defects_with_model(model, sheet, *DET_ARGS, **DET_KWARGS)
+    coarse, telemetry = detect_defects_coarse_to_fine(model, sheet, *DET_ARGS, **DET_KWARGS)
+    full_boxes, coarse_boxes = _boxes(full[1]), _boxes(coarse[1])
+    assert telemetry["tiles_refined"] > 0
+    assert len(full_boxes) == len(coarse_boxes) == (len(DEFECTS) if defective else 0)
+    for fb, cb in zip(full_boxes, coarse_boxes):
+        assert _overlap(fb, cb), (fb, cb)
+
+
+
+def test_coarse_reuses_sheet_thresholds():
+    model, sheet = _template()
+    for x, y, r, color in DEFECTS:
+        cv2.circle(sheet, (x, y), r, color, -1)
+    first, t1 = detect_defects_coarse_to_fine(model, sheet, *DET_ARGS, max_reuse=4, **DET_KWARGS)
+    again, t2 = detect_defects_coarse_to_fine(model, sheet, *DET_ARGS, max_reuse=4, **DET_KWARGS)
+    assert t1["thresholds_cached"] is False and t2["thresholds_cached"] is True
+    assert t2["thresholds_s"] < t1["thresholds_s"]
+    assert _boxes(again[1]) == _boxes(first[1])
@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+import pytest
+
+from models.defect_detector import _filter_contours
+from models.defect_table import build_defect_table
+
+# Tabela de defeitos vs _filter_contours (findContours + contourArea/arcLength):
+# os mesmos blobs passam os filtros, incluindo linhas de 1 px (área de contorno
+# 0), formas em L, blobs com buracos e blobs dentro do buraco de outro.
+
+MIN_AREA = 19
+
+
+def _reference_boxes(mask, min_area):
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return sorted(cv2.boundingRect(c) for c in _filter_contours(contours, min_area))
+
+
+def _table_boxes(mask, min_area):
+    return sorted(tuple(int(v) for v in b) for b in build_defect_table(mask, None, min_area).bbox)
+
+
+def _shapes():
+    m = np.zeros((240, 320), np.uint8)
+    cv2.line(m, (10, 10), (50, 10), 255, 1)                     # linha de 1 px: contourArea 0
+    cv2.line(m, (10, 30), (60, 70), 255, 1)                     # diagonal de 1 px
+    cv2.line(m, (80, 10), (80, 60), 255, 1)                     # L de 1 px
+    cv2.line(m, (80, 60), (130, 60), 255, 1)
+    m[10:50, 150:154] = 255                                     # L com 4 px de largura
+    m[46:50, 150:200] = 255
+    cv2.rectangle(m, (10, 100), (70, 160), 255, 6)              # anel (blob com buraco)
+    cv2.circle(m, (40, 130), 6, 255, -1)                        # blob dentro do buraco do anel
+    cv2.rectangle(m, (100, 100), (140, 140), 255, -1)
+    m[115:125, 115:125] = 0                                     # bloco com buraco
+    m[200:202, 10:300] = 255                                    # filamento: circularidade < 0.02
+    cv2.circle(m, (250, 120), 3, 255, -1)                       # abaixo da área mínima
+    return m
+
+
+@pytest.mark.parametrize("min_area", [1, MIN_AREA, 60])
+def test_table_filters_match_filter_contours(min_area):
+    mask = _shapes()
+    assert _table_boxes(mask, min_area) == _reference_boxes(mask, min_area)
+
+
+def test_table_filters_match_filter_contours_random():
+    rng = np.random.default_rng(11)
+    for _ in range(200):
+        mask = np.zeros((96, 128), np.uint8)
+        for _ in range(int(rng.integers(1, 8))):
+            x0, y0 = (int(v) for v in rng.integers(0, (128, 96)))
+            x1, y1 = (int(v) for v in rng.integers(0, (128, 96)))
+            kind = rng.integers(0, 3)
+            if kind == 0:
+                cv2.line(mask, (x0, y0), (x1, y1), 255, int(rng.integers(1, 3)))
+            elif kind == 1:
+                cv2.rectangle(mask, (x0, y0), (x1, y1), 255, int(rng.choice([-1, 1, 3])))
+            else:
+                cv2.circle(mask, (x0, y0), int(rng.integers(1, 12)), 255, int(rng.choice([-1, 1, 2])))
+        assert _table_boxes(mask, MIN_AREA) == _reference_boxes(mask, MIN_AREA)
@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+import pytest
+
+from models.can_detector import build_can_regions, can_regions_pad, detect_defects_per_can, sheet_thresholds
+from models.defect_detector import TemplateModel
+
+# Deteção por lata: o veredicto de uma lata não depende das outras (saída cedo
+# com verdict_only, ordem das regiões).
+
+H, W = 768, 1024
+DET_ARGS = (40, 124, 3, 1, 3, 1, 19, 255, 78, 112)     # dark_threshold baixo: a lata 1 sai na fase barata
+DET_KWARGS = dict(use_ms_ssim=True, use_morph_maps=False, use_color_delta=False, verbose=False)
+
+
+def _template():
+    rng = np.random.default_rng(3)
+    yy, xx = np.mgrid[0:H, 0:W]
+    tpl = np.dstack([60 + 100 * xx / W, 80 + 80 * yy / H, 120 + 40 * np.sin(xx / 50.0)]).astype(np.uint8)
+    for _ in range(12):
+        x, y = int(rng.integers(50, W - 150)), int(rng.integers(50, H - 100))
+        color = tuple(int(v) for v in rng.integers(30, 220, 3))
+        cv2.rectangle(tpl, (x, y), (x + int(rng.integers(30, 120)), y + int(rng.integers(20, 80))), color, -1)
+        cv2.putText(tpl, "LATA", (x, y + int(rng.integers(10, 40))), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (20, 20, 20), 2)
+    tpl = cv2.GaussianBlur(tpl, (3, 3), 0)
+    mask = np.zeros((H, W), np.uint8)
+    cv2.rectangle(mask, (16, 16), (W - 16, H - 16), 255, -1)
+    clean = cv2.add(tpl, rng.integers(0, 4, tpl.shape, dtype=np.uint8))
+    return TemplateModel(tpl, mask, apply_mask=True), clean
+
+
+def _layout(rows=3, cols=4, size=180):
+    layout = []
+    for r in range(rows):
+        for c in range(cols):
+            x0, y0 = 60 + c * 230, 60 + r * 230
+            layout.append({"numero_lata": r * cols + c + 1,
+                           "points": [(x0, y0), (x0 + size, y0), (x0 + size, y0 + size), (x0, y0 + size)]})
+    return layout
+
+
+def _verdicts(regions, sheet, **kwargs):
+    res = detect_defects_per_can(regions, sheet, *DET_ARGS, workers=1, **DET_KWARGS, **kwargs)
+    return {n: r["rejected"] for n, r in res.items()}
+
+
+@pytest.mark.parametrize("sheet_level", [False, True])
+def test_can_verdict_independent_of_other_cans(sheet_level):
+    model, sheet = _template()
+    cv2.circle(sheet, (150, 150), 20, (0, 0, 0), -1)              # lata 1: escura, fase barata
+    cv2.circle(sheet, (380, 380), 10, (200, 200, 200), -1)        # lata 6
+    regions = build_can_regions(model, _layout(), pad=can_regions_pad())
+    thresholds = sheet_thresholds(model, sheet, *DET_ARGS, **DET_KWARGS) if sheet_level else None
+
+    ref = _verdicts(regions, sheet, thresholds=thresholds)
+    assert ref[1]
+    assert _verdicts(regions, sheet, thresholds=thresholds, verdict_only=True) == ref
+    assert _verdicts(regions[::-1], sheet, thresholds=thresholds, verdict_only=True) == ref
+    if sheet_level:     # limiares da folha: a mesma lata sozinha ou com as outras
+        for rg in regions:
+            assert _verdicts([rg], sheet, thresholds=thresholds)[rg.numero_lata] == ref[rg.numero_lata]
+
+
+def test_sheet_thresholds_reused_until_exposure_drifts():
+    model, sheet = _template()
+    kw = dict(DET_KWARGS, max_reuse=2, max_drift=2.0)
+    first = sheet_thresholds(model, sheet, *DET_ARGS, **kw)
+    again = sheet_thresholds(model, sheet, *DET_ARGS, **kw)
+    assert not first["cached"] and again["cached"]
+    assert again["thr"] == first["thr"] and again["ranges"] == first["ranges"]
+
+    brighter = cv2.add(sheet, np.full_like(sheet, 6))                     # exposição mudou -> recalcula
+    assert not sheet_thresholds(model, brighter, *DET_ARGS, **kw)["cached"]
+    assert sheet_thresholds(model, brighter, *DET_ARGS, **kw)["cached"]
+    assert sheet_thresholds(model, brighter, *DET_ARGS, **kw)["cached"]
+    assert not sheet_thresholds(model, brighter, *DET_ARGS, **kw)["cached"]   # max_reuse esgotado
+    # parâmetros diferentes: outra entrada da cache
+    assert not sheet_thresholds(model, sheet, *DET_ARGS, **dict(kw, msssim_percentile=99.0))["cached"]
+
+
+def test_sheet_thresholds_empty_population():
+    model, sheet = _template()
+    # tile_size=64: a amostra em xadrez não apanha o único tile com ROI depois da erosão
+    mask = np.zeros((H, W), np.uint8)
+    mask[8:56, 72:120] = 255                     # tile (0, 1): fora do xadrez (0*3 + 1) % 4
+    small = TemplateModel(model.tpl, mask, apply_mask=True)
+    thresholds = sheet_thresholds(small, sheet, *DET_ARGS, tile_size=64, sample_stride=4,
+                                  **dict(DET_KWARGS, roi_erode_px=2))
+    assert thresholds["thr"]["dssim"] is not None
+    with pytest.raises(ValueError, match="ROI vazio"):
+        sheet_thresholds(small, sheet, *DET_ARGS, tile_size=64, **dict(DET_KWARGS, roi_erode_px=30))
@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+import pytest
+
+from models.defect_detector import DETECTOR_OUTPUTS, TemplateModel, _split_strips, detect_defects_with_model
+
+# Execução em faixas (tiles/workers) do modo Full: o resultado tem de ser
+# bit-a-bit igual ao da execução sem faixas, incluindo um defeito cortado
+# pela fronteira entre faixas.
+
+H, W = 480, 640
+DET_ARGS = (154, 124, 3, 1, 3, 1, 19, 255, 78, 112)
+
+
+def _sheet():
+    rng = np.random.default_rng(7)
+    tpl = cv2.GaussianBlur(rng.integers(40, 200, (H, W, 3), dtype=np.uint8), (9, 9), 0)
+    mask = np.zeros((H, W), np.uint8)
+    cv2.rectangle(mask, (20, 20), (W - 20, H - 20), 255, -1)
+    aligned = cv2.add(tpl, rng.integers(0, 4, tpl.shape, dtype=np.uint8))
+    # defeitos: um a meio da fronteira das 2 faixas (y = H/2), outro na fronteira 1/4 das 4 faixas
+    y2 = _split_strips(H, 2, 0)[0][1]
+    y4 = _split_strips(H, 4, 0)[0][1]
+    cv2.circle(aligned, (W // 2, y2), 14, (0, 0, 0), -1)
+    cv2.rectangle(aligned, (100, y4 - 9), (160, y4 + 9), (255, 255, 255), -1)
+    cv2.circle(aligned, (480, 360), 10, (200, 40, 40), -1)
+    return TemplateModel(tpl, mask, apply_mask=True), aligned
+
+
+def _detect(model, aligned, fusion_mode, tiles, workers):
+    outputs = tuple(n for n in DETECTOR_OUTPUTS if n != "contours")
+    return detect_defects_with_model(
+        model, aligned, *DET_ARGS, use_ms_ssim=True, use_morph_maps=True, use_color_delta=True,
+        fusion_mode=fusion_mode, outputs=outputs, tiles=tiles, workers=workers, verbose=False)
+
+
+@pytest.mark.parametrize("fusion_mode", ["or", "weighted"])
+@pytest.mark.parametrize("tiles", [1, 2, 4])
+@pytest.mark.parametrize("workers", [1, 4])
+def test_tiled_equals_untiled(fusion_mode, tiles, workers):
+    model, aligned = _sheet()
+    ref = _detect(model, aligned, fusion_mode, None, None)
+    y2 = _split_strips(H, 2, 0)[0][1]
+    assert ref["final"][y2 - 3:y2 + 3, W // 2 - 3:W // 2 + 3].any(), "defeito na fronteira não detetado"
+    out = _detect(model, aligned, fusion_mode, tiles, workers)
+    for name, value in ref.items():
+        if name == "table":
+            for field in ("area", "bbox", "centroid", "perimeter", "type"):
+                np.testing.assert_array_equal(getattr(out[name], field), getattr(value, field), err_msg=field)
+        else:
+            np.testing.assert_array_equal(out[name], value, err_msg=name)
@@ -0,0 +1,54 @@
+import tracemalloc
+
+import cv2
+import numpy as np
+import pytest
+
+from models.defect_detector import detect_defects_with_model
+from models.workspace import DetectorWorkspace
+from tests.test_per_can import _template
+
+# Workspace do modo Full: depois do aquecimento uma folha não aloca nada do
+# tamanho da ROI (as saídas de máscara são vistas do workspace) e o resultado é
+# bit-a-bit igual ao da chamada sem workspace.
+
+DET_ARGS = (30, 30, 3, 1, 3, 1, 5, 10, 25, 25)
+MASKS = ("final", "dark", "bright", "blue", "red", "msssim", "fusion")
+CONFIGS = [
+    dict(),
+    dict(tiles=4, workers=4),
+    dict(ssim_backend="separable", percentile_method="histogram", fusion_mode="weighted", tiles=3),
+    dict(ssim_backend="separable", color_metric="l2ab", ignore_overexposed=True, suppress_border_width_px=4, tiles=2),
+]
+# 2/3 de uma máscara uint8 de 768x1024; medido 40-240 KB (histogramas de 4096
+# classes por faixa no percentil "histogram" e objetos pequenos)
+PEAK_BOUND = 512 * 1024
+
+
+def _detect(model, sheet, cfg, workspace=None):
+    return detect_defects_with_model(model, sheet, *DET_ARGS, outputs=MASKS, workspace=workspace,
+                                     verbose=False, **cfg)
+
+
+@pytest.mark.parametrize("cfg", CONFIGS)
+def test_workspace_call_allocates_no_roi_sized_buffers(cfg):
+    model, sheet = _template()
+    cv2.circle(sheet, (150, 150), 20, (0, 0, 0), -1)
+    cv2.circle(sheet, (380, 380), 10, (200, 200, 200), -1)
+    ws = DetectorWorkspace()
+    for _ in range(2):                  # aquecimento: buffers do workspace e caches do modelo
+        _detect(model, sheet, cfg, ws)
+    n_buffers = ws.allocations
+
+    tracemalloc.start()
+    try:
+        res = _detect(model, sheet, cfg, ws)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert ws.allocations == n_buffers
+    assert peak < PEAK_BOUND, f"pico por chamada {peak / 1024:.0f} KB"
+    ref = _detect(model, sheet, cfg)
+    for name in MASKS:
+        np.testing.assert_array_equal(res[name], ref[name], err_msg=name)
@@ -0,0 +1,210 @@
+import glob
+import json
+import os
+import time
+
+import cv2
+
+# ---------------------------
+# Fontes de frames para a inspeção (câmara, pasta vigiada, lista gravada)
+# ---------------------------
+# Todas expõem o mesmo contrato em dois passos, para o runner separar o
+# "quando" do "ler": wait() bloqueia até haver uma folha e devolve um item
+# (caminho do ficheiro ou instante do trigger), ou None quando a fonte acabou;
+# read(item) devolve o frame BGR (corre no estágio de captura do pipeline).
+# Só a CameraSource precisa do Picamera2, que não é importado aqui: quem abre
+# a câmara passa o objeto (open_camera importa-o só quando é chamado).
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.bmp", "*.tif", "*.tiff")
+
+
+def load_camera_params_from_json(path="config/camera_params.json"):
+    """
+    Lê os parâmetros guardados do template. Exemplo esperado:
+    {
+        "ExposureTime": 34900,
+        "AnalogueGain": 2.1,
+        "Brightness": 0.8,
+        "Contrast": 2.3,
+        "ColourGains": [2.3, 1.7]
+    }
+    """
+    try:
+        with open(path, "r") as f:
+            params = json.load(f)
+        return params
+    except Exception as e:
+        print(f"⚠️ Não consegui ler {path}: {e}")
+        return {}
+
+
+def build_controls_from_params(params: dict):
+    """
+    Converte o JSON em dict de controls para Picamera2.
+    Respeita AeEnable/AwbEnable guardados e só força manuais quando desativados.
+    """
+    ae_on = bool(params.get("AeEnable", False))
+    awb_on = bool(params.get("AwbEnable", False))
+
+    controls = {
+        "AeEnable": ae_on,
+        "AwbEnable": awb_on,
+    }
+
+    # Apenas aplica Exposure/Gain manuais quando AE está OFF
+    if not ae_on:
+        if "ExposureTime" in params:
+            controls["ExposureTime"] = int(params["ExposureTime"])  # µs
+            # Opcional: travar frame duration para estabilizar ainda mais
+            controls["FrameDurationLimits"] = (int(params["ExposureTime"]), int(params["ExposureTime"]))
+        if "AnalogueGain" in params:
+            controls["AnalogueGain"] = float(params["AnalogueGain"])
+
+    # Apenas aplica ColourGains manuais quando AWB está OFF
+    if not awb_on:
+        if "ColourGains" in params and isinstance(params["ColourGains"], (list, tuple)) and len(params["ColourGains"]) == 2:
+            rg, bg = params["ColourGains"]
+            controls["ColourGains"] = (float(rg), float(bg))
+
+    # Estes podem ser sempre aplicados
+    if "Brightness" in params:
+        controls["Brightness"] = float(params["Brightness"])
+    if "Contrast" in params:
+        controls["Contrast"] = float(params["Contrast"])
+    # Se tiveres "Saturation" e "Sharpness" no futuro, também dá:
+    # if "Saturation" in params: controls["Saturation"] = float(params["Saturation"])
+    # if "Sharpness"  in params: controls["Sharpness"]  = float(params["Sharpness"])
+    return controls
+
+
+def start_camera(picam2, params_path="config/camera_params.json", size=(4056, 3040)):
+    """Configura (still, BGR888) e arranca a câmara com os controls guardados; devolve os controls."""
+    controls = build_controls_from_params(load_camera_params_from_json(params_path))
+    # passa os controls logo na configuração (garante que arranca no modo correto)
+    config = picam2.create_still_configuration(main={"size": tuple(size), "format": "BGR888"}, controls=controls)
+    picam2.configure(config)
+    picam2.start()
+    time.sleep(0.3)  # breve estabilização
+
+    # reforça os controls após start (algumas versões aplicam melhor depois do start)
+    try:
+        picam2.set_controls(controls)
+    except Exception as e:
+        print("⚠️ set_controls após start falhou:", e)
+    return controls
+
+
+def open_camera(params_path="config/camera_params.json"):
+    """Picamera2 configurada e a correr (import só aqui: o resto do módulo não precisa dela)."""
+    from picamera2 import Picamera2
+
+    picam2 = Picamera2()
+    controls = start_camera(picam2, params_path)
+    print("[INFO] Controles da câmara aplicados:", controls)
+    return picam2
+
+
+class CameraSource:
+    """Captura da Picamera2 no momento pedido: wait() devolve o instante, read() bloqueia AE/AWB e captura."""
+
+    def __init__(self, picam2, settle_s=0.05):
+        self.picam2 = picam2
+        self.settle_s = float(settle_s)
+
+    def wait(self):
+        return time.time()
+
+    def read(self, item=None):
+        # Bloquear AE/AWB ANTES da captura (para estabilizar a exposição)
+        self.picam2.set_controls({"AeEnable": False, "AwbEnable": False})
+        time.sleep(self.settle_s)
+        frame = self.picam2.capture_array("main")
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+
+class FileListSource:
+    """Folhas gravadas por ordem (caminhos ou padrões glob); loop=True recomeça do início."""
+
+    def __init__(self, paths, loop=False):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = [p for pattern in paths for p in (sorted(glob.glob(pattern)) or [pattern])]
+        if not self.paths:
+            raise ValueError("Lista de folhas vazia.")
+        self.loop = bool(loop)
+        self._next = 0
+
+    def wait(self):
+        if self._next >= len(self.paths):
+            if not self.loop:
+                return None
+            self._next = 0
+        path = self.paths[self._next]
+        self._next += 1
+        return path
+
+    def read(self, item):
+        frame = cv2.imread(item)
+        if frame is None:
+            raise ValueError(f"Não foi possível ler a folha: {item}")
+        return frame
+
+
+class FolderSource:
+    """
+    Pasta vigiada: cada imagem nova (por ordem de modificação) é uma folha. Com
+    watch=False só as que já existem; com watch espera até idle_timeout_s sem
+    novidades (None = para sempre). Um ficheiro só entra depois de o tamanho
+    estabilizar entre duas leituras (cópia ainda em curso).
+    """
+
+    def __init__(self, folder, patterns=IMAGE_PATTERNS, watch=True, poll_s=0.2, idle_timeout_s=None):
+        if not os.path.isdir(folder):
+            raise ValueError(f"Pasta não encontrada: {folder}")
+        self.folder = folder
+        self.patterns = tuple(patterns)
+        self.watch = bool(watch)
+        self.poll_s = float(poll_s)
+        self.idle_timeout_s = idle_timeout_s
+        self._seen = set()
+        self._sizes = {}
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def _ready(self):
+        paths = [p for pattern in self.patterns for p in glob.glob(os.path.join(self.folder, pattern))]
+        ready = []
+        for p in paths:
+            if p in self._seen:
+                continue
+            try:
+                size = os.path.getsize(p)
+            except OSError:
+                continue
+            if not self.watch or self._sizes.get(p) == size:
+                ready.append(p)
+            self._sizes[p] = size
+        return sorted(ready, key=lambda p: (os.path.getmtime(p), p))
+
+    def wait(self):
+        last_new = time.monotonic()
+        while not self._stopped:
+            ready = self._ready()
+            if ready:
+                self._seen.add(ready[0])
+                self._sizes.pop(ready[0], None)
+                return ready[0]
+            if not self.watch:
+                return None
+            if self.idle_timeout_s is not None and time.monotonic() - last_new > self.idle_timeout_s:
+                return None
+            time.sleep(self.poll_s)
+        return None
+
+    def read(self, item):
+        frame = cv2.imread(item)
+        if frame is None:
+            raise ValueError(f"Não foi possível ler a folha: {item}")
+        return frame
@@ -1,3 +1,6 @@
+import threading
+import time
+
 try:
     import RPi.GPIO as GPIO  # type: ignore
     _GPIO_AVAILABLE = True
@@ -6,31 +9,151 @@ except Exception:
     _GPIO_AVAILABLE = False
 
 
+class FakeGPIO:
+    """In-memory stand-in for the subset of RPi.GPIO used here (off-Pi tests and replays).
+
+    - `set_input(pin, level)` changes a pin and fires its edge callbacks like the real
+      module does (callback(channel) on a background thread for `replay`).
+    - `replay(schedule)` plays [(t_s, pin, level), ...] relative to the call time on a
+      daemon thread; `wait_replay()` joins it.
+    - `bouncetime` is accepted and ignored: debounce is done by the caller.
+    - Outputs are kept as levels too; `outputs` records (perf_counter, pin, level) writes.
+    """
+
+    BCM, BOARD = "BCM", "BOARD"
+    IN, OUT = "IN", "OUT"
+    LOW, HIGH = False, True
+    PUD_UP, PUD_DOWN = "PUD_UP", "PUD_DOWN"
+    RISING, FALLING, BOTH = "RISING", "FALLING", "BOTH"
+
+    def __init__(self):
+        self._levels = {}
+        self._detect = {}
+        self._lock = threading.Lock()
+        self._replay_thread = None
+        self._replay_stop = threading.Event()
+        self.outputs = []
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        with self._lock:
+            if direction == self.OUT:
+                self._levels[pin] = bool(initial)
+            else:
+                self._levels[pin] = pull_up_down != self.PUD_DOWN
+
+    def output(self, pin, level):
+        with self._lock:
+            self._levels[pin] = bool(level)
+            self.outputs.append((time.perf_counter(), pin, bool(level)))
+
+    def input(self, pin):
+        with self._lock:
+            return self._levels.get(pin, True)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            if pin in self._detect:
+                raise RuntimeError(f"Conflicting edge detection already enabled for this GPIO channel ({pin})")
+            self._detect[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detect.pop(pin, None)
+
+    def cleanup(self, pins=None):
+        self._replay_stop.set()
+        with self._lock:
+            for p in (list(self._levels) if pins is None else pins):
+                self._detect.pop(p, None)
+                self._levels.pop(p, None)
+
+    def set_input(self, pin, level):
+        level = bool(level)
+        with self._lock:
+            previous = self._levels.get(pin, True)
+            self._levels[pin] = level
+            edge, callback = self._detect.get(pin, (None, None))
+        if callback is None or previous == level:
+            return
+        if edge == self.BOTH or edge == (self.RISING if level else self.FALLING):
+            callback(pin)
+
+    def replay(self, schedule):
+        events = sorted((float(t), pin, bool(level)) for t, pin, level in schedule)
+        self._replay_stop.clear()
+
+        def _run():
+            start = time.monotonic()
+            for t, pin, level in events:
+                delay = start + t - time.monotonic()
+                if delay > 0 and self._replay_stop.wait(delay):
+                    return
+                self.set_input(pin, level)
+
+        self._replay_thread = threading.Thread(target=_run, name="fake-gpio-replay", daemon=True)
+        self._replay_thread.start()
+        return self._replay_thread
+
+    def wait_replay(self, timeout=None):
+        if self._replay_thread is not None:
+            self._replay_thread.join(timeout)
+
+
+def pulse_schedule(times_s, pin, pulse_ms=100.0, active_low=True, bounce_ms=0.0, bounces=0):
+    """Edge list for `FakeGPIO.replay`: one sensor pulse per time, optionally with contact bounce."""
+    active, idle = (False, True) if active_low else (True, False)
+    schedule = []
+    for t in times_s:
+        t = float(t)
+        schedule.append((t, pin, active))
+        step = float(bounce_ms) / 1000.0 / (2 * int(bounces)) if bounces else 0.0
+        for k in range(int(bounces)):
+            schedule.append((t + (2 * k + 1) * step, pin, idle))
+            schedule.append((t + (2 * k + 2) * step, pin, active))
+        schedule.append((t + float(pulse_ms) / 1000.0, pin, idle))
+    return schedule
+
+
 class RaspberryGPIO:
     """Lightweight GPIO reader wrapper.
 
     - Initializes the given pins as inputs with optional pull (UP/DOWN).
     - Provides `read_states()` -> {pin: bool} and `cleanup()`.
+    - `watch_edges(callback)` registers both-edge interrupts: callback(pin, level, t)
+      with t = time.perf_counter() taken as soon as the callback runs.
+    - `outputs` pins are set up as outputs (initially inactive); `write(pin, active)`
+      drives them, honouring `active_high`.
+    - `backend` replaces RPi.GPIO (e.g. `FakeGPIO()` off-Pi); same API subset.
     - Safe to use off-Pi; methods degrade gracefully when GPIO is unavailable.
     """
 
-    def __init__(self, pins, mode='BCM', pull='UP'):
+    def __init__(self, pins, mode='BCM', pull='UP', backend=None, outputs=None, active_high=True):
         self.pins = list(pins or [])
-        self.available = _GPIO_AVAILABLE and len(self.pins) > 0
+        self.out_pins = list(outputs or [])
+        self.active_high = bool(active_high)
+        self.gpio = backend if backend is not None else GPIO
+        self.available = (backend is not None or _GPIO_AVAILABLE) and len(self.pins) + len(self.out_pins) > 0
         self._configured = False
+        self._watched = []
         if not self.available:
             return
+        gpio = self.gpio
         try:
             if mode == 'BCM':
-                GPIO.setmode(GPIO.BCM)
+                gpio.setmode(gpio.BCM)
             else:
-                GPIO.setmode(GPIO.BOARD)
-            pud = GPIO.PUD_UP if str(pull).upper() == 'UP' else GPIO.PUD_DOWN
+                gpio.setmode(gpio.BOARD)
+            pud = gpio.PUD_UP if str(pull).upper() == 'UP' else gpio.PUD_DOWN
             for p in self.pins:
                 try:
-                    GPIO.setup(p, GPIO.IN, pull_up_down=pud)
+                    gpio.setup(p, gpio.IN, pull_up_down=pud)
                 except Exception:
-                    GPIO.setup(p, GPIO.IN)
+                    gpio.setup(p, gpio.IN)
+            for p in self.out_pins:
+                gpio.setup(p, gpio.OUT, initial=gpio.LOW if self.active_high else gpio.HIGH)
             self._configured = True
         except Exception:
             self.available = False
@@ -42,16 +165,58 @@ class RaspberryGPIO:
         states = {}
         for p in self.pins:
             try:
-                states[p] = bool(GPIO.input(p))
+                states[p] = bool(self.gpio.input(p))
             except Exception:
                 states[p] = False
         return states
 
+    def write(self, pin, active):
+        """Drive an output pin active/inactive. Returns False if GPIO is unavailable."""
+        if not (self.available and self._configured):
+            return False
+        level = bool(active) == self.active_high
+        try:
+            self.gpio.output(pin, self.gpio.HIGH if level else self.gpio.LOW)
+        except Exception:
+            return False
+        return True
+
+    def watch_edges(self, callback, pins=None):
+        """Both-edge interrupts on `pins` (default: all). Returns True if every pin is watched."""
+        if not (self.available and self._configured):
+            return False
+        gpio = self.gpio
+
+        def _on_edge(channel):
+            t = time.perf_counter()
+            try:
+                level = bool(gpio.input(channel))
+            except Exception:
+                return
+            callback(channel, level, t)
+
+        ok = True
+        for p in (self.pins if pins is None else pins):
+            try:
+                gpio.add_event_detect(p, gpio.BOTH, callback=_on_edge)
+                self._watched.append(p)
+            except Exception:
+                ok = False
+        return ok
+
+    def unwatch_edges(self):
+        for p in self._watched:
+            try:
+                self.gpio.remove_event_detect(p)
+            except Exception:
+                pass
+        self._watched = []
+
     def cleanup(self):
         if not (self.available and self._configured):
             return
+        self.unwatch_edges()
         try:
-            GPIO.cleanup(self.pins)
+            self.gpio.cleanup(self.pins + self.out_pins)
         except Exception:
             pass
-
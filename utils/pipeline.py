@@ -0,0 +1,197 @@
+import queue
+import threading
+import time
+from collections import deque
+
+from utils.profiler import PROFILER
+
+# ---------------------------
+# Pipeline de folhas por estágios (produtor/consumidor, fora da thread da GUI)
+# ---------------------------
+# Cada estágio (captura -> alinhamento -> deteção -> classificação -> render)
+# corre numa thread própria e recebe as folhas por uma fila limitada: enquanto
+# a folha N está na deteção, a N+1 já pode ser capturada e alinhada. Um só
+# worker por estágio de propósito: a câmara, o AlignmentEngine e o workspace
+# do detetor não são thread-safe, e o paralelismo dentro de um estágio já
+# existe (faixas do detetor). Cada estágio é fn(folha) -> folha (dict); uma
+# exceção descarta essa folha (on_error) sem parar a thread.
+#
+# Entre estágios a fila cheia bloqueia o estágio anterior (backpressure até à
+# entrada). A política só se aplica à entrada (submit), quando a fila do 1.º
+# estágio está cheia:
+#   "block"       espera até block_timeout_s e só então descarta (para
+#                 produtores em thread própria: trigger GPIO, runner);
+#   "drop_newest" recusa a folha nova (nunca bloqueia: o que a GUI usa);
+#   "drop_oldest" descarta a mais antiga em espera e aceita a nova.
+# As folhas descartadas vão para on_drop. Throughput: ThroughputMeter sobre as
+# folhas concluídas numa janela rolante (folhas/minuto).
+
+DROP_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+_STOP = object()
+
+
+class ThroughputMeter:
+    """Folhas/minuto sobre as conclusões dos últimos window_s segundos."""
+
+    def __init__(self, window_s=60.0):
+        self.window_s = float(window_s)
+        self._stamps = deque()
+        self._lock = threading.Lock()
+
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._stamps.append(now)
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._stamps and now - self._stamps[0] > self.window_s:
+            self._stamps.popleft()
+
+    def per_minute(self, now=None):
+        """Conclusões/minuto na janela (entre a 1.ª e a última; 0 com menos de 2)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._trim(now)
+            if len(self._stamps) < 2:
+                return 0.0
+            span = self._stamps[-1] - self._stamps[0]
+            return 60.0 * (len(self._stamps) - 1) / span if span > 0 else 0.0
+
+    def reset(self):
+        with self._lock:
+            self._stamps.clear()
+
+
+class SheetPipeline:
+    """Estágios [(nome, fn)] ligados por filas limitadas, um worker por estágio."""
+
+    def __init__(self, stages, queue_size=2, drop_policy="block", block_timeout_s=2.0,
+                 on_result=None, on_drop=None, on_error=None, throughput_window_s=60.0):
+        if not stages:
+            raise ValueError("Pipeline sem estágios.")
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Política desconhecida: {drop_policy} (opções: {', '.join(DROP_POLICIES)})")
+        self.stages = [(str(name), fn) for name, fn in stages]
+        self.queue_size = max(1, int(queue_size))
+        self.drop_policy = drop_policy
+        self.block_timeout_s = float(block_timeout_s)
+        self.on_result = on_result      # fn(folha) na thread do último estágio
+        self.on_drop = on_drop          # fn(folha) na thread de quem submeteu
+        self.on_error = on_error        # fn(folha, nome do estágio, exceção)
+        self.throughput = ThroughputMeter(throughput_window_s)
+        self._queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        self._threads = []
+        self._submit_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self.submitted = self.completed = self.dropped = self.errors = 0
+        self._dropped_inside = 0   # aceites e depois descartadas (drop_oldest / stop sem drain)
+
+    # ---- ciclo de vida ----
+    def start(self):
+        if self._threads:
+            return self
+        for i, (name, fn) in enumerate(self.stages):
+            t = threading.Thread(target=self._worker, args=(i, name, fn), name=f"pipeline-{name}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, drain=True, timeout=None):
+        """Pára os workers; drain=False descarta as folhas ainda em espera (on_drop)."""
+        if not self._threads:
+            return
+        if not drain:
+            for q in self._queues:
+                self._discard_waiting(q)
+        self._queues[0].put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    # ---- entrada ----
+    def submit(self, sheet):
+        """Entra uma folha no 1.º estágio segundo a drop_policy; devolve False se foi descartada."""
+        q = self._queues[0]
+        with self._submit_lock:
+            try:
+                if self.drop_policy == "block":
+                    q.put(sheet, timeout=self.block_timeout_s)
+                else:
+                    q.put_nowait(sheet)
+            except queue.Full:
+                if self.drop_policy != "drop_oldest":
+                    self._drop(sheet)
+                    return False
+                try:
+                    self._drop(q.get_nowait(), accepted=True)
+                except queue.Empty:
+                    pass
+                q.put_nowait(sheet)
+            with self._count_lock:
+                self.submitted += 1
+        return True
+
+    def in_flight(self):
+        with self._count_lock:
+            return self.submitted - self.completed - self.errors - self._dropped_inside
+
+    def stats(self):
+        """{"submitted", "completed", "dropped", "errors", "in_flight", "queue_depths", "sheets_per_min"}."""
+        with self._count_lock:
+            out = {"submitted": self.submitted, "completed": self.completed, "dropped": self.dropped,
+                   "errors": self.errors}
+        out["in_flight"] = self.in_flight()
+        out["queue_depths"] = {name: q.qsize() for (name, _), q in zip(self.stages, self._queues)}
+        out["sheets_per_min"] = self.throughput.per_minute()
+        return out
+
+    # ---- internos ----
+    def _drop(self, sheet, accepted=False):
+        with self._count_lock:
+            self.dropped += 1
+            if accepted:
+                self._dropped_inside += 1
+        if self.on_drop is not None:
+            self.on_drop(sheet)
+
+    def _discard_waiting(self, q):
+        while True:
+            try:
+                sheet = q.get_nowait()
+            except queue.Empty:
+                return
+            if sheet is not _STOP:
+                self._drop(sheet, accepted=True)
+
+    def _worker(self, index, name, fn):
+        inbox = self._queues[index]
+        outbox = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        while True:
+            sheet = inbox.get()
+            if sheet is _STOP:
+                if outbox is not None:
+                    outbox.put(_STOP)
+                return
+            try:
+                with PROFILER.span(f"pipeline.{name}"):
+                    sheet = fn(sheet)
+            except Exception as e:
+                with self._count_lock:
+                    self.errors += 1
+                if self.on_error is not None:
+                    self.on_error(sheet, name, e)
+                continue
+            if outbox is not None:
+                outbox.put(sheet)          # bloqueia com o estágio seguinte cheio (backpressure)
+                continue
+            with self._count_lock:
+                self.completed += 1
+            self.throughput.tick()
+            if self.on_result is not None:
+                self.on_result(sheet)
@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# ---------------------------
+# Profiler por estágio (spans por folha + histograma rolante + Chrome trace)
+# ---------------------------
+# Uso:
+#   from utils.profiler import PROFILER
+#   with PROFILER.sheet():              # uma folha = um trace
+#       with PROFILER.span("align"):
+#           ...
+#       sp = PROFILER.start("render")   # forma manual (blocos grandes)
+#       ...
+#       sp.stop()
+# Cada span fecha numa janela rolante de durações por nome (p50/p95/p99 em
+# stats()/report()); os spans da folha em curso vão para o trace, exportável
+# em JSON do Chrome (chrome://tracing ou https://ui.perfetto.dev).
+# Desligado (omissão), span()/start() devolvem um objeto nulo partilhado:
+# custo = uma chamada e um teste de atributo. Liga-se com PROFILER.enabled =
+# True ou com a variável de ambiente INSPECTION_PROFILE=1.
+# Os spans podem vir de várias threads (faixas do detetor): tid no trace.
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def stop(self):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("_profiler", "name", "_t0")
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self.name = name
+        self._t0 = time.perf_counter_ns()
+
+    def __enter__(self):
+        self._t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def stop(self):
+        if self._t0 is not None:
+            self._profiler._record(self.name, self._t0, time.perf_counter_ns())
+            self._t0 = None
+
+
+class StageProfiler:
+    """Spans por estágio: janela rolante de durações por nome e traces das últimas folhas."""
+
+    def __init__(self, enabled=False, window=500, max_traces=20):
+        self.enabled = bool(enabled)
+        self.window = int(window)
+        self._durations = {}                      # nome -> deque de durações (ms)
+        self._traces = deque(maxlen=int(max_traces))
+        self._current = None                      # eventos da folha em curso
+        self._origin_ns = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    # ---- spans ----
+    def span(self, name):
+        """Context manager que mede o bloco (nulo se desligado)."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def start(self, name):
+        """Span já iniciado; fecha com .stop() (nulo se desligado)."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def sheet(self, name="sheet"):
+        """Context manager de uma folha: abre um trace novo e mede a folha inteira."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _SheetSpan(self, name)
+
+    def _record(self, name, t0_ns, t1_ns):
+        dur_ms = (t1_ns - t0_ns) / 1e6
+        with self._lock:
+            hist = self._durations.get(name)
+            if hist is None:
+                hist = self._durations[name] = deque(maxlen=self.window)
+            hist.append(dur_ms)
+            if self._current is not None:
+                self._current.append((name, t0_ns, t1_ns, threading.get_ident()))
+
+    # ---- estatísticas ----
+    def stats(self):
+        """{nome: {"n", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"}} sobre a janela rolante."""
+        with self._lock:
+            snapshot = {name: np.fromiter(d, np.float64, len(d)) for name, d in self._durations.items()}
+        out = {}
+        for name, v in snapshot.items():
+            if v.size == 0:
+                continue
+            p50, p95, p99 = np.percentile(v, (50, 95, 99))
+            out[name] = {"n": int(v.size), "mean_ms": float(v.mean()), "p50_ms": float(p50),
+                         "p95_ms": float(p95), "p99_ms": float(p99), "max_ms": float(v.max())}
+        return out
+
+    def report(self):
+        """Tabela de texto das stats(), ordenada por p50 decrescente."""
+        rows = sorted(self.stats().items(), key=lambda kv: -kv[1]["p50_ms"])
+        lines = [f"{'estágio':<28}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)"]
+        for name, s in rows:
+            lines.append(f"{name:<28}{s['n']:>6}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}"
+                         f"{s['p99_ms']:>10.2f}{s['max_ms']:>10.2f}")
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._traces.clear()
+            self._current = None
+
+    # ---- Chrome trace ----
+    def chrome_trace(self, last=None):
+        """Dict no formato Chrome trace (eventos "X") com as últimas `last` folhas (todas por omissão)."""
+        with self._lock:
+            traces = list(self._traces)
+        if last is not None:
+            traces = traces[-int(last):]
+        pid = os.getpid()
+        events = []
+        for trace in traces:
+            for name, t0, t1, tid in trace:
+                events.append({"name": name, "cat": name.split(".")[0], "ph": "X", "pid": pid, "tid": tid,
+                               "ts": (t0 - self._origin_ns) / 1e3, "dur": (t1 - t0) / 1e3})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path, last=None):
+        """Escreve chrome_trace() em path (JSON); devolve o path."""
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(last), f)
+        return path
+
+
+class _SheetSpan(_Span):
+    __slots__ = ()
+
+    def __enter__(self):
+        with self._profiler._lock:
+            self._profiler._current = []
+        return super().__enter__()
+
+    def stop(self):
+        if self._t0 is None:
+            return
+        super().stop()
+        p = self._profiler
+        with p._lock:
+            if p._current is not None:
+                p._traces.append(p._current)
+                p._current = None
+
+
+PROFILER = StageProfiler(enabled=os.environ.get("INSPECTION_PROFILE", "") not in ("", "0"))
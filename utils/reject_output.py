@@ -0,0 +1,176 @@
+import heapq
+import threading
+import time
+from collections import deque
+
+from utils.gpio_rapsberry import FakeGPIO, RaspberryGPIO
+from utils.trigger import LatencyStats
+
+# ---------------------------
+# Saída rejeitar/aceitar para o desviador, com prazo por folha e watchdog
+# ---------------------------
+# arm(seq, t0) no trigger (ou no início da folha) abre o prazo t0 + deadline_ms;
+# deliver(seq, ok) quando o veredicto existe (fim da classificação). Uma thread
+# de watchdog (heap de instantes) trata o resto:
+#   - prazo expirado sem veredicto -> veredicto fail-safe (por omissão
+#     "reject": folha que o pipeline não viu, descartou ou em que falhou não
+#     passa como boa) e conta um miss; um veredicto que chegue depois só conta
+#     como "late" (a saída já foi dada);
+#   - fim dos impulsos (pulse_ms) nos pinos de saída.
+# Modos: "asap" liga a saída logo no deliver; "deadline" guarda o veredicto e
+# liga-a exatamente no prazo (latência constante para o desviador; o erro de
+# temporização do watchdog fica em "jitter"). Métricas: folga (prazo - chegada
+# do veredicto, ms; negativa = atrasado) em janela rolante, misses, late,
+# fail-safe, rejeitadas/aceites.
+
+OUTPUT_MODES = ("asap", "deadline")
+FAILSAFE_VERDICTS = ("reject", "accept")
+
+
+class RejectOutput:
+    """Impulso no pino de rejeição (ou de aceitação) por folha, dentro do prazo desde o trigger."""
+
+    def __init__(self, gpio, reject_pin, accept_pin=None, deadline_ms=1500.0, pulse_ms=100.0,
+                 failsafe="reject", mode="asap", on_output=None, window=1000):
+        if failsafe not in FAILSAFE_VERDICTS:
+            raise ValueError(f"Fail-safe desconhecido: {failsafe} (opções: {', '.join(FAILSAFE_VERDICTS)})")
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Modo desconhecido: {mode} (opções: {', '.join(OUTPUT_MODES)})")
+        self.gpio = gpio
+        self.reject_pin = int(reject_pin)
+        self.accept_pin = None if accept_pin is None else int(accept_pin)
+        self.deadline_s = float(deadline_ms) / 1000.0
+        self.pulse_s = float(pulse_ms) / 1000.0
+        self.failsafe = failsafe
+        self.mode = mode
+        self.on_output = on_output      # fn(seq, "reject"|"accept", motivo) na thread que liga a saída
+        self.slack = LatencyStats(window)
+        self.jitter = LatencyStats(window)
+        self.counts = {"armed": 0, "on_time": 0, "misses": 0, "late": 0, "failsafe": 0,
+                       "rejects": 0, "accepts": 0, "unknown": 0}
+        self._pending = {}              # seq -> {"deadline": t, "ok": None | bool}
+        self._release_at = {}           # pino -> fim do último impulso
+        self._expired = deque(maxlen=int(window))   # folhas que já levaram o fail-safe
+        self._heap = []                 # (t, ordem, tipo, chave)
+        self._order = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._watchdog, name="reject-watchdog", daemon=True)
+        self._thread.start()
+
+    # ---- API ----
+    def arm(self, seq, t0=None):
+        """Abre o prazo da folha seq (t0 em time.perf_counter(), ex. o instante do trigger)."""
+        t0 = time.perf_counter() if t0 is None else float(t0)
+        with self._cond:
+            self._pending[seq] = {"deadline": t0 + self.deadline_s, "ok": None}
+            self.counts["armed"] += 1
+            self._push(t0 + self.deadline_s, "deadline", seq)
+
+    def deliver(self, seq, ok):
+        """
+        Veredicto da folha (ok=True -> aceitar). Devolve {"output", "slack_ms"}; output é
+        "accept"/"reject" (ou "pending" no modo deadline), "late" depois do fail-safe e
+        "unknown" para uma folha não armada.
+        """
+        now = time.perf_counter()
+        with self._cond:
+            entry = self._pending.get(seq)
+            if entry is None:
+                output = "late" if seq in self._expired else "unknown"
+                self.counts[output] += 1
+                return {"output": output, "slack_ms": None}
+            slack_ms = (entry["deadline"] - now) * 1000.0
+            self.slack.add(slack_ms)
+            self.counts["on_time"] += 1
+            verdict = "accept" if ok else "reject"
+            if self.mode == "deadline":
+                entry["ok"] = bool(ok)
+                return {"output": "pending", "slack_ms": slack_ms}
+            del self._pending[seq]
+            self._drive(seq, verdict, "verdict")
+        return {"output": verdict, "slack_ms": slack_ms}
+
+    def stats(self):
+        """Contagens + "miss_rate" + "slack" (p5/p50 ms) + "jitter" (modo deadline)."""
+        with self._cond:
+            out = dict(self.counts)
+            out["pending"] = len(self._pending)
+        decided = out["on_time"] + out["misses"]
+        out["miss_rate"] = out["misses"] / decided if decided else 0.0
+        out["slack"] = self.slack.summary((5, 50))
+        out["jitter"] = self.jitter.summary((50, 95))
+        return out
+
+    def wait_idle(self, timeout=None):
+        """Espera até não haver folhas com prazo aberto; False se o timeout chegar antes."""
+        deadline = None if timeout is None else time.monotonic() + float(timeout)
+        with self._cond:
+            while self._pending:
+                remaining = 0.05 if deadline is None else min(0.05, deadline - time.monotonic())
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        """Pára o watchdog e desliga as saídas."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(1.0)
+        for pin in (self.reject_pin, self.accept_pin):
+            if pin is not None:
+                self.gpio.write(pin, False)
+
+    # ---- internos ----
+    def _push(self, t, kind, key):
+        self._order += 1
+        heapq.heappush(self._heap, (t, self._order, kind, key))
+        self._cond.notify()
+
+    def _drive(self, seq, verdict, reason):
+        """Liga o pino do veredicto por pulse_s (chamado com o lock)."""
+        self.counts["rejects" if verdict == "reject" else "accepts"] += 1
+        pin = self.reject_pin if verdict == "reject" else self.accept_pin
+        if pin is not None:
+            self.gpio.write(pin, True)
+            end = time.perf_counter() + self.pulse_s
+            self._release_at[pin] = end
+            self._push(end, "release", pin)
+        if self.on_output is not None:
+            self.on_output(seq, verdict, reason)
+
+    def _watchdog(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.perf_counter()
+                if not self._heap or self._heap[0][0] > now:
+                    self._cond.wait(None if not self._heap else self._heap[0][0] - now)
+                    continue
+                t, _, kind, key = heapq.heappop(self._heap)
+                if kind == "release":
+                    if self._release_at.get(key, 0.0) <= now:     # impulso mais recente já acabou
+                        self.gpio.write(key, False)
+                    continue
+                entry = self._pending.pop(key, None)
+                if entry is None:                                  # entregue a tempo (modo asap)
+                    continue
+                if entry["ok"] is None:
+                    self.counts["misses"] += 1
+                    self.counts["failsafe"] += 1
+                    self._expired.append(key)
+                    self._drive(key, self.failsafe, "deadline")
+                else:
+                    self.jitter.add((now - t) * 1000.0)
+                    self._drive(key, "accept" if entry["ok"] else "reject", "verdict")
+
+
+def open_reject_output(reject_pin, accept_pin=None, backend="auto", active_high=True, **kwargs):
+    """RejectOutput num RaspberryGPIO só de saídas: backend "auto" (RPi.GPIO) ou "fake" (FakeGPIO)."""
+    pins = [reject_pin] + ([accept_pin] if accept_pin is not None else [])
+    gpio = RaspberryGPIO([], backend=FakeGPIO() if backend == "fake" else None, outputs=pins,
+                         active_high=active_high)
+    if not gpio.available:
+        raise ValueError("GPIO de saída indisponível (RPi.GPIO em falta?): usar gpio_backend = fake.")
+    return RejectOutput(gpio, reject_pin, accept_pin, **kwargs)
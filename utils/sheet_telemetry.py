@@ -0,0 +1,62 @@
+import csv
+import os
+import time
+
+# ---------------------------
+# Telemetria por folha (CSV)
+# ---------------------------
+# Uma linha por folha inspecionada (ou rejeitada) com a decisão do alinhamento
+# (reuse / realign / reject), o relatório de qualidade (models.align_image.
+# alignment_report), o nº de defeitos e o tempo total. Mesmo formato do
+# logs/param_history.csv (";" como separador, cabeçalho na 1.ª escrita), para
+# abrir direto na folha de cálculo e cruzar alinhamentos maus com falsos defeitos.
+
+SHEET_TELEMETRY_PATH = os.path.join("logs", "sheet_telemetry.csv")
+
+SHEET_TELEMETRY_FIELDS = [
+    "timestamp", "sheet", "decision", "source", "backend", "align_ms",
+    "matches", "inliers", "inlier_ratio", "reproj_rms_px", "shift_px", "response",
+    "scale", "anisotropy", "skew_deg", "perspective", "reasons",
+    "defects", "cans_with_defects", "total_ms",
+]
+
+
+def _fmt(value):
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return "" if value is None else value
+
+
+def sheet_telemetry_row(sheet, decision, align_info, defects=None, cans_with_defects=None, total_ms=None):
+    """Linha de telemetria (dict com SHEET_TELEMETRY_FIELDS) de uma folha."""
+    quality = align_info.get("quality") or {}
+    row = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sheet": sheet,
+        "decision": decision,
+        "source": align_info.get("source"),
+        "backend": align_info.get("backend"),
+        "align_ms": align_info.get("time_ms"),
+        "reasons": " | ".join(quality.get("reasons", [])),
+        "defects": defects,
+        "cans_with_defects": cans_with_defects,
+        "total_ms": total_ms,
+    }
+    for key in ("matches", "inliers", "inlier_ratio", "reproj_rms_px", "shift_px", "response",
+                "scale", "anisotropy", "skew_deg", "perspective"):
+        row[key] = quality.get(key)
+    return {k: _fmt(v) for k, v in row.items()}
+
+
+def append_sheet_telemetry(row, path=SHEET_TELEMETRY_PATH):
+    """Acrescenta a linha ao CSV (cria a pasta e o cabeçalho se preciso)."""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    file_exists = os.path.isfile(path)
+    with open(path, mode="a", newline="", encoding="utf-8") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=SHEET_TELEMETRY_FIELDS, delimiter=';', extrasaction='ignore')
+        if not file_exists:
+            writer.writeheader()
+        writer.writerow(row)
+    return path
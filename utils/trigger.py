@@ -0,0 +1,153 @@
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from utils.gpio_rapsberry import FakeGPIO, RaspberryGPIO
+
+# ---------------------------
+# Trigger da folha por interrupção (sensor de folha em posição, pinos 22–25)
+# ---------------------------
+# O RaspberryGPIO chama _on_edge em cada flanco (ambos os sentidos, thread do
+# RPi.GPIO ou do FakeGPIO) com o instante time.perf_counter() da entrada no
+# callback. Todos os flancos vão para on_change (indicadores da GUI); só o
+# flanco ativo de um pino de trigger gera um evento de folha:
+#   {"seq", "pin", "level", "edge", "t" (perf_counter), "wall" (time.time)}
+# Debounce = janela de bloqueio por pino: um flanco ativo a menos de
+# debounce_ms do último aceite nesse pino é ressalto e é ignorado (contado em
+# "bounces"). Não se usa o bouncetime do RPi.GPIO (pouco fiável com BOTH).
+# O "t" do evento segue com a folha: o estágio de captura mede a latência
+# trigger -> frame capturado (LatencyStats) e o tempo total conta desde o trigger.
+
+TRIGGER_EDGES = ("falling", "rising")
+
+
+class LatencyStats:
+    """Janela rolante de latências (ms): última, mínimo, percentis e máximo."""
+
+    def __init__(self, window=500):
+        self._values = deque(maxlen=int(window))
+        self._lock = threading.Lock()
+
+    def add(self, ms):
+        with self._lock:
+            self._values.append(float(ms))
+
+    def summary(self, percentiles=(50, 95)):
+        """{"n", "last_ms", "min_ms", "p<q>_ms" por percentil, "max_ms"} (None sem amostras)."""
+        with self._lock:
+            v = np.fromiter(self._values, np.float64, len(self._values))
+        if v.size == 0:
+            return None
+        out = {"n": int(v.size), "last_ms": float(v[-1]), "min_ms": float(v.min())}
+        for q, value in zip(percentiles, np.percentile(v, percentiles)):
+            out[f"p{q:g}_ms"] = float(value)
+        out["max_ms"] = float(v.max())
+        return out
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class SheetTrigger:
+    """Flancos do RaspberryGPIO -> eventos de folha com debounce (on_trigger, ou fila para wait())."""
+
+    def __init__(self, gpio, trigger_pins, edge="falling", debounce_ms=50.0, on_trigger=None, on_change=None,
+                 queue_size=16):
+        if edge not in TRIGGER_EDGES:
+            raise ValueError(f"Flanco desconhecido: {edge} (opções: {', '.join(TRIGGER_EDGES)})")
+        self.gpio = gpio
+        self.trigger_pins = [int(p) for p in trigger_pins]
+        self.edge = edge
+        self.debounce_s = max(0.0, float(debounce_ms)) / 1000.0
+        self.on_trigger = on_trigger    # fn(evento) na thread do GPIO; sem ele, eventos na fila (wait)
+        self.on_change = on_change      # fn(pino, nível) em todos os flancos (indicadores)
+        self.events = queue.Queue(int(queue_size))
+        self._seq = itertools.count(1)
+        self._last = {}
+        self._stopped = threading.Event()
+        self.triggers = self.bounces = self.overflows = 0
+        self.watching = False
+
+    def start(self):
+        """Liga as interrupções em todos os pinos do gpio; False se não houver deteção de flancos."""
+        self._stopped.clear()
+        self.watching = self.gpio is not None and self.gpio.watch_edges(self._on_edge)
+        return self.watching
+
+    def stop(self):
+        self._stopped.set()
+        if self.gpio is not None and self.watching:
+            self.gpio.unwatch_edges()
+        self.watching = False
+
+    def _on_edge(self, pin, level, t):
+        if self.on_change is not None:
+            self.on_change(pin, level)
+        if pin not in self.trigger_pins or level != (self.edge == "rising"):
+            return
+        last = self._last.get(pin)
+        if last is not None and t - last < self.debounce_s:
+            self.bounces += 1
+            return
+        self._last[pin] = t
+        self.triggers += 1
+        event = {"seq": next(self._seq), "pin": pin, "level": level, "edge": self.edge, "t": t,
+                 "wall": time.time()}
+        if self.on_trigger is not None:
+            self.on_trigger(event)
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:              # consumidor parado: o trigger perde-se (contado)
+            self.overflows += 1
+
+    def wait(self, timeout=None):
+        """Próximo evento de trigger, ou None com timeout / stop()."""
+        deadline = None if timeout is None else time.monotonic() + float(timeout)
+        while not self._stopped.is_set():
+            remaining = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+            if remaining <= 0:
+                return None
+            try:
+                return self.events.get(timeout=remaining)
+            except queue.Empty:
+                continue
+        return None
+
+
+class TriggerSource:
+    """Fonte de frames comandada pelo trigger: wait() espera o evento, read() lê da fonte interna."""
+
+    def __init__(self, trigger, frames, idle_timeout_s=None):
+        self.trigger = trigger
+        self.frames = frames              # CameraSource, ou FileListSource para replays sem câmara
+        self.idle_timeout_s = idle_timeout_s
+
+    def wait(self):
+        return self.trigger.wait(self.idle_timeout_s)
+
+    def read(self, item):
+        inner = self.frames.wait()
+        if inner is None:
+            raise ValueError(f"Trigger {item['seq']} sem frame: a fonte acabou.")
+        if isinstance(inner, str):
+            item["name"] = inner          # ficheiro reproduzido neste trigger
+        return self.frames.read(inner)
+
+
+def load_trigger_schedule(path):
+    """Sequência de flancos para o FakeGPIO.replay: JSON [[t_s, pino, nível], ...]."""
+    with open(path, "r") as f:
+        schedule = json.load(f)
+    return [(float(t), int(pin), bool(level)) for t, pin, level in schedule]
+
+
+def open_trigger_gpio(pins, backend="auto"):
+    """RaspberryGPIO nos pinos: backend "auto" (RPi.GPIO, se existir) ou "fake" (FakeGPIO em gpio.gpio)."""
+    return RaspberryGPIO(pins, mode='BCM', pull='UP', backend=FakeGPIO() if backend == "fake" else None)
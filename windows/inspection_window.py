@@ -1,88 +1,35 @@
 import os
-import json
 import time
-import csv
 import cv2
-import numpy as np
-from shapely.geometry import Polygon, Point
 from PySide6.QtWidgets import (
     QDialog, QWidget, QLabel, QVBoxLayout, QHBoxLayout, QPushButton, QFrame,
     QGridLayout, QSizePolicy, QSpacerItem
 )
-from PySide6.QtCore import Qt, QTimer
+from PySide6.QtCore import Qt, QTimer, QObject, Signal
 from PySide6.QtGui import QPixmap, QImage, QShortcut, QKeySequence
 from picamera2 import Picamera2
 
 from windows.defect_tuner_window import DefectTunerWindow
-from models.align_image import align_with_template
-from models.defect_detector import detect_defects
-from config.utils import load_params
+from models.inspection_runner import InspectionRunner
 from config.config import INSPECTION_PREVIEW_WIDTH, INSPECTION_PREVIEW_HEIGHT
 from widgets.custom_widgets import (
     ButtonMain, ImageLabel, Switch,
     LabeledValue, TitleLabel, LabeledText,
     LabeledIndicator, Indicator, TitleLabelMain
 )
-from utils.gpio_rapsberry import RaspberryGPIO
-
-import os, json, time
-
-def _load_camera_params_from_json(path="config/camera_params.json"):
-    """
-    Lê os parâmetros guardados do template. Exemplo esperado:
-    {
-        "ExposureTime": 34900,
-        "AnalogueGain": 2.1,
-        "Brightness": 0.8,
-        "Contrast": 2.3,
-        "ColourGains": [2.3, 1.7]
-    }
-    """
-    try:
-        with open(path, "r") as f:
-            params = json.load(f)
-        return params
-    except Exception as e:
-        print(f"⚠️ Não consegui ler {path}: {e}")
-        return {}
-
-def _build_controls_from_params(params: dict):
-    """
-    Converte o JSON em dict de controls para Picamera2.
-    Respeita AeEnable/AwbEnable guardados e só força manuais quando desativados.
-    """
-    ae_on = bool(params.get("AeEnable", False))
-    awb_on = bool(params.get("AwbEnable", False))
-
-    controls = {
-        "AeEnable": ae_on,
-        "AwbEnable": awb_on,
-    }
-
-    # Apenas aplica Exposure/Gain manuais quando AE está OFF
-    if not ae_on:
-        if "ExposureTime" in params:
-            controls["ExposureTime"] = int(params["ExposureTime"])  # µs
-            # Opcional: travar frame duration para estabilizar ainda mais
-            controls["FrameDurationLimits"] = (int(params["ExposureTime"]), int(params["ExposureTime"]))
-        if "AnalogueGain" in params:
-            controls["AnalogueGain"] = float(params["AnalogueGain"])
-
-    # Apenas aplica ColourGains manuais quando AWB está OFF
-    if not awb_on:
-        if "ColourGains" in params and isinstance(params["ColourGains"], (list, tuple)) and len(params["ColourGains"]) == 2:
-            rg, bg = params["ColourGains"]
-            controls["ColourGains"] = (float(rg), float(bg))
-
-    # Estes podem ser sempre aplicados
-    if "Brightness" in params:
-        controls["Brightness"] = float(params["Brightness"])
-    if "Contrast" in params:
-        controls["Contrast"] = float(params["Contrast"])
-    # Se tiveres "Saturation" e "Sharpness" no futuro, também dá:
-    # if "Saturation" in params: controls["Saturation"] = float(params["Saturation"])
-    # if "Sharpness"  in params: controls["Sharpness"]  = float(params["Sharpness"])
-    return controls
+from utils.frame_sources import CameraSource, start_camera
+from utils.pipeline import ThroughputMeter
+from utils.trigger import SheetTrigger, load_trigger_schedule, open_trigger_gpio
+from utils.profiler import PROFILER
+
+class _PipelineSignals(QObject):
+    """Ponte pipeline -> GUI: emitidos nas threads dos estágios, entregues na thread da GUI."""
+    sheet_done = Signal(object)
+    sheet_dropped = Signal(object)
+    sheet_error = Signal(object, str)
+    sheet_triggered = Signal(object)     # evento do sensor (modo síncrono: a folha corre na GUI)
+    gpio_changed = Signal(int, bool)     # flanco num pino (indicadores)
+
 
 class InspectionWindow(QDialog):
     def __init__(self, parent=None, picam2=None, template_path="", mask_path="", user_type="User", user=""):
@@ -111,6 +58,9 @@ class InspectionWindow(QDialog):
         self.count_total_cans = 0
         self.count_good_cans = 0
         self.count_defect_cans = 0
+        self.count_rejected_sheets = 0   # folhas com alinhamento não fiável (não inspecionadas)
+        self.count_dropped_sheets = 0    # triggers descartados com o pipeline cheio
+        self.pipeline = None
 
         try:
             cv2.setUseOptimized(True)
@@ -120,10 +70,14 @@ class InspectionWindow(QDialog):
             pass
 
         # --- novos estados de visualização ---
-        self.last_aligned = None     # última imagem alinhada analisada (color)
+        self.last_aligned = None     # última imagem alinhada analisada (color), gerada só ao mostrar
+        self._last_aligned_src = None  # (frame, H) da última análise, para gerar last_aligned
         self.last_vis_bw  = None     # última imagem B/W com círculos
         self.last_vis_color = None   # última imagem COLOR com círculos
-        self.last_H = None  # homografia a reutilizar enquanto a folha estiver parada
+        self.last_H = None  # homografia da última folha (a cache verificada está no AlignmentEngine)
+        self.last_can_offsets = None  # {numero_lata: (dx, dy, resposta)} do refinamento por lata
+        self.last_align_info = None  # {"source": "cache"|"corners"|"phase"|"orb", "backend", "quality", ...}
+        self.last_sheet_telemetry = None  # última linha de telemetria (utils/sheet_telemetry.py)
 
         # Layout principal
         main_layout = QVBoxLayout(self)
@@ -156,7 +110,8 @@ class InspectionWindow(QDialog):
 
         # GPIO indicators row (22, 23, 24, 25) on the right
         self.gpio_pins = [22, 23, 24, 25]
-        self.gpio = RaspberryGPIO(self.gpio_pins, mode='BCM', pull='UP')
+        self.gpio = None      # aberto com o trigger, depois dos parâmetros (backend real ou fake)
+        self.trigger = None
         self.gpio_indicators = {}
 
         self.bottom_layout.addStretch(1)
@@ -196,11 +151,10 @@ class InspectionWindow(QDialog):
         self.bottom_layout.addWidget(grid_wrap)
         self.bottom_layout.addStretch(1)
 
-        # Timer to poll GPIO states
+        # Timer to poll GPIO states (fallback: only started when edge interrupts are unavailable)
         self.gpio_timer = QTimer(self)
         self.gpio_timer.setInterval(200)
         self.gpio_timer.timeout.connect(self._update_gpio_indicators)
-        self.gpio_timer.start()
 
         # Painel esquerdo (card)
         card_style = "background:#1e1e1e; border:1px solid #333333; border-radius:8px;"
@@ -231,6 +185,15 @@ class InspectionWindow(QDialog):
         self.systemTotalSheets = LabeledValue("Total Sheets: ", 0)
         self.left_panel.addWidget(self.systemTotalSheets)
 
+        self.systemThroughput = LabeledValue("Folhas/min: ", "0.0")
+        self.left_panel.addWidget(self.systemThroughput)
+
+        self.systemTriggerLatency = LabeledText("Trigger→captura: ", "—")
+        self.left_panel.addWidget(self.systemTriggerLatency)
+
+        self.systemRejectOutput = LabeledText("Desviador: ", "—")
+        self.left_panel.addWidget(self.systemRejectOutput)
+
         self.systemTotalCans = LabeledValue("Total Cans: ", 0)
         self.left_panel.addWidget(self.systemTotalCans)
 
@@ -331,83 +294,48 @@ class InspectionWindow(QDialog):
         self.tooltip_img.setVisible(False)
 
         # ----------------- Inicialização Picamera2 -----------------
-        camera_params = _load_camera_params_from_json("config/camera_params.json")
-        controls = _build_controls_from_params(camera_params)
-
         self.picam2 = picam2
-
-        # passa os controls logo na configuração (garante que arranca no modo correto)
-        config = self.picam2.create_still_configuration(
-            main={"size": (4056, 3040), "format": "BGR888"},
-            controls=controls
-        )
-        self.picam2.configure(config)
-        self.picam2.start()
-        time.sleep(0.3)  # breve estabilização
-
-        # reforça os controls após start (algumas versões aplicam melhor depois do start)
-        try:
-            self.picam2.set_controls(controls)
-        except Exception as e:
-            print("⚠️ set_controls após start falhou:", e)
-
+        # passa os controls logo na configuração (config/camera_params.json; utils/frame_sources.py)
+        controls = start_camera(self.picam2, "config/camera_params.json")
         print("[INFO] Controles da câmara aplicados:", controls)
         self._set_status("Câmara inicializada.")
-
-        # Carrega template e máscara
-        self.template_full = cv2.imread(self.template_path)
-        self.mask_full = cv2.imread(self.mask_path, cv2.IMREAD_GRAYSCALE)
-        self.aligned_full = self.template_full.copy()
         self.current_full = self.capture_picam_frame()
 
-        # --- pré-computos do template (1x) ---
-        self.clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(4, 4))
-
-        tpl_gray = cv2.cvtColor(self.template_full, cv2.COLOR_BGR2GRAY)
-        self.tpl_gray_eq = self.clahe.apply(cv2.GaussianBlur(tpl_gray, (3, 3), 0))
-        self.tpl_lab = cv2.cvtColor(self.template_full, cv2.COLOR_BGR2LAB)
-
-        # Carrega parâmetros primeiro (para usar margem ROI)
-        self._load_params()
-
-        # ROI seguro (afasta borda da máscara) + cache bbox
-        try:
-            erode_px = max(0, int(getattr(self, 'roi_erode_px', 2)))
-        except Exception:
-            erode_px = 0
-        k = 2 * erode_px + 1
-        if k < 1:
-            k = 1
-        self.safe_mask = cv2.erode(self.mask_full, np.ones((k,k), np.uint8), 1)
-        nz = cv2.findNonZero(self.safe_mask)
-        x0, y0, w0, h0 = cv2.boundingRect(nz) if nz is not None else (0, 0, self.mask_full.shape[1], self.mask_full.shape[0])
-        self._mask_bbox = (x0, y0, w0, h0)
-
-        # Carrega forma_base e instâncias
-        self.instancias_poligonos = []
-        try:
-            with open("data/mask/forma_base.json", "r") as f:
-                self.forma_base = json.load(f)
-            with open("data/mask/instancias_poligonos.txt") as f:
-                for line in f:
-                    parts = line.strip().split(":")
-                    if len(parts) != 2:
-                        continue
-                    idx_str, rest = parts
-                    cx_str, cy_str, s_str = rest.split(",")
-                    idx = int(idx_str)
-                    cx, cy, s = float(cx_str), float(cy_str), float(s_str)
-                    pontos = [(cx + x * s, cy + y * s) for x, y in self.forma_base]
-                    poly = Polygon(pontos)
-                    self.instancias_poligonos.append({
-                        "numero_lata": idx,
-                        "polygon": poly,
-                        "center": (cx, cy),
-                        "scale": s
-                    })
-            print(f"[INFO] Carregadas {len(self.instancias_poligonos)} instâncias de latas.")
-        except Exception as e:
-            print("❌ Erro ao carregar forma_base ou instâncias:", e)
+        # Inspeção sem GUI (models/inspection_runner.py): template, máscara, parâmetros,
+        # alinhamento, layout das latas e estágios; a janela só trata da UI e dos contadores
+        self.runner = InspectionRunner(self.template_path, self.mask_path, source=CameraSource(self.picam2))
+        self.template_full = self.runner.template_full
+        self.mask_full = self.runner.mask_full
+        self.align_engine = self.runner.align_engine
+        if self.runner.reject_output is None:   # reject_output_enabled = 0 (ou GPIO de saída indisponível)
+            self.systemRejectOutput.update_value("desligado")
+
+        # Pipeline de inspeção (utils/pipeline.py): estágios em threads, resultados por sinais
+        self.throughput = ThroughputMeter(self.runner.throughput_window_s)
+        self._pipeline_signals = _PipelineSignals(self)
+        self._pipeline_signals.sheet_done.connect(self._finish_sheet)
+        self._pipeline_signals.sheet_dropped.connect(self._on_sheet_dropped)
+        self._pipeline_signals.sheet_error.connect(self._on_sheet_error)
+        if self.runner.pipeline_enabled:
+            self.pipeline = self.runner.make_pipeline(
+                on_result=self._pipeline_signals.sheet_done.emit,
+                on_drop=self._pipeline_signals.sheet_dropped.emit,
+                on_error=lambda sheet, stage, e: self._pipeline_signals.sheet_error.emit(sheet, f"{stage}: {e}"),
+            ).start()
+
+        # Sensores 22–25 por interrupção (utils/trigger.py): flancos -> indicadores e, no flanco
+        # ativo de trigger_pins, uma folha (sem clique). Sem deteção de flancos fica o polling.
+        self.gpio = open_trigger_gpio(self.gpio_pins, self.runner.gpio_backend)
+        self._pipeline_signals.sheet_triggered.connect(self._run_triggered_sheet)
+        self._pipeline_signals.gpio_changed.connect(self._on_gpio_changed)
+        self.trigger = SheetTrigger(self.gpio, self.runner.trigger_pins if self.runner.trigger_enabled else [],
+                                    edge=self.runner.trigger_edge, debounce_ms=self.runner.trigger_debounce_ms,
+                                    on_trigger=self._on_trigger, on_change=self._pipeline_signals.gpio_changed.emit)
+        self._update_gpio_indicators()
+        if not self.trigger.start():
+            self.gpio_timer.start()
+        elif self.runner.gpio_backend == "fake" and self.runner.gpio_fake_schedule:
+            self.gpio.gpio.replay(load_trigger_schedule(self.runner.gpio_fake_schedule))
 
         # Mostra template inicial
         self.show_image(self.template_full)
@@ -424,6 +352,7 @@ class InspectionWindow(QDialog):
         QShortcut(QKeySequence("B"), self, activated=lambda: self._shortcut_toggle(self.toggle_bw))
         QShortcut(QKeySequence("C"), self, activated=lambda: self._shortcut_toggle(self.toggle_contours))
         QShortcut(QKeySequence("Ctrl+T"), self, activated=self.open_tuner_window)
+        QShortcut(QKeySequence("P"), self, activated=self._export_profile)
         QShortcut(QKeySequence("Q"), self, activated=self.close)
 
     # ----------------- Funções -----------------
@@ -476,14 +405,21 @@ class InspectionWindow(QDialog):
                 self.show_image(self.last_vis_color)
             else:
                 # fallback se ainda não há análise com círculos
-                base = self.last_aligned if self.last_aligned is not None else self.current_full
+                base = self._aligned_view()
                 img = self._to_gray_bgr(base) if bw else base
                 self.show_image(img)
         else:
-            base = self.last_aligned if self.last_aligned is not None else self.current_full
+            base = self._aligned_view()
             img = self._to_gray_bgr(base) if bw else base
             self.show_image(img)
 
+    def _aligned_view(self):
+        """Frame da última análise alinhado ao template (warp inteiro feito só quando pedido)."""
+        if self.last_aligned is None and self._last_aligned_src is not None:
+            frame, H = self._last_aligned_src
+            self.last_aligned = self.align_engine.warp_full(frame, H)
+        return self.last_aligned if self.last_aligned is not None else self.current_full
+
     def _toggle_defect_contours(self):
         self._refresh_view()
 
@@ -493,353 +429,81 @@ class InspectionWindow(QDialog):
     def _shortcut_toggle(self, switch_widget):
         switch_widget.setChecked(not switch_widget.isChecked())
 
-    def _load_params(self):
-        params = load_params("config/inspection_params.json") or {}
-
-        # ---- existentes ----
-        self.dark_threshold           = int(params.get("dark_threshold", 30))
-        self.bright_threshold         = int(params.get("bright_threshold", 30))
-        self.dark_morph_kernel_size   = int(params.get("dark_morph_kernel_size", 3))
-        self.dark_morph_iterations    = int(params.get("dark_morph_iterations", 1))
-        self.bright_morph_kernel_size = int(params.get("bright_morph_kernel_size", 3))
-        self.bright_morph_iterations  = int(params.get("bright_morph_iterations", 1))
-        # aceita detect_area (antigo) OU min_defect_area (novo)
-        self.min_defect_area          = int(params.get("detect_area", params.get("min_defect_area", 1)))
-        self.dark_gradient_threshold  = int(params.get("dark_gradient_threshold", 10))
-        self.blue_threshold           = int(params.get("blue_threshold", 25))
-        self.red_threshold            = int(params.get("red_threshold", 25))
-
-        # ---- NOVOS: MS-SSIM ----
-        self.use_ms_ssim              = bool(int(params.get("use_ms_ssim", 1)))
-        self.msssim_percentile        = float(params.get("msssim_percentile", 99.5))
-        self.msssim_weight            = float(params.get("msssim_weight", 0.5))
-
-        # kernels por escala (ímpares)
-        k1 = int(params.get("msssim_kernel_size_s1", 7))
-        k2 = int(params.get("msssim_kernel_size_s2", 5))
-        k3 = int(params.get("msssim_kernel_size_s3", 3))
-        if k1 < 1: k1 = 1
-        if k2 < 1: k2 = 1
-        if k3 < 1: k3 = 1
-        if k1 % 2 == 0: k1 += 1
-        if k2 % 2 == 0: k2 += 1
-        if k3 % 2 == 0: k3 += 1
-        self.msssim_kernel_sizes = (k1, k2, k3)
-
-        # sigmas por escala
-        s1 = float(params.get("msssim_sigma_s1", 1.5))
-        s2 = float(params.get("msssim_sigma_s2", 1.0))
-        s3 = float(params.get("msssim_sigma_s3", 0.8))
-        self.msssim_sigmas = (s1, s2, s3)
-
-        # morfologia do mapa MS-SSIM
-        self.msssim_morph_kernel_size = int(params.get("msssim_morph_kernel_size", 3))
-        if self.msssim_morph_kernel_size < 1:
-            self.msssim_morph_kernel_size = 1
-        if self.msssim_morph_kernel_size % 2 == 0:
-            self.msssim_morph_kernel_size += 1
-
-        self.msssim_morph_iterations  = int(params.get("msssim_morph_iterations", 1))
-        if self.msssim_morph_iterations < 0:
-            self.msssim_morph_iterations = 0
-
-        # ---- NOVOS: Mapas morfológicos L, Δa/Δb e Fusão ----
-        self.use_morph_maps      = bool(int(params.get("use_morph_maps", 1)))
-        self.th_top_percentile   = float(params.get("th_top_percentile", 99.5))
-        self.th_black_percentile = float(params.get("th_black_percentile", 99.5))
-        # clamps percentis
-        self.th_top_percentile   = max(0.0, min(100.0, self.th_top_percentile))
-        self.th_black_percentile = max(0.0, min(100.0, self.th_black_percentile))
-
-        self.se_top   = int(params.get("se_top", 9))
-        self.se_black = int(params.get("se_black", 9))
-        if self.se_top < 1: self.se_top = 1
-        if self.se_black < 1: self.se_black = 1
-        if self.se_top % 2 == 0: self.se_top += 1
-        if self.se_black % 2 == 0: self.se_black += 1
-
-        self.use_color_delta  = bool(int(params.get("use_color_delta", 1)))
-        self.color_metric     = str(params.get("color_metric", "maxab"))
-        self.color_percentile = float(params.get("color_percentile", 99.0))
-        self.color_percentile = max(0.0, min(100.0, self.color_percentile))
-
-        self.fusion_mode = str(params.get("fusion_mode", "or"))
-        self.w_struct    = float(params.get("w_struct", 0.50))
-        self.w_top       = float(params.get("w_top", 0.25))
-        self.w_black     = float(params.get("w_black", 0.15))
-        self.w_color     = float(params.get("w_color", 0.10))
-        self.fused_percentile = float(params.get("fused_percentile", 99.5))
-        # clamps
-        for attr in ("w_struct","w_top","w_black","w_color"):
-            v = getattr(self, attr)
-            setattr(self, attr, max(0.0, min(1.0, float(v))))
-        self.fused_percentile = max(0.0, min(100.0, self.fused_percentile))
-
-        # ---- ROI / Border handling ----
-        self.roi_erode_px = int(params.get("roi_erode_px", 2))
-        self.roi_erode_px = max(0, self.roi_erode_px)
-        self.suppress_border_width_px = int(params.get("suppress_border_width_px", 0))
-        self.suppress_border_width_px = max(0, self.suppress_border_width_px)
-        # overexposed handling
-        self.ignore_overexposed = bool(int(params.get("ignore_overexposed", params.get("ignore_overexposed", 0))))
-
-        # ---- clamps básicos úteis ----
-        self.dark_threshold   = max(0, min(255, self.dark_threshold))
-        self.bright_threshold = max(0, min(255, self.bright_threshold))
-        self.blue_threshold   = max(0, min(255, self.blue_threshold))
-        self.red_threshold    = max(0, min(255, self.red_threshold))
-
-        # kernels ímpares nas morfologias principais
-        if self.dark_morph_kernel_size < 1: self.dark_morph_kernel_size = 1
-        if self.dark_morph_kernel_size % 2 == 0: self.dark_morph_kernel_size += 1
-        if self.bright_morph_kernel_size < 1: self.bright_morph_kernel_size = 1
-        if self.bright_morph_kernel_size % 2 == 0: self.bright_morph_kernel_size += 1
-
-        self.dark_morph_iterations   = max(0, self.dark_morph_iterations)
-        self.bright_morph_iterations = max(0, self.bright_morph_iterations)
-
-        self.min_defect_area = max(1, self.min_defect_area)
-
-
-    
-    @staticmethod
-    def _normalize_lab_to_template(tpl_bgr, img_bgr, mask):
-        
-        eps = 1e-6
-        tpl_lab = cv2.cvtColor(tpl_bgr, cv2.COLOR_BGR2LAB).astype(np.float32)
-        img_lab = cv2.cvtColor(img_bgr,  cv2.COLOR_BGR2LAB).astype(np.float32)
-        m = (mask > 0)
-        norm = img_lab.copy()
-        for c in range(3):
-            mu_t, sd_t = float(np.mean(tpl_lab[:,:,c][m])), float(np.std(tpl_lab[:,:,c][m]) + eps)
-            mu_i, sd_i = float(np.mean(img_lab[:,:,c][m])), float(np.std(img_lab[:,:,c][m]) + eps)
-            gain = sd_t / sd_i
-            # clamp to avoid over/under-correction jitter
-            gain = max(0.8, min(1.25, gain))
-            bias = mu_t - gain * mu_i
-            bias = max(-10.0, min(10.0, bias))
-            norm[:,:,c] = gain * img_lab[:,:,c] + bias
-        norm = np.clip(norm, 0, 255).astype(np.uint8)
-        return cv2.cvtColor(norm, cv2.COLOR_LAB2BGR)
+    # ---------------------------
+    # Ciclo de inspeção
+    # ---------------------------
+    # Os estágios (captura -> alinhamento -> deteção -> classificação -> render)
+    # são os do InspectionRunner. Com pipeline_enabled (omissão) correm no
+    # SheetPipeline do runner (uma thread por estágio, filas limitadas) e a folha
+    # concluída chega pelo sinal sheet_done: a GUI não congela e a folha N+1 é
+    # capturada enquanto a N ainda está na deteção. _finish_sheet corre sempre
+    # na thread da GUI.
 
     def _show_defects(self):
-        total_start = time.perf_counter()
-
-        try:
-            cv2.setUseOptimized(True)
-            cv2.setNumThreads(4)
-        except Exception:
-            pass
+        self._run_sheet(self.runner.new_sheet())
 
-       # 1) Bloquear AE/AWB ANTES da captura (para estabilizar a exposição)
-        self.picam2.set_controls({"AeEnable": False, "AwbEnable": False})
-        time.sleep(0.05)
-        frame = self.picam2.capture_array("main")
-        self.current_full = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-        # 2) Alinhamento (current -> template) com reutilização da última H
-        H = getattr(self, "last_H", None)
-        if H is not None:
-            try:
-                # warpa diretamente com a H anterior (mais estável entre cliques)
-                self.aligned_full = cv2.warpPerspective(
-                    self.current_full, H,
-                    (self.template_full.shape[1], self.template_full.shape[0])
-                )
-            except Exception:
-                H = None  # força realinhar se der erro
-
-        if H is None:
-            # não havia H válida — faz o alinhamento completo e guarda H
-            try:
-                self.aligned_full, H = align_with_template(self.current_full, self.template_full)
-                if self.aligned_full is None or H is None:
-                    raise ValueError("Falhou alinhamento")
-                self.last_H = H  # <- guarda para os próximos cliques
-            except Exception as e:
-                print("⚠️ Erro no alinhamento, usando imagem original:", e)
-                self.aligned_full = self.current_full.copy()
-                H = np.eye(3, dtype=np.float32)
-                self.last_H = None  # não guardar uma H inválida
-
-        # Inversa: template -> current (para reprojetar desenho)
-        try:
-            H_inv = np.linalg.inv(H)
-        except Exception:
-            H_inv = np.eye(3, dtype=np.float32)
-
-        # 3) ROI da máscara (cálculo/uso)
-        if not hasattr(self, "_mask_bbox"):
-            nz = cv2.findNonZero(self.mask_full)
-            if nz is None:
-                print("❌ Máscara vazia.")
-                return
-            x0, y0, w0, h0 = cv2.boundingRect(nz)
-            self._mask_bbox = (x0, y0, w0, h0)
-        else:
-            x0, y0, w0, h0 = self._mask_bbox
-
-        # 4) Recortes ROI no espaço do TEMPLATE (porque aligned_full está nesse espaço)
-        tpl_roi  = self.template_full[y0:y0+h0, x0:x0+w0]
-        cur_roi  = self.aligned_full[y0:y0+h0, x0:x0+w0]
-        mask_roi = self.safe_mask[y0:y0+h0, x0:x0+w0]
-
-        # Normalização fotométrica sempre aplicada para estabilidade
-        tpl_masked_roi = cv2.bitwise_and(tpl_roi, tpl_roi, mask=mask_roi)
-        cur_masked_roi = cv2.bitwise_and(cur_roi, cur_roi, mask=mask_roi)
-        cur_masked_roi = self._normalize_lab_to_template(tpl_masked_roi, cur_masked_roi, mask_roi)
-
-        # 5) Deteção de defeitos (em coords do TEMPLATE/ROI)
-        t_det = time.perf_counter()
-        result = detect_defects(
-            tpl_masked_roi, cur_masked_roi, mask_roi,
-            self.dark_threshold, self.bright_threshold,
-            self.dark_morph_kernel_size,  self.dark_morph_iterations,
-            self.bright_morph_kernel_size, self.bright_morph_iterations,
-            self.min_defect_area, self.dark_gradient_threshold,
-            self.blue_threshold, self.red_threshold,
-            # ---- MS-SSIM ----
-            use_ms_ssim=self.use_ms_ssim,
-            msssim_percentile=self.msssim_percentile,
-            msssim_weight=self.msssim_weight,
-            msssim_kernel_sizes=self.msssim_kernel_sizes,
-            msssim_sigmas=self.msssim_sigmas,
-            msssim_morph_kernel_size=self.msssim_morph_kernel_size,
-            msssim_morph_iterations=self.msssim_morph_iterations,
-            # ---- ROI / Borders ----
-            roi_erode_px=self.roi_erode_px,
-            suppress_border_width_px=self.suppress_border_width_px,
-            # ---- Overexposed ----
-            ignore_overexposed=self.ignore_overexposed,
-            # ---- Mapas adicionais + Fusão ----
-            use_morph_maps=self.use_morph_maps,
-            th_top_percentile=self.th_top_percentile,
-            th_black_percentile=self.th_black_percentile,
-            se_top=self.se_top,
-            se_black=self.se_black,
-            use_color_delta=self.use_color_delta,
-            color_metric=self.color_metric,
-            color_percentile=self.color_percentile,
-            fusion_mode=self.fusion_mode,
-            w_struct=self.w_struct,
-            w_top=self.w_top,
-            w_black=self.w_black,
-            w_color=self.w_color,
-            fused_percentile=self.fused_percentile,
-        )
-        if len(result) == 7:
-            final_mask, contours_roi, darker_mask_roi, brighter_mask_roi, blue_mask_roi, red_mask_roi, _ = result
+    def _on_trigger(self, event):
+        """Flanco do sensor (thread do GPIO): a folha entra logo no pipeline, sem esperar pela GUI."""
+        if self.pipeline is not None:
+            self.pipeline.submit(self.runner.new_sheet(event))
         else:
-            final_mask, contours_roi, darker_mask_roi, brighter_mask_roi, blue_mask_roi, red_mask_roi = result
-
-        # 6) Preparar visualizações sobre a IMAGEM ORIGINAL (sem warp)
-        gray_full = cv2.cvtColor(self.current_full, cv2.COLOR_BGR2GRAY)
-        vis_bw    = cv2.cvtColor(gray_full, cv2.COLOR_GRAY2BGR)
-        vis_color = self.current_full.copy()
-
-        # helpers para reprojetar um ponto e um raio
-        def _warp_point_T2C(Hinv, x_t, y_t):
-            v = np.array([x_t, y_t, 1.0], dtype=np.float32)
-            w = Hinv @ v
-            w /= (w[2] + 1e-12)
-            return float(w[0]), float(w[1])
-
-        def _warp_radius_T2C(Hinv, cx_t, cy_t, r_t):
-            # aproxima o raio transformando um ponto deslocado no template
-            x2_t, y2_t = cx_t + r_t, cy_t
-            cx_c, cy_c = _warp_point_T2C(Hinv, cx_t, cy_t)
-            x2_c, y2_c = _warp_point_T2C(Hinv, x2_t, y2_t)
-            return max(1.0, ((x2_c - cx_c)**2 + (y2_c - cy_c)**2) ** 0.5)
-
-        mask_types = {
-            "dark":   darker_mask_roi,
-            "bright": brighter_mask_roi,
-            "blue":   blue_mask_roi,
-            "red":    red_mask_roi
-        }
-        color_map = {
-            "dark":   (0, 255, 0),
-            "bright": (255, 255, 0),
-            "blue":   (0, 0, 255),
-            "red":    (255, 0, 255)
-        }
-
-        defect_data = []
-        self.defect_contours = []
+            self._pipeline_signals.sheet_triggered.emit(event)
+
+    def _run_triggered_sheet(self, event):
+        self._run_sheet(self.runner.new_sheet(event))
 
-        for cnt_roi in contours_roi:
-            xr, yr, wr, hr = cv2.boundingRect(cnt_roi)
-            # tipo dominante no ROI (template-space)
-            label = max(
-                mask_types,
-                key=lambda k: cv2.countNonZero(mask_types[k][yr:yr+hr, xr:xr+wr])
-            )
-            color = color_map[label]
-
-            # círculo mínimo no ROI (template-space)
-            (cxr_f, cyr_f), rr_f = cv2.minEnclosingCircle(cnt_roi)
-            cx_t, cy_t, r_t = float(cxr_f + x0), float(cyr_f + y0), float(max(rr_f, 8))
-
-            # reprojetar centro/raio para CURRENT (sem warp)
-            cx_c, cy_c = _warp_point_T2C(H_inv, cx_t, cy_t)
-            r_c = max(24.0, _warp_radius_T2C(H_inv, cx_t, cy_t, r_t) + 6.0)
-
-            # reprojetar contorno completo para guardar/mostrar (opcional)
-            cnt_full_t = cnt_roi.copy()
-            cnt_full_t[:, 0, 0] += x0
-            cnt_full_t[:, 0, 1] += y0
-            # aplica H_inv
-            pts = cnt_full_t.reshape(-1, 2).astype(np.float32)
-            pts_h = np.hstack([pts, np.ones((pts.shape[0], 1), dtype=np.float32)])
-            pts_c = (pts_h @ H_inv.T)
-            pts_c[:, 0] /= (pts_c[:, 2] + 1e-12)
-            pts_c[:, 1] /= (pts_c[:, 2] + 1e-12)
-            cnt_full_c = pts_c[:, :2].reshape(-1, 1, 2).astype(np.int32)
-            self.defect_contours.append(cnt_full_c)
-
-            # desenhar nos visuais (CURRENT)
-            cxi, cyi, ri = int(round(cx_c)), int(round(cy_c)), int(round(r_c))
-            cv2.circle(vis_bw,    (cxi, cyi), ri, color, 3, lineType=cv2.LINE_AA)
-            cv2.circle(vis_bw,    (cxi, cyi), 2,  color, -1, lineType=cv2.LINE_AA)
-            cv2.circle(vis_color, (cxi, cyi), ri, color, 3, lineType=cv2.LINE_AA)
-            cv2.circle(vis_color, (cxi, cyi), 2,  color, -1, lineType=cv2.LINE_AA)
-
-            # nº da lata (encontra por polígono em coords CURRENT)
-            lata_id = None
-            pt = Point(cxi, cyi)
-            for pol in self.instancias_poligonos:
-                # Polígonos estão em coords do TEMPLATE? Se sim, reprojeta vértices 1x ao arranque.
-                # Supondo que já tens os polígonos em CURRENT, senão comentar…
-                if pol["polygon"].contains(pt) or pol["polygon"].distance(pt) <= 2.0:
-                    lata_id = pol["numero_lata"]
-                    break
-
-            if lata_id is None and self.instancias_poligonos:
-                nearest = min(self.instancias_poligonos,
-                            key=lambda p: (p["center"][0] - cxi)**2 + (p["center"][1] - cyi)**2)
-                lata_id = nearest["numero_lata"]
-
-            if lata_id is not None:
-                cv2.putText(vis_bw,    f"#{lata_id}", (max(cxi - ri, 0), max(cyi - ri - 6, 0)),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
-                cv2.putText(vis_color, f"#{lata_id}", (max(cxi - ri, 0), max(cyi - ri - 6, 0)),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
-
-            defect_data.append({
-                "lata": lata_id,
-                "tipo": label,
-                "area": round(cv2.contourArea(cnt_full_c), 2),
-                "bbox": (int(xr + x0), int(yr + y0), int(wr), int(hr)),  # bbox ainda em template-space, se precisares reprojeta os 4 cantos
-                "cx": int(cxi), "cy": int(cyi), "r": int(ri)
-            })
+    def _run_sheet(self, sheet):
+        if self.pipeline is not None:
+            self.pipeline.submit(sheet)     # descartada -> sinal sheet_dropped
+            return
+        # síncrono: um trace por folha (utils.profiler; sem custo com o profiler desligado)
+        try:
+            with PROFILER.sheet():
+                for _, stage in self.runner.stages():
+                    sheet = stage(sheet)
+        except Exception as e:
+            self._on_sheet_error(sheet, str(e))
+            return
+        self._finish_sheet(sheet)
+
+    def _finish_sheet(self, sheet):
+        """Folha concluída (thread da GUI): estado, contadores, imagem e telemetria."""
+        sp = PROFILER.start("ui_update")
+        verdict = self.runner.finish(sheet)   # tempo total, veredicto e telemetria da folha
+        self.last_sheet_telemetry = self.runner.last_sheet_telemetry
+        self.current_full = sheet["frame"]
+        self.last_align_info = sheet["align_info"]
+        self.last_H = None if sheet["decision"] == "reject" else sheet["H"]  # não guardar uma H inválida
+        if "can_offsets" in sheet:
+            self.last_can_offsets = sheet["can_offsets"]
+        if "coarse_telemetry" in sheet:
+            self.last_coarse_telemetry = sheet["coarse_telemetry"]
+        self.defect_contours = sheet["contours"]
+        self.last_aligned   = None   # frame alinhado inteiro só quando for preciso mostrar/guardar
+        self._last_aligned_src = None if sheet["skip"] else (sheet["frame"], sheet["H"])
+        self.last_vis_bw    = sheet["vis_bw"]
+        self.last_vis_color = sheet["vis_color"]
+        self.throughput.tick()
+        self.systemThroughput.set_value(f"{self.throughput.per_minute():.1f}")
+        if sheet.get("trigger_latency_ms") is not None:
+            lat = self.runner.trigger_latency.summary()
+            self.systemTriggerLatency.update_value(f"{lat['last_ms']:.0f} ms (p95 {lat['p95_ms']:.0f})")
+        if self.runner.reject_output is not None:
+            ro = self.runner.reject_output.stats()
+            slack = f", folga p5 {ro['slack']['p5_ms']:.0f} ms" if ro["slack"] else ""
+            self.systemRejectOutput.update_value(f"{ro['misses']} fora de prazo{slack}")
+        if sheet["skip"]:
+            self._reject_sheet(sheet)
+            sp.stop()
+            return
 
         # 7) Atualiza contadores e UI
-        can_ids = {d["lata"] for d in defect_data if d.get("lata") is not None}
+        defect_data, can_ids = sheet["defect_data"], sheet["can_ids"]
         cans_with_defects = len(can_ids)
-        per_sheet_total = len(self.instancias_poligonos) if hasattr(self, 'instancias_poligonos') else 0
+        per_sheet_total = len(self.runner.can_layout)
         per_sheet_good = max(0, per_sheet_total - cans_with_defects)
 
-        # contar folha sempre que corre _show_defects
+        # contar folha sempre que uma inspeção termina
         self.count_sheets += 1
         self.systemTotalSheets.set_value(self.count_sheets)
 
@@ -859,22 +523,55 @@ class InspectionWindow(QDialog):
         self.systemCansDefects.update_value(ids_text)
 
         # 8) Mostra sobre o frame ORIGINAL (sem funil)
-        self.show_image(vis_bw)
-        print(f"[Tempo Total] _show_defects: {time.perf_counter() - total_start:.4f} s")
-
-        self.last_aligned   = self.aligned_full.copy()   # ainda guardo, útil p/ debug
-        self.last_vis_bw    = vis_bw
-        self.last_vis_color = vis_color
+        self.show_image(sheet["vis_bw"])
+        print(f"[Tempo Total] folha {sheet['seq']}: {verdict['total_ms'] / 1000.0:.4f} s")
         self._refresh_view()
         self._set_status(f"Inspeção concluída: {len(defect_data)} defeitos em {cans_with_defects} latas.")
+        sp.stop()
+
+    def _reject_sheet(self, sheet):
+        """Folha com alinhamento não fiável: não correu a deteção; mostra o frame tal como veio."""
+        self.count_sheets += 1
+        self.count_rejected_sheets += 1
+        self.systemTotalSheets.set_value(self.count_sheets)
+        self.show_image(sheet["vis_bw"])
+        self._refresh_view()
+        reasons = sheet["align_info"]["quality"]["reasons"]
+        self._set_status(f"Folha rejeitada: alinhamento não fiável ({reasons[0] if reasons else '?'}). "
+                         f"{self.count_rejected_sheets} rejeitada(s) nesta sessão.")
+
+    def _on_sheet_dropped(self, sheet):
+        self.count_dropped_sheets += 1
+        print(f"⚠️ Folha {sheet['seq']} descartada: pipeline cheio ({self.pipeline.drop_policy})")
+        self._set_status(f"Folha descartada (inspeção ainda ocupada): {self.count_dropped_sheets} nesta sessão.")
+
+    def _on_sheet_error(self, sheet, message):
+        print(f"❌ Erro na inspeção da folha {sheet.get('seq')}:", message)
+        self._set_status(f"Erro na inspeção: {message}")
+
+    def _export_profile(self):
+        """Imprime p50/p95/p99 por estágio e grava o Chrome trace das últimas folhas em logs/traces."""
+        if not PROFILER.enabled:
+            self._set_status("Profiler desligado (profile_enabled=1 ou INSPECTION_PROFILE=1).")
+            return
+        print(PROFILER.report())
+        ts = time.strftime("%Y%m%d_%H%M%S")
+        path = PROFILER.export_chrome_trace(os.path.join("logs", "traces", f"trace_{ts}.json"))
+        self._set_status(f"Trace guardado: {path}")
 
     def open_tuner_window(self):
+        # a câmara e o AlignmentEngine são dos estágios do pipeline enquanto houver folhas em curso
+        if self.pipeline is not None and self.pipeline.in_flight():
+            self._set_status("Inspeção em curso: aguarde antes de abrir o Tuner.")
+            return
         # 1) capturar frame atual
         frame = self.picam2.capture_array("main")
         cur = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
 
-        # 2) alinhar ao template em espaço do template
-        aligned, _ = align_with_template(cur, self.template_full)
+        # 2) alinhar ao template em espaço do template (frame inteiro: com set_roi o align
+        #    só devolve a bbox da máscara, e o Tuner trabalha com template/máscara inteiros)
+        _, H = self.align_engine.align(cur)
+        aligned = self.align_engine.warp_full(cur, H)
 
         # 3) aplicar máscara do template (em coords do template!)
         tpl_m = cv2.bitwise_and(self.template_full, self.template_full, mask=self.mask_full)
@@ -932,7 +629,13 @@ class InspectionWindow(QDialog):
         self.count_total_cans = 0
         self.count_good_cans = 0
         self.count_defect_cans = 0
+        self.count_rejected_sheets = 0
+        self.count_dropped_sheets = 0
+        self.throughput.reset()
+        self.runner.trigger_latency.reset()
         self.systemTotalSheets.set_value(0)
+        self.systemThroughput.set_value("0.0")
+        self.systemTriggerLatency.update_value("—")
         self.systemTotalCans.set_value(0)
         self.systemGoodCans.set_value(0)
         self.systemTotalDefects.set_value(0)
@@ -947,7 +650,7 @@ class InspectionWindow(QDialog):
             if self.toggle_contours.isChecked():
                 img = self.last_vis_bw if self.toggle_bw.isChecked() else self.last_vis_color
             if img is None:
-                img = self.last_aligned if self.last_aligned is not None else self.current_full
+                img = self._aligned_view()
             out_dir = os.path.join("logs", "snapshots")
             os.makedirs(out_dir, exist_ok=True)
             out_path = os.path.join(out_dir, f"snapshot_{ts}.png")
@@ -972,14 +675,29 @@ class InspectionWindow(QDialog):
             pass
 
         try:
+            if self.trigger is not None:
+                self.trigger.stop()
             if hasattr(self, "gpio") and self.gpio is not None:
                 self.gpio.cleanup()
         except Exception:
             pass
 
+        # pára os estágios antes da câmara (folhas em espera são descartadas)
+        try:
+            if self.pipeline is not None:
+                self.pipeline.stop(drain=False, timeout=5.0)
+            self.runner.close()
+        except Exception:
+            pass
+
         self.picam2.stop()
         event.accept()
 
+    def _on_gpio_changed(self, pin, level):
+        ind = self.gpio_indicators.get(pin)
+        if ind is not None:
+            ind.set_state(bool(level))
+
     def _update_gpio_indicators(self):
         # Poll GPIO states via utils wrapper
         try: